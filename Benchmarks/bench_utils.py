@@ -0,0 +1,133 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+import timeit
+import platform
+import subprocess
+import multiprocessing
+from datetime import datetime
+import numpy as np
+import torch
+import torch.optim as optim
+import torch.utils.data as data_utils
+from argparse import Namespace
+from Utils import synthetic_data
+
+
+# -------------------------------------------------------------------------------------------
+#  Common utilities for the benchmarks
+# -------------------------------------------------------------------------------------------
+
+
+def get_default_prm(**kwargs):
+    ''' Parameters for the benchmarks (the same defaults as in main_Meta_Bayes.py, with synthetic data) '''
+    prm = Namespace(data_source='Synthetic', data_transform='None', data_path='', model_name='ConvNet3',
+                    loss_type='CrossEntropy', batch_size=128, test_batch_size=512, n_MC=1, n_MC_eval=3,
+                    log_var_init={'mean': -10, 'std': 0.1}, lr=1e-3, lr_schedule={},
+                    complexity_type='Seeger', divergence_type='KL', kappa_prior=1e2, kappa_post=1e-3, delta=0.1,
+                    test_type='MaxPosterior', meta_batch_size=5, n_train_tasks=5, seed=1,
+                    device=torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
+    prm.optim_func, prm.optim_args = optim.Adam, {'lr': prm.lr}
+    for name, value in kwargs.items():
+        setattr(prm, name, value)
+    return prm
+
+
+def get_synthetic_loaders(prm, n_tasks, meta_split='meta_train', num_workers=0):
+    ''' Data loaders of synthetic tasks (by default without worker processes, to time only the computation) '''
+    tasks = synthetic_data.SyntheticTasks(prm)
+    data_loaders = []
+    for i_task in range(n_tasks):
+        train_dataset, test_dataset = tasks.get_task(meta_split)
+        train_loader = data_utils.DataLoader(train_dataset, batch_size=prm.batch_size, shuffle=True,
+                                             num_workers=num_workers)
+        test_loader = data_utils.DataLoader(test_dataset, batch_size=prm.test_batch_size, shuffle=False,
+                                            num_workers=num_workers)
+        data_loaders.append({'train': train_loader, 'test': test_loader,
+                             'n_train_samples': len(train_dataset), 'n_test_samples': len(test_dataset)})
+    return data_loaders
+
+
+def sync_device(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def time_func(func, device, n_warmup=3, n_repeat=20):
+    ''' Returns timing statistics [ms] of repeated calls of func (after some warm-up calls) '''
+    for _ in range(n_warmup):
+        func()
+    times = []
+    for _ in range(n_repeat):
+        sync_device(device)
+        start_time = timeit.default_timer()
+        func()
+        sync_device(device)
+        times.append(1e3 * (timeit.default_timer() - start_time))
+    times = np.array(times)
+    return {'mean_ms': float(times.mean()), 'std_ms': float(times.std()), 'min_ms': float(times.min()),
+            'median_ms': float(np.median(times)), 'n_repeat': n_repeat}
+
+
+def get_git_commit():
+    try:
+        repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_dir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_machine_info(device):
+    info = {'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpu_count': multiprocessing.cpu_count(),
+            'python': sys.version.split()[0], 'torch': torch.__version__, 'numpy': np.__version__,
+            'torch_threads': torch.get_num_threads(), 'device': str(device), 'git_commit': get_git_commit()}
+    if device.type == 'cuda':
+        info['gpu'] = torch.cuda.get_device_name(device)
+        info['cuda'] = torch.version.cuda
+        info['cudnn'] = torch.backends.cudnn.version()
+    return info
+
+
+# -------------------------------------------------------------------------------------------
+#  Results files
+# -------------------------------------------------------------------------------------------
+
+def save_results(results, file_path):
+    dir_path = os.path.dirname(file_path)
+    if dir_path and not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    with open(file_path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results saved in ' + file_path)
+
+
+def load_results(file_path):
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+
+def compare_to_baseline(results, baseline, regression_threshold=0.1):
+    ''' Compares the mean times with a stored baseline.
+      Returns the report lines and the list of benchmarks which are slower by more than regression_threshold '''
+    lines = ['{:<60}{:>14}{:>14}{:>10}'.format('Benchmark', 'Baseline[ms]', 'Current[ms]', 'Ratio')]
+    regressions = []
+    baseline_benchmarks = baseline['benchmarks']
+    for name, stats in sorted(results['benchmarks'].items()):
+        if name not in baseline_benchmarks:
+            lines.append('{:<60}{:>14}{:>14.3f}{:>10}'.format(name, '-', stats['mean_ms'], 'new'))
+            continue
+        base_time = baseline_benchmarks[name]['mean_ms']
+        ratio = stats['mean_ms'] / max(base_time, 1e-12)
+        flag = ''
+        if ratio > 1 + regression_threshold:
+            regressions.append(name)
+            flag = '  <-- slower'
+        lines.append('{:<60}{:>14.3f}{:>14.3f}{:>10.2f}{}'.format(name, base_time, stats['mean_ms'], ratio, flag))
+    if baseline['machine'].get('device') != results['machine'].get('device') or \
+            baseline['machine'].get('gpu') != results['machine'].get('gpu'):
+        lines.append('Note: the baseline was measured on a different device ({})'.format(baseline['machine']))
+    return lines, regressions
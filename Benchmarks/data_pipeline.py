@@ -0,0 +1,167 @@
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import timeit
+from copy import deepcopy
+import torch
+import torch.utils.data as data_utils
+
+from Utils.data_gen import Task_Generator, CachedDataset
+from Utils.Losses import get_loss_func
+from Utils.common import set_random_seed
+from Models.stochastic_models import get_model
+from Benchmarks.bench_utils import get_default_prm, get_machine_info, time_func, save_results
+
+# -------------------------------------------------------------------------------------------
+#  Data pipeline throughput benchmark
+# -------------------------------------------------------------------------------------------
+# For each data source x data transform combination, measures:
+#   * tasks/sec of Task_Generator.create_meta_batch (data set loading, splitting and transform creation)
+#   * batches/sec and images/sec of iterating the train loader of a task, for each combination of
+#     number of workers, batch size and cached \ uncached data set (two passes, the second one shows the cache effect)
+#   * batches/sec of the forward + backward of the model on the same batches (compute only),
+#     so each configuration can be marked as data-bound or compute-bound.
+# Data sources which are not available on the machine (e.g. no data on disk and no network) are reported as skipped.
+#
+# Run from the repository root, e.g.:
+#   python -m Benchmarks.data_pipeline --data_sources Synthetic Omniglot --num_workers 0 2 4 --batch_sizes 32 128
+
+DATA_SOURCES = ['Synthetic', 'MNIST', 'binarized_MNIST', 'CIFAR10', 'Omniglot', 'SmallImageNet']
+DATA_TRANSFORMS = ['None', 'Permute_Pixels', 'Shuffled_Pixels', 'Permute_Labels', 'Rotate90']
+
+
+def benchmark_task_creation(task_generator, prm, n_tasks):
+    start_time = timeit.default_timer()
+    data_loaders = task_generator.create_meta_batch(prm, n_tasks, meta_split='meta_train')
+    elapsed = timeit.default_timer() - start_time
+    return data_loaders, {'tasks_per_sec': n_tasks / elapsed, 'time_per_task_ms': 1e3 * elapsed / n_tasks}
+
+
+def benchmark_loader(dataset, batch_size, num_workers, n_batches, n_passes, device):
+    ''' Batches/sec and images/sec of each pass over the first n_batches of the data set '''
+    # note: no shuffling, so the passes read the same samples (and the cached passes hit the cache)
+    loader = data_utils.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                                   pin_memory=device.type == 'cuda')
+    passes = []
+    for i_pass in range(n_passes):
+        n_images = 0
+        i_batch = 0
+        start_time = timeit.default_timer()
+        for inputs, targets in loader:
+            inputs, targets = inputs.to(device), targets.to(device)
+            n_images += inputs.shape[0]
+            i_batch += 1
+            if n_batches and i_batch >= n_batches:
+                break
+        elapsed = timeit.default_timer() - start_time
+        passes.append({'batches_per_sec': i_batch / elapsed, 'images_per_sec': n_images / elapsed})
+    return passes
+
+
+def benchmark_compute(dataset, batch_size, prm):
+    ''' Batches/sec of the model forward + backward (without data loading) '''
+    model = get_model(prm)
+    model.train()
+    loss_criterion = get_loss_func(prm)
+    inputs, targets = next(iter(data_utils.DataLoader(dataset, batch_size=batch_size)))
+    inputs, targets = inputs.to(prm.device), targets.to(prm.device)
+
+    def run():
+        model.zero_grad()
+        loss_criterion(model(inputs), targets).backward()
+
+    stats = time_func(run, prm.device, n_warmup=2, n_repeat=10)
+    return 1e3 / stats['mean_ms']
+
+
+def run_data_pipeline_benchmark(base_prm, args):
+    results = {}
+    for data_source in args.data_sources:
+        for data_transform in args.data_transforms:
+            name = '{}/{}'.format(data_source, data_transform)
+            print('---- ' + name)
+            prm = deepcopy(base_prm)
+            prm.data_source, prm.data_transform = data_source, data_transform
+            prm.num_workers = 0
+            set_random_seed(prm.seed)
+            try:
+                task_generator = Task_Generator(prm)
+                data_loaders, task_stats = benchmark_task_creation(task_generator, prm, args.n_tasks)
+                dataset = data_loaders[0]['train'].dataset
+                dataset[0]  # check that the samples can be read (e.g. the transform fits the data)
+            except Exception as e:
+                # e.g. data set not on disk and cannot be downloaded, or the transform does not fit the data
+                print('Skipped: ' + repr(e))
+                results[name] = {'skipped': repr(e)}
+                continue
+            results[name] = {'task_creation': task_stats, 'loaders': {}, 'compute_batches_per_sec': {}}
+            for batch_size in args.batch_sizes:
+                compute_rate = benchmark_compute(dataset, batch_size, prm)
+                results[name]['compute_batches_per_sec'][str(batch_size)] = compute_rate
+                for num_workers in args.num_workers:
+                    for cached in [False, True]:
+                        curr_dataset = CachedDataset(dataset) if cached else dataset
+                        passes = benchmark_loader(curr_dataset, batch_size, num_workers, args.n_batches,
+                                                  args.n_passes, prm.device)
+                        data_rate = passes[-1]['batches_per_sec']
+                        config = 'batch_size={}/num_workers={}/cached={}'.format(batch_size, num_workers, cached)
+                        results[name]['loaders'][config] = {'passes': passes,
+                                                            'bound': 'data' if data_rate < compute_rate else 'compute'}
+                        print('{:<45} {}  | compute: {:.1f} batches/sec -> {}-bound'.format(
+                            config, ', '.join('pass {}: {:.1f} batches/sec, {:.0f} images/sec'.format(
+                                i_pass + 1, p['batches_per_sec'], p['images_per_sec'])
+                                for i_pass, p in enumerate(passes)),
+                            compute_rate, results[name]['loaders'][config]['bound']))
+    return results
+
+
+# -------------------------------------------------------------------------------------------
+#  Main script
+# -------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--data_sources', type=str, nargs='+', help='Data sources: ' + ' / '.join(DATA_SOURCES),
+                        default=DATA_SOURCES)
+
+    parser.add_argument('--data_transforms', type=str, nargs='+', help='Transforms: ' + ' / '.join(DATA_TRANSFORMS),
+                        default=DATA_TRANSFORMS)
+
+    parser.add_argument('--num_workers', type=int, nargs='+', help='Numbers of loader workers to test',
+                        default=[0, 2, 4])
+
+    parser.add_argument('--batch_sizes', type=int, nargs='+', help='Batch sizes to test',
+                        default=[32, 128])
+
+    parser.add_argument('--n_tasks', type=int, help='Number of tasks to create for the tasks/sec measurement',
+                        default=5)
+
+    parser.add_argument('--n_batches', type=int, help='Number of batches in each pass (0 = a full epoch)',
+                        default=50)
+
+    parser.add_argument('--n_passes', type=int, help='Number of passes over the batches',
+                        default=2)
+
+    parser.add_argument('--model-name', type=str, help='Model for the compute throughput',
+                        default='ConvNet3')
+
+    parser.add_argument('--output', type=str, help='Path of the output JSON file',
+                        default='saved/benchmarks/data_pipeline.json')
+
+    parser.add_argument('--gpu_index', type=int, help='The index of GPU device to run on',
+                        default=0)
+
+    args = parser.parse_args()
+
+    from Data_Path import get_data_path
+    # Omniglot \ SmallImageNet parameters (as in main_Meta_Bayes.py):
+    prm = get_default_prm(model_name=args.model_name, data_path=get_data_path(), N_Way=5, K_Shot_MetaTrain=100,
+                          K_Shot_MetaTest=100, chars_split_type='random', n_meta_train_chars=1200,
+                          n_meta_train_classes=500, n_pixels_shuffles=200)
+    if torch.cuda.is_available():
+        prm.device = torch.device('cuda:' + str(args.gpu_index))
+
+    results = {'machine': get_machine_info(prm.device), 'settings': vars(args),
+               'benchmarks': run_data_pipeline_benchmark(prm, args)}
+    save_results(results, args.output)
@@ -0,0 +1,330 @@
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import torch
+
+from Models.stochastic_layers import StochasticLinear, StochasticConv2d
+from Models import stochastic_models, deterministic_models
+from Utils.complexity_terms import get_net_densities_divergence
+from Utils.Bayes_utils import run_eval_Bayes, run_eval_Bayes_multi
+from Utils.Losses import get_loss_func
+from Utils.common import set_random_seed
+from Utils.mixed_precision import run_forward_loss
+from Utils.compiled import reset_compiled
+from Models.freeze import freeze_model, freeze_ensemble
+from PriorMetaLearning.Get_Objective_MPB import get_objective
+from Benchmarks.bench_utils import get_default_prm, get_synthetic_loaders, time_func, get_machine_info, \
+    save_results, load_results, compare_to_baseline
+
+# -------------------------------------------------------------------------------------------
+#  Micro-benchmarks of the main building blocks
+# -------------------------------------------------------------------------------------------
+# Run from the repository root:
+#   python -m Benchmarks.micro_benchmarks --output saved/benchmarks/results.json
+# and to compare a later version against it:
+#   python -m Benchmarks.micro_benchmarks --output saved/benchmarks/new.json --baseline saved/benchmarks/results.json
+#
+# All benchmarks use synthetic data (no download needed). Times are of forward + backward (if relevant), in ms.
+
+STOCHASTIC_MODELS = ['FcNet3', 'ConvNet3', 'OmConvNet', 'OmConvNet_NoBN', 'OmConvNet_NoBN_32', 'OmConvNet_NoBN_16',
+                     'OmConvNet_NoBN_elu']
+DETERMINISTIC_MODELS = ['FcNet3', 'ConvNet3', 'OmConvNet', 'OmConvNet_NoBN']
+DIVERGENCE_TYPES = ['KL', 'W_Sqr', 'W_NoSqr']
+TEST_TYPES = ['MaxPosterior', 'Expected', 'MajorityVote', 'AvgVote']
+
+# (in_dim, out_dim) of the linear layers and (in_channels, out_channels, kernel_size, image_size) of the conv layers:
+LINEAR_SHAPES = [(784, 400), (400, 400), (400, 10), (2304, 10)]
+CONV_SHAPES = [(1, 10, 5, 28), (10, 20, 5, 12), (1, 64, 3, 28), (64, 64, 3, 13)]
+N_MC_LIST = [1, 4]
+META_BATCH_SIZES = [1, 5, 16]
+
+SUITES = ['layers', 'models', 'objective', 'divergence', 'eval', 'compiled', 'frozen']
+COMPILED_MODELS = ['FcNet3', 'ConvNet3', 'OmConvNet_NoBN']
+FROZEN_MODELS = ['FcNet3', 'ConvNet3', 'OmConvNet']
+N_ENSEMBLE = 5
+
+
+def layer_forward_backward(layer, inputs, n_MC):
+    def run():
+        layer.zero_grad()
+        loss = 0
+        for i_MC in range(n_MC):
+            loss += layer(inputs).pow(2).mean()
+        loss.backward()
+    return run
+
+
+def benchmark_layers(prm, bench_args):
+    results = {}
+    for (in_dim, out_dim) in LINEAR_SHAPES:
+        layer = StochasticLinear(in_dim, out_dim, prm).to(prm.device)
+        inputs = torch.randn(prm.batch_size, in_dim, device=prm.device)
+        for n_MC in N_MC_LIST:
+            name = 'layers/StochasticLinear/{}x{}/n_MC={}'.format(in_dim, out_dim, n_MC)
+            results[name] = time_func(layer_forward_backward(layer, inputs, n_MC), prm.device, **bench_args)
+        layer.set_estimator('flipout')
+        name = 'layers/StochasticLinear/{}x{}/flipout'.format(in_dim, out_dim)
+        results[name] = time_func(layer_forward_backward(layer, inputs, 1), prm.device, **bench_args)
+    for (in_channels, out_channels, kernel_size, image_size) in CONV_SHAPES:
+        layer = StochasticConv2d(in_channels, out_channels, kernel_size, prm).to(prm.device)
+        inputs = torch.randn(prm.batch_size, in_channels, image_size, image_size, device=prm.device)
+        for n_MC in N_MC_LIST:
+            name = 'layers/StochasticConv2d/{}x{}x{}x{}/n_MC={}'.format(in_channels, out_channels, kernel_size,
+                                                                          image_size, n_MC)
+            results[name] = time_func(layer_forward_backward(layer, inputs, n_MC), prm.device, **bench_args)
+        layer.set_estimator('flipout')
+        name = 'layers/StochasticConv2d/{}x{}x{}x{}/flipout'.format(in_channels, out_channels, kernel_size,
+                                                                      image_size)
+        results[name] = time_func(layer_forward_backward(layer, inputs, 1), prm.device, **bench_args)
+    return results
+
+
+def benchmark_models(prm, bench_args):
+    results = {}
+    loss_criterion = get_loss_func(prm)
+    inputs = None
+    for model_type, models_module, model_names in [('Stochastic', stochastic_models, STOCHASTIC_MODELS),
+                                                   ('Standard', deterministic_models, DETERMINISTIC_MODELS)]:
+        for model_name in model_names:
+            prm.model_name = model_name
+            model = models_module.get_model(prm)
+            model.train()
+            if inputs is None:
+                batch = next(iter(get_synthetic_loaders(prm, 1)[0]['train']))
+                inputs, targets = batch[0].to(prm.device), batch[1].to(prm.device)
+
+            def run():
+                model.zero_grad()
+                loss_criterion(model(inputs), targets).backward()
+
+            name = 'models/{}/{}'.format(model_type, model_name)
+            results[name] = time_func(run, prm.device, **bench_args)
+    return results
+
+
+def benchmark_objective(prm, bench_args):
+    results = {}
+    loss_criterion = get_loss_func(prm)
+    prior_model = stochastic_models.get_model(prm)
+    for meta_batch_size in META_BATCH_SIZES:
+        data_loaders = get_synthetic_loaders(prm, meta_batch_size)
+        iterators = [iter(data_loader['train']) for data_loader in data_loaders]
+        posteriors_models = [stochastic_models.get_model(prm) for _ in range(meta_batch_size)]
+
+        def run():
+            prior_model.zero_grad()
+            for post_model in posteriors_models:
+                post_model.zero_grad()
+            total_objective, info = get_objective(prior_model, prm, data_loaders, iterators, posteriors_models,
+                                                  loss_criterion, prm.n_train_tasks)
+            if torch.is_tensor(total_objective) and total_objective.requires_grad:
+                total_objective.backward()
+
+        name = 'objective/{}/{}/meta_batch_size={}'.format(prm.model_name, prm.complexity_type, meta_batch_size)
+        results[name] = time_func(run, prm.device, **bench_args)
+    return results
+
+
+def benchmark_divergence(prm, bench_args):
+    results = {}
+    divergence_type = prm.divergence_type
+    prior_model = stochastic_models.get_model(prm)
+    post_model = stochastic_models.get_model(prm)
+    for dvrg_type in DIVERGENCE_TYPES:
+        prm.divergence_type = dvrg_type
+        for noised_prior in [False, True]:
+            def run():
+                prior_model.zero_grad()
+                post_model.zero_grad()
+                get_net_densities_divergence(prior_model, post_model, prm, noised_prior).backward()
+
+            name = 'divergence/{}/{}/noised_prior={}'.format(prm.model_name, prm.divergence_type, noised_prior)
+            results[name] = time_func(run, prm.device, **bench_args)
+    prm.divergence_type = divergence_type
+    return results
+
+
+def benchmark_eval(prm, bench_args):
+    results = {}
+    test_type = prm.test_type
+    model = stochastic_models.get_model(prm)
+    test_loader = get_synthetic_loaders(prm, 1, meta_split='meta_test')[0]['test']
+    for test_type_curr in TEST_TYPES:
+        prm.test_type = test_type_curr
+        name = 'eval/{}/{}/n_samples={}'.format(prm.model_name, prm.test_type, len(test_loader.dataset))
+        results[name] = time_func(lambda: run_eval_Bayes(model, test_loader, prm), prm.device, **bench_args)
+    prm.test_type = test_type
+    # all the test types in one pass (shared forward draws):
+    name = 'eval/{}/all_single_pass/n_samples={}'.format(prm.model_name, len(test_loader.dataset))
+    results[name] = time_func(lambda: run_eval_Bayes_multi(model, test_loader, prm, TEST_TYPES), prm.device,
+                              **bench_args)
+    # the draws with pre-sampled weights (plain forward, see --eval_weight_sampling):
+    prm.eval_weight_sampling = True
+    name = 'eval/{}/all_single_pass_weight_sampling/n_samples={}'.format(prm.model_name, len(test_loader.dataset))
+    results[name] = time_func(lambda: run_eval_Bayes_multi(model, test_loader, prm, TEST_TYPES), prm.device,
+                              **bench_args)
+    prm.eval_weight_sampling = False
+    return results
+
+
+def benchmark_compiled(prm, bench_args):
+    ''' Eager vs. compiled (--compile_forward, see Utils/compiled.py) forward + backward of the stochastic models,
+     and of the meta-objective (the compilation is in the warm-up calls) '''
+    results = {}
+    loss_criterion = get_loss_func(prm)
+    batch = next(iter(get_synthetic_loaders(prm, 1)[0]['train']))
+    inputs, targets = batch[0].to(prm.device), batch[1].to(prm.device)
+    for model_name in COMPILED_MODELS:
+        prm.model_name = model_name
+        model = stochastic_models.get_model(prm)
+        model.train()
+        for compile_forward in [False, True]:
+            prm.compile_forward = compile_forward
+
+            def run():
+                model.zero_grad()
+                run_forward_loss(model, inputs, targets, loss_criterion, prm)[1].backward()
+
+            name = 'compiled/models/{}/{}'.format(model_name, 'compiled' if compile_forward else 'eager')
+            results[name] = time_func(run, prm.device, **bench_args)
+
+    prm.model_name = 'ConvNet3'
+    meta_batch_size = 5
+    prior_model = stochastic_models.get_model(prm)
+    data_loaders = get_synthetic_loaders(prm, meta_batch_size)
+    iterators = [iter(data_loader['train']) for data_loader in data_loaders]
+    posteriors_models = [stochastic_models.get_model(prm) for _ in range(meta_batch_size)]
+    for compile_forward in [False, True]:
+        prm.compile_forward = compile_forward
+
+        def run():
+            prior_model.zero_grad()
+            for post_model in posteriors_models:
+                post_model.zero_grad()
+            total_objective, info = get_objective(prior_model, prm, data_loaders, iterators, posteriors_models,
+                                                  loss_criterion, prm.n_train_tasks)
+            total_objective.backward()
+
+        name = 'compiled/objective/{}/meta_batch_size={}/{}'.format(prm.model_name, meta_batch_size,
+                                                                     'compiled' if compile_forward else 'eager')
+        results[name] = time_func(run, prm.device, **bench_args)
+    prm.compile_forward = False
+    reset_compiled()
+
+    # the speedups of the compiled versions:
+    for name in results:
+        if name.endswith('/compiled'):
+            eager_name = name[:-len('compiled')] + 'eager'
+            results[name]['speedup_vs_eager'] = results[eager_name]['mean_ms'] / results[name]['mean_ms']
+    return results
+
+
+def benchmark_frozen(prm, bench_args):
+    ''' Inference (forward without grad) of the stochastic models vs. the frozen deterministic modules
+     (see Models/freeze.py): the posterior means, traced to TorchScript, and an ensemble of sampled networks vs.
+     the same number of draws of the stochastic model '''
+    results = {}
+    inputs = next(iter(get_synthetic_loaders(prm, 1, meta_split='meta_test')[0]['test']))[0].to(prm.device)
+    for model_name in FROZEN_MODELS:
+        prm.model_name = model_name
+        model = stochastic_models.get_model(prm)
+        model.eval()
+        frozen_model = freeze_model(model, prm)
+        ensemble = freeze_ensemble(model, prm, N_ENSEMBLE)
+        with torch.no_grad():
+            traced_model = torch.jit.trace(frozen_model, inputs)
+
+        def run_max_posterior():
+            old_eps_std = model.set_eps_std(0.0)
+            model(inputs)
+            model.set_eps_std(old_eps_std)
+
+        def run_draws():
+            for i_draw in range(N_ENSEMBLE):
+                model(inputs)
+
+        for name, run in [('stochastic_max_posterior', run_max_posterior), ('frozen', lambda: frozen_model(inputs)),
+                          ('frozen_torchscript', lambda: traced_model(inputs)),
+                          ('stochastic_draws={}'.format(N_ENSEMBLE), run_draws),
+                          ('frozen_ensemble={}'.format(N_ENSEMBLE), lambda: ensemble(inputs))]:
+            with torch.no_grad():
+                results['frozen/{}/{}'.format(model_name, name)] = time_func(run, prm.device, **bench_args)
+    return results
+
+
+def run_benchmarks(prm, suites=SUITES, n_warmup=3, n_repeat=20):
+    ''' Runs the benchmark suites, and returns the results (a dict which can be saved as JSON) '''
+    suites_funcs = {'layers': benchmark_layers, 'models': benchmark_models, 'objective': benchmark_objective,
+                    'divergence': benchmark_divergence, 'eval': benchmark_eval, 'compiled': benchmark_compiled,
+                    'frozen': benchmark_frozen}
+    bench_args = {'n_warmup': n_warmup, 'n_repeat': n_repeat}
+    model_name = prm.model_name
+    benchmarks = {}
+    for suite in suites:
+        print('---- Running benchmark suite: ' + suite)
+        set_random_seed(prm.seed)
+        suite_results = suites_funcs[suite](prm, bench_args)
+        prm.model_name = model_name
+        for name, stats in sorted(suite_results.items()):
+            print('{:<60} {:>10.3f} ms (+- {:.3f})'.format(name, stats['mean_ms'], stats['std_ms']) +
+                  (' speedup: {:.2f}'.format(stats['speedup_vs_eager']) if 'speedup_vs_eager' in stats else ''))
+        benchmarks.update(suite_results)
+    settings = {'model_name': prm.model_name, 'batch_size': prm.batch_size, 'test_batch_size': prm.test_batch_size,
+                'n_MC': prm.n_MC, 'n_MC_eval': prm.n_MC_eval, 'complexity_type': prm.complexity_type,
+                'divergence_type': prm.divergence_type, 'n_warmup': n_warmup, 'n_repeat': n_repeat}
+    return {'machine': get_machine_info(prm.device), 'settings': settings, 'benchmarks': benchmarks}
+
+
+# -------------------------------------------------------------------------------------------
+#  Main script
+# -------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--suites', type=str, nargs='+', help='Benchmark suites to run: ' + ' / '.join(SUITES),
+                        default=SUITES)
+
+    parser.add_argument('--output', type=str, help='Path of the output JSON file',
+                        default='saved/benchmarks/micro_benchmarks.json')
+
+    parser.add_argument('--baseline', type=str, help='Path of a stored results file to compare to (empty = none)',
+                        default='')
+
+    parser.add_argument('--regression_threshold', type=float,
+                        help='Relative slow-down (vs. the baseline) which is reported as a regression',
+                        default=0.1)
+
+    parser.add_argument('--n_warmup', type=int, help='Number of untimed calls before timing',
+                        default=3)
+
+    parser.add_argument('--n_repeat', type=int, help='Number of timed calls',
+                        default=20)
+
+    parser.add_argument('--model-name', type=str, help='Model for the objective, divergence and eval benchmarks',
+                        default='ConvNet3')
+
+    parser.add_argument('--batch-size', type=int, help='input batch size for training',
+                        default=128)
+
+    parser.add_argument('--complexity_type', type=str, help='The learning objective complexity type',
+                        default='Seeger')
+
+    parser.add_argument('--gpu_index', type=int, help='The index of GPU device to run on',
+                        default=0)
+
+    args = parser.parse_args()
+
+    prm = get_default_prm(model_name=args.model_name, batch_size=args.batch_size,
+                          complexity_type=args.complexity_type)
+    if torch.cuda.is_available():
+        prm.device = torch.device('cuda:' + str(args.gpu_index))
+
+    results = run_benchmarks(prm, args.suites, args.n_warmup, args.n_repeat)
+    save_results(results, args.output)
+
+    if args.baseline:
+        lines, regressions = compare_to_baseline(results, load_results(args.baseline), args.regression_threshold)
+        print('\n'.join(lines))
+        print('{} regressions (more than {:.0%} slower than the baseline)'.format(len(regressions),
+                                                                                   args.regression_threshold))
@@ -0,0 +1,135 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import argparse
+import torch
+
+from Models.stochastic_models import get_model
+from Utils import data_gen
+from Utils.Bayes_utils import compare_noise_types, NOISE_TYPES
+from Utils.adaptive_MC import get_gradient_stats
+from Utils.Losses import get_loss_func
+from Utils.common import create_result_dir, set_random_seed, write_to_log, load_model_state
+from Benchmarks.bench_utils import get_default_prm, get_synthetic_loaders, get_machine_info, save_results, \
+    time_func
+
+# -------------------------------------------------------------------------------------------
+#  Variance of the Monte-Carlo evaluation with different noise types
+# -------------------------------------------------------------------------------------------
+# Repeats the Monte-Carlo estimate of the expected test loss and error of a posterior (test_type='Expected') with
+# iid, antithetic and quasi-Monte-Carlo noise of the re-parametrization trick (see StochasticLayer.draw_noise),
+# and reports the variance of the estimates and the number of iid samples (n_MC_eval) with the same variance.
+# It also compares the gradient estimators of the stochastic layers (local re-parametrization and Flipout): the
+# time of a training forward + backward and the variance of the single-sample gradient on a training batch.
+#
+# Run from the repository root, e.g.:
+#   python -m Benchmarks.noise_variance --n_MC_eval 2 4 8 16
+# The posterior is a randomly initialized model (with log-variance --log_var_init), or a saved model of the same
+# architecture (--load_model_path, e.g. a meta-learned prior).
+
+
+def run_noise_variance_benchmark(model, loader, prm, n_MC_list, n_repeats):
+    results = {}
+    for n_MC in n_MC_list:
+        results[n_MC] = compare_noise_types(model, loader, prm, n_MC=n_MC, n_repeats=n_repeats)
+        for noise_type, res in results[n_MC].items():
+            write_to_log('n_MC_eval={}, {}: loss {:.4} (var {:.3}), error {:.3}% (var {:.3}), variance reduction '
+                         '{:.3} (loss) {:.3} (error), equivalent iid n_MC_eval: {:.1f}'.format(
+                          n_MC, noise_type, res['loss_mean'], res['loss_var'], 100 * res['error_mean'],
+                          res['error_var'], res['loss_var_reduction'], res['error_var_reduction'],
+                          res['equivalent_iid_n_MC']), prm)
+    return results
+
+
+ESTIMATORS = ['local_reparam', 'flipout']
+
+
+def compare_estimators(model, inputs, targets, prm, n_samples, bench_args):
+    ''' Time [ms] of a forward + backward and the single-sample gradient statistics of each gradient estimator '''
+    loss_criterion = get_loss_func(prm)
+    old_estimator = model.set_estimator(ESTIMATORS[0])
+    model.train()
+    results = {}
+    for estimator in ESTIMATORS:
+        model.set_estimator(estimator)
+
+        def forward_backward():
+            model.zero_grad()
+            loss_criterion(model(inputs), targets).backward()
+
+        layers_stats, total_signal, total_var = get_gradient_stats(model, inputs, targets, loss_criterion, n_samples)
+        results[estimator] = {'time': time_func(forward_backward, prm.device, **bench_args), 'grad_var': total_var,
+                              'grad_sqr_norm': total_signal, 'snr_1': total_signal / max(total_var, 1e-30),
+                              'layers': layers_stats}
+        write_to_log('{}: forward + backward {:.3} [ms], gradient variance {:.4}, single-sample SNR {:.4}'.format(
+            estimator, results[estimator]['time']['mean_ms'], total_var, results[estimator]['snr_1']), prm)
+    model.set_estimator(old_estimator)
+    return results
+
+
+# -------------------------------------------------------------------------------------------
+#  Main script
+# -------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--run-name', type=str, help='Name of dir to save results in (if empty, name by time)',
+                        default='noise_variance')
+
+    parser.add_argument('--seed', type=int, help='random seed',
+                        default=1)
+
+    parser.add_argument('--model-name', type=str, help="Define model type (hypothesis class)'",
+                        default='ConvNet3')
+
+    parser.add_argument('--load_model_path', type=str, help='Path of a saved stochastic model (if empty, a random one)',
+                        default='')
+
+    parser.add_argument('--log_var_init', type=float, help='Log-variance of the weights of the random model',
+                        default=-4.)
+
+    parser.add_argument('--n_test_samples', type=int, help='Number of (synthetic) test samples',
+                        default=1000)
+
+    parser.add_argument('--n_MC_eval', type=int, nargs='+', help='Numbers of Monte-Carlo samples to compare',
+                        default=[2, 4, 8, 16])
+
+    parser.add_argument('--n_repeats', type=int, help='Number of repeated estimates for the variance',
+                        default=30)
+
+    parser.add_argument('--batch-size', type=int, help='Training batch size for the comparison of the estimators',
+                        default=128)
+
+    parser.add_argument('--grad_samples', type=int,
+                        help='Number of gradient samples for the comparison of the estimators (0 = no comparison)',
+                        default=20)
+
+    parser.add_argument('--gpu_index', type=int, help='The index of GPU device to run on',
+                        default=0)
+
+    args = parser.parse_args()
+
+    prm = get_default_prm(run_name=args.run_name, seed=args.seed, model_name=args.model_name,
+                          log_var_init={'mean': args.log_var_init, 'std': 0.1},
+                          batch_size=args.batch_size, synthetic_n_train_samples=args.batch_size,
+                          synthetic_n_test_samples=args.n_test_samples)
+    if torch.cuda.is_available():
+        prm.device = torch.device('cuda:' + str(args.gpu_index))
+    create_result_dir(prm)
+    set_random_seed(prm.seed)
+
+    model = get_model(prm)
+    if args.load_model_path:
+        load_model_state(model, args.load_model_path)
+    task_data = get_synthetic_loaders(prm, 1, meta_split='meta_test')[0]
+
+    results = run_noise_variance_benchmark(model, task_data['test'], prm, args.n_MC_eval, args.n_repeats)
+    estimators_results = None
+    if args.grad_samples:
+        inputs, targets = data_gen.get_batch_vars(next(iter(task_data['train'])), prm)
+        estimators_results = compare_estimators(model, inputs, targets, prm, args.grad_samples,
+                                                {'n_warmup': 3, 'n_repeat': 20})
+    save_results({'settings': vars(args), 'machine': get_machine_info(prm.device), 'noise_types': NOISE_TYPES,
+                  'results': results, 'estimators': estimators_results},
+                 os.path.join(prm.result_dir, 'noise_variance.json'))
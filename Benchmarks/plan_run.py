@@ -0,0 +1,223 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import argparse
+import timeit
+from copy import deepcopy
+import torch
+
+from Utils.data_gen import get_info
+from Utils.common import create_result_dir, set_random_seed, write_to_log
+from Utils.cost_model import estimate_costs, get_method, get_n_samples_per_task, predict_wall_time, costs_report
+from PriorMetaLearning import meta_train_Bayes_finite_tasks, meta_test_Bayes
+from MAML import meta_train_MAML_finite_tasks, meta_test_MAML
+from Benchmarks.bench_utils import get_default_prm, get_synthetic_loaders, sync_device, get_machine_info, save_results
+
+# -------------------------------------------------------------------------------------------
+#  Planning a run: estimated memory, FLOPs and wall time
+# -------------------------------------------------------------------------------------------
+# Estimates the costs of a run with the analytic cost model (Utils/cost_model.py), and predicts its wall time
+# from a short calibration run on this machine: a few meta-training steps and meta-test steps of the same
+# configuration (model, batch size, n_MC, meta-batch size, number of posteriors), on synthetic data of the same
+# input shape and number of classes (so the data set is not needed).
+#
+# Run from the repository root, e.g.:
+#   python -m Benchmarks.plan_run --data-source Omniglot --model-name OmConvNet --N_Way 5 --K_Shot_MetaTrain 5 \
+#       --n_train_tasks 200 --n_meta_train_epochs 300
+
+
+class StepTimer(object):
+    ''' A step_callback of the meta-training functions, which stops after n_warmup + n_steps meta-steps,
+     and measures the mean time of the last n_steps '''
+
+    def __init__(self, device, n_warmup, n_steps):
+        self.device, self.n_warmup, self.n_steps = device, n_warmup, n_steps
+        self.start_time = None
+        self.step_time = None
+
+    def __call__(self, i_step, model, info):
+        sync_device(self.device)
+        if i_step == self.n_warmup:
+            self.start_time = timeit.default_timer()
+        elif i_step == self.n_warmup + self.n_steps:
+            self.step_time = (timeit.default_timer() - self.start_time) / self.n_steps
+            return True
+        return False
+
+
+def get_calibration_prm(prm, n_train_samples, n_test_samples):
+    ''' The run parameters, with synthetic data of the same input shape and number of classes '''
+    info = get_info(prm)
+    calib_prm = deepcopy(prm)
+    calib_prm.data_source = 'Synthetic'
+    calib_prm.data_transform = 'None'
+    calib_prm.synthetic_input_shape = info['input_shape']
+    calib_prm.synthetic_n_classes = info['n_classes']
+    calib_prm.synthetic_n_train_samples = n_train_samples
+    calib_prm.synthetic_n_test_samples = n_test_samples
+    return calib_prm
+
+
+def calibrate(prm, n_warmup=2, n_steps=10):
+    ''' Measures the time [sec] of a meta-training step and of a meta-test step with the run's configuration
+     (and on GPU - the peak memory of the meta-training) '''
+    method = get_method(prm)
+    calibration = {}
+    set_random_seed(prm.seed)
+
+    # Meta-training steps (all the posteriors are created, with up to one batch of data per task for each step,
+    # so the per-epoch overheads are amortized as in the run):
+    n_train_samples, _ = get_n_samples_per_task(prm, 'meta_train')
+    calib_prm = get_calibration_prm(prm, min(n_train_samples, prm.batch_size * (n_warmup + n_steps)),
+                                    min(prm.test_batch_size, 100))
+    n_tasks = prm.n_train_tasks if prm.n_train_tasks else prm.meta_batch_size
+    train_data_loaders = get_synthetic_loaders(calib_prm, n_tasks)
+    timer = StepTimer(prm.device, n_warmup, n_steps)
+    if prm.device.type == 'cuda':
+        torch.cuda.empty_cache()
+        if hasattr(torch.cuda, 'reset_max_memory_allocated'):
+            torch.cuda.reset_max_memory_allocated(prm.device)
+    if method == 'MPB':
+        calib_prm.n_meta_train_epochs = n_warmup + n_steps
+        model = meta_train_Bayes_finite_tasks.run_meta_learning(train_data_loaders, calib_prm, step_callback=timer)
+    else:
+        calib_prm.n_meta_train_iterations = (n_warmup + n_steps) * len(train_data_loaders)
+        model = meta_train_MAML_finite_tasks.run_meta_learning(train_data_loaders, calib_prm, step_callback=timer)
+    calibration['meta_train'] = {'step_time': timer.step_time}
+    if prm.device.type == 'cuda':
+        calibration['meta_train']['max_memory_allocated'] = torch.cuda.max_memory_allocated(prm.device)
+    del train_data_loaders
+
+    # Meta-test steps (learning a new task from the meta-learned model):
+    n_test_task_samples, _ = get_n_samples_per_task(prm, 'meta_test')
+    n_batches = int(min(n_test_task_samples, prm.batch_size * (n_warmup + n_steps)) // prm.batch_size) or 1
+    calib_prm = get_calibration_prm(prm, min(n_test_task_samples, prm.batch_size * n_batches),
+                                    min(prm.test_batch_size, 100))
+    task_data = get_synthetic_loaders(calib_prm, 1, meta_split='meta_test')[0]
+    start_time = timeit.default_timer()
+    if method == 'MPB':
+        calib_prm.n_meta_test_epochs = 1
+        meta_test_Bayes.run_learning(task_data, model, calib_prm, verbose=0)
+    else:
+        n_batches = calib_prm.n_meta_test_grad_steps = n_warmup + n_steps
+        meta_test_MAML.run_learning(task_data, model, calib_prm, verbose=0)
+    sync_device(prm.device)
+    # note: includes the evaluation of the (small) test set
+    calibration['meta_test'] = {'step_time': (timeit.default_timer() - start_time) / n_batches}
+    return calibration
+
+
+def plan_run(prm, calibration_steps=10):
+    ''' Returns the estimated costs, and if calibration_steps > 0 - the calibration and the predicted times '''
+    plan = {'costs': estimate_costs(prm)}
+    if calibration_steps:
+        plan['calibration'] = calibrate(prm, n_steps=calibration_steps)
+        plan['prediction'] = predict_wall_time(plan['costs'], plan['calibration'])
+    return plan
+
+
+# -------------------------------------------------------------------------------------------
+#  Main script
+# -------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--run-name', type=str, help='Name of dir to save results in (if empty, name by time)',
+                        default='')
+
+    parser.add_argument('--method', type=str, help="Meta-learning method: 'MPB' / 'MAML'",
+                        default='MPB')
+
+    parser.add_argument('--calibration_steps', type=int,
+                        help='Number of timed steps in the calibration run (0 = only the analytic estimates)',
+                        default=10)
+
+    # ----- The planned run parameters (as in main_Meta_Bayes.py / main_MAML.py) -----#
+
+    parser.add_argument('--data-source', type=str, help="Data: 'MNIST' / 'CIFAR10' / Omniglot / SmallImageNet / Synthetic",
+                        default='MNIST')
+
+    parser.add_argument('--n_train_tasks', type=int, help='Number of meta-training tasks (0 = infinite)',
+                        default=5)
+
+    parser.add_argument('--n_test_tasks', type=int, help='Number of meta-test tasks',
+                        default=10)
+
+    parser.add_argument('--limit_train_samples_in_test_tasks', type=int,
+                        help='Upper limit for the number of training samples in the meta-test tasks (0 = unlimited)',
+                        default=0)
+
+    parser.add_argument('--N_Way', type=int, help='Number of classes in a task (for Omniglot)',
+                        default=5)
+
+    parser.add_argument('--K_Shot_MetaTrain', type=int, help='Number of training sample per class in meta-training',
+                        default=100)
+
+    parser.add_argument('--K_Shot_MetaTest', type=int, help='Number of training sample per class in meta-testing',
+                        default=100)
+
+    parser.add_argument('--model-name', type=str, help="Define model type (hypothesis class)'",
+                        default='ConvNet3')
+
+    parser.add_argument('--batch-size', type=int, help='input batch size for training',
+                        default=128)
+
+    parser.add_argument('--n_MC', type=int, help='MPB: number of Monte-Carlo iterations',
+                        default=1)
+
+    parser.add_argument('--meta_batch_size', type=int, help='Maximal number of tasks in each meta-batch',
+                        default=5)
+
+    parser.add_argument('--complexity_type', type=str, help='MPB: the learning objective complexity type',
+                        default='Seeger')
+
+    parser.add_argument('--streamed_backward', type=str, help="MPB: 'None' / 'Task' / 'MC'",
+                        default='None')
+
+    parser.add_argument('--posterior_steps_per_prior_step', type=int, help='MPB: posterior steps per prior step',
+                        default=1)
+
+    parser.add_argument('--n_meta_train_epochs', type=int, help='MPB: number of meta-training epochs',
+                        default=150)
+
+    parser.add_argument('--n_inner_steps', type=int, help='MPB, infinite tasks: steps per meta-batch of tasks',
+                        default=50)
+
+    parser.add_argument('--n_meta_test_epochs', type=int, help='MPB: number of meta-test epochs',
+                        default=200)
+
+    parser.add_argument('--n_meta_train_grad_steps', type=int, help='MAML: number of inner gradient steps',
+                        default=1)
+
+    parser.add_argument('--n_meta_train_iterations', type=int, help='MAML: number of meta-training iterations',
+                        default=300)
+
+    parser.add_argument('--n_meta_test_grad_steps', type=int, help='MAML: number of gradient steps in meta-testing',
+                        default=3)
+
+    parser.add_argument('--alpha', type=float, help='MAML: step size for gradient step',
+                        default=0.01)
+
+    parser.add_argument('--gpu_index', type=int, help='The index of GPU device to run on',
+                        default=0)
+
+    args = parser.parse_args()
+
+    prm = get_default_prm(**{name: value for name, value in vars(args).items()
+                             if name not in ['calibration_steps', 'gpu_index']})
+    prm.MAML_Use_Test_Data = False
+    if torch.cuda.is_available():
+        prm.device = torch.device('cuda:' + str(args.gpu_index))
+    create_result_dir(prm)
+
+    plan = plan_run(prm, args.calibration_steps)
+    write_to_log('---- Run plan:', prm)
+    write_to_log(costs_report(plan['costs'], plan.get('prediction')), prm)
+    if 'max_memory_allocated' in plan.get('calibration', {}).get('meta_train', {}):
+        write_to_log('Measured peak memory in the calibration: {:.1f} [MB] (estimated: {:.1f} [MB])'.format(
+            1e-6 * plan['calibration']['meta_train']['max_memory_allocated'],
+            1e-6 * plan['costs']['meta_train']['peak_bytes']), prm)
+    plan['machine'] = get_machine_info(prm.device)
+    plan['settings'] = vars(args)
+    save_results(plan, os.path.join(prm.result_dir, 'run_plan.json'))
@@ -0,0 +1,195 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import argparse
+import timeit
+from copy import deepcopy
+import torch
+
+from Models import stochastic_models, deterministic_models
+from Utils.data_gen import Task_Generator, get_batch_vars, get_info
+from Utils.common import create_result_dir, set_random_seed, write_to_log
+from Utils.Losses import get_loss_func
+from Utils.mixed_precision import run_forward
+from PriorMetaLearning import meta_train_Bayes_finite_tasks
+from MAML import meta_train_MAML_finite_tasks
+from Benchmarks.bench_utils import get_default_prm, get_synthetic_loaders, get_machine_info, save_results
+from Benchmarks.time_to_accuracy import get_method_prm, run_meta_test
+
+# -------------------------------------------------------------------------------------------
+#  Accuracy parity of bf16 mixed precision
+# -------------------------------------------------------------------------------------------
+# Checks that the bf16 mixed precision mode (--mixed_precision bf16, see Utils/mixed_precision.py) gives the same
+# accuracy as fp32:
+#  * forward parity - the relative difference of the outputs and of the loss of each model on the same batch
+#    (the stochastic models with the mean weights).
+#  * training parity - MPB and MAML are trained with the same seed on the same fixed tasks in fp32 and in bf16,
+#    and the meta-test errors are compared (with the training times). The comparison is meaningful only if the
+#    methods learn, so the check also fails if the fp32 error is near chance (MPB uses a semi-stochastic model,
+#    see --stochastic_layers).
+# Exits with status 1 if a difference is above its tolerance, e.g.:
+#   python -m Benchmarks.precision_parity --n_epochs 20 --err_tolerance 0.02
+
+METHODS = ['MPB', 'MAML']
+MODELS = ['FcNet3', 'ConvNet3', 'OmConvNet_NoBN']
+
+
+def forward_parity(prm, model_names):
+    ''' The relative difference between the bf16 and fp32 outputs and loss of each model on a synthetic batch '''
+    results = {}
+    loss_criterion = get_loss_func(prm)
+    for model_type, models_module in [('Stochastic', stochastic_models), ('Standard', deterministic_models)]:
+        for model_name in model_names:
+            model_prm = deepcopy(prm)
+            model_prm.model_name = model_name
+            set_random_seed(prm.seed)
+            model = models_module.get_model(model_prm)
+            model.eval()
+            if model_type == 'Stochastic':
+                model.set_eps_std(0.0)
+            inputs, targets = get_batch_vars(next(iter(get_synthetic_loaders(model_prm, 1)[0]['train'])), prm)
+            outputs = {}
+            with torch.no_grad():
+                for precision in ['fp32', 'bf16']:
+                    model_prm.mixed_precision = precision
+                    outputs[precision] = run_forward(model, inputs, model_prm)
+            loss = {precision: loss_criterion(out, targets).item() for precision, out in outputs.items()}
+            results['{}/{}'.format(model_type, model_name)] = {
+                'outputs_rel_diff': ((outputs['bf16'] - outputs['fp32']).norm() / outputs['fp32'].norm()).item(),
+                'loss_rel_diff': abs(loss['bf16'] - loss['fp32']) / max(abs(loss['fp32']), 1e-12)}
+    return results
+
+
+def training_parity(method, train_data_loaders, test_tasks_data, base_prm, args):
+    ''' Meta-test errors and training times of the method in fp32 and bf16 (with the same seed and tasks) '''
+    results = {}
+    for precision in ['fp32', 'bf16']:
+        prm = get_method_prm(base_prm, method, args)
+        prm.mixed_precision = precision
+        if method == 'MPB':
+            prm.stochastic_layers = args.stochastic_layers
+        set_random_seed(prm.seed)
+        start_time = timeit.default_timer()
+        if method == 'MPB':
+            model = meta_train_Bayes_finite_tasks.run_meta_learning(train_data_loaders, prm)
+        else:
+            model = meta_train_MAML_finite_tasks.run_meta_learning(train_data_loaders, prm)
+        train_time = timeit.default_timer() - start_time
+        set_random_seed(prm.seed)
+        results[precision] = {'test_err': float(run_meta_test(method, model, test_tasks_data, prm)),
+                              'train_time_sec': train_time}
+    results['err_diff'] = abs(results['bf16']['test_err'] - results['fp32']['test_err'])
+    results['speedup'] = results['fp32']['train_time_sec'] / max(results['bf16']['train_time_sec'], 1e-12)
+    return results
+
+
+# -------------------------------------------------------------------------------------------
+#  Main script
+# -------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--run-name', type=str, help='Name of dir to save results in (if empty, name by time)',
+                        default='precision_parity')
+
+    parser.add_argument('--seed', type=int, help='random seed',
+                        default=1)
+
+    parser.add_argument('--methods', type=str, nargs='+', help='Methods to compare: ' + ' / '.join(METHODS),
+                        default=METHODS)
+
+    parser.add_argument('--models', type=str, nargs='+', help='Models for the forward parity',
+                        default=MODELS)
+
+    parser.add_argument('--model-name', type=str, help='The model of the training parity',
+                        default='FcNet3')  # on the synthetic tasks, ConvNet3 stays near chance in short runs
+
+    parser.add_argument('--n_train_tasks', type=int, help='Number of meta-training tasks',
+                        default=5)
+
+    parser.add_argument('--n_test_tasks', type=int, help='Number of meta-test tasks',
+                        default=5)
+
+    parser.add_argument('--data-transform', type=str, help="Data transformation of the synthetic tasks",
+                        default='Permute_Labels')
+
+    parser.add_argument('--n_test_samples', type=int,
+                        help='Number of test samples in each synthetic task (the meta-test error is compared with '
+                             'err_tolerance, so its standard error should be well below it)',
+                        default=1000)
+
+    parser.add_argument('--n_epochs', type=int, help='MPB: meta-training epochs (MAML: in meta-batches of tasks)',
+                        default=20)
+
+    parser.add_argument('--n_meta_test_epochs', type=int, help='MPB: epochs of meta-test learning',
+                        default=10)
+
+    parser.add_argument('--stochastic_layers', type=str, nargs='+',
+                        help='MPB: the stochastic layers of the training parity (see main_Meta_Bayes.py), on the '
+                             'synthetic tasks the complexity term of a fully stochastic FcNet3 keeps the error at '
+                             'chance in short runs',
+                        default=['1'])
+
+    parser.add_argument('--alpha', type=float, help='MAML: step size for the inner gradient step',
+                        default=0.4)
+
+    parser.add_argument('--n_meta_test_grad_steps', type=int, help='MAML: gradient steps in meta-testing',
+                        default=3)
+
+    parser.add_argument('--output_tolerance', type=float,
+                        help='Tolerance of the relative difference of the outputs / loss in the forward parity',
+                        default=0.05)
+
+    parser.add_argument('--err_tolerance', type=float, help='Tolerance of the meta-test error difference',
+                        default=0.02)
+
+    parser.add_argument('--chance_margin', type=float,
+                        help='The fp32 meta-test error must be below the chance error by at least this margin',
+                        default=0.2)
+
+    parser.add_argument('--gpu_index', type=int, help='The index of GPU device to run on',
+                        default=0)
+
+    args = parser.parse_args()
+    args.max_epochs = args.n_epochs
+
+    prm = get_default_prm(run_name=args.run_name, seed=args.seed, model_name=args.model_name,
+                          data_transform=args.data_transform, n_train_tasks=args.n_train_tasks,
+                          synthetic_n_test_samples=args.n_test_samples)
+    if torch.cuda.is_available():
+        prm.device = torch.device('cuda:' + str(args.gpu_index))
+    create_result_dir(prm)
+
+    results = {'settings': vars(args), 'machine': get_machine_info(prm.device)}
+    passed = True
+
+    results['forward'] = forward_parity(prm, args.models)
+    for name, res in results['forward'].items():
+        ok = res['outputs_rel_diff'] <= args.output_tolerance and res['loss_rel_diff'] <= args.output_tolerance
+        passed = passed and ok
+        write_to_log('Forward parity {}: outputs relative diff. {:.3}, loss relative diff. {:.3} - {}'.format(
+            name, res['outputs_rel_diff'], res['loss_rel_diff'], 'OK' if ok else 'FAILED'), prm)
+
+    # The same fixed tasks for both precisions:
+    set_random_seed(prm.seed)
+    task_generator = Task_Generator(prm)
+    train_data_loaders = task_generator.create_meta_batch(prm, args.n_train_tasks, meta_split='meta_train')
+    test_tasks_data = task_generator.create_meta_batch(prm, args.n_test_tasks, meta_split='meta_test')
+    chance_err = 1 - 1 / get_info(prm)['n_classes']
+    results['training'] = {'chance_err': chance_err}
+    for method in args.methods:
+        res = results['training'][method] = training_parity(method, train_data_loaders, test_tasks_data, prm, args)
+        res['learned'] = res['fp32']['test_err'] <= chance_err - args.chance_margin
+        ok = res['learned'] and res['err_diff'] <= args.err_tolerance
+        passed = passed and ok
+        write_to_log('Training parity {}: meta-test error fp32 {:.3}%, bf16 {:.3}% (chance {:.3}%), training time '
+                     'speedup {:.2f} - {}'.format(method, 100 * res['fp32']['test_err'], 100 * res['bf16']['test_err'],
+                                                  100 * chance_err, res['speedup'],
+                                                  'OK' if ok else ('FAILED' if res['learned'] else
+                                                                   'FAILED (fp32 near chance)')), prm)
+
+    results['passed'] = passed
+    save_results(results, os.path.join(prm.result_dir, 'precision_parity.json'))
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,327 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import argparse
+import random
+import timeit
+from copy import deepcopy
+import numpy as np
+import torch
+
+from Utils.data_gen import Task_Generator
+from Utils.common import create_result_dir, set_random_seed, write_to_log
+from PriorMetaLearning import meta_train_Bayes_finite_tasks, meta_train_Average_Transfer, meta_test_Bayes
+from MAML import meta_train_MAML_finite_tasks, meta_test_MAML
+from Benchmarks.bench_utils import get_default_prm, get_machine_info, save_results
+
+# -------------------------------------------------------------------------------------------
+#  Time-to-accuracy benchmark of the meta-learners
+# -------------------------------------------------------------------------------------------
+# Runs each method (MPB / MAML / AverageTransfer) on the same fixed set of meta-train and meta-test tasks,
+# and records the meta-test error against the training wall-clock time, the number of meta-steps and the number of
+# processed training samples. The meta-test evaluations are not counted in the training time, and they do not change
+# the random state of the training.
+#
+# Run from the repository root, e.g.:
+#   python -m Benchmarks.time_to_accuracy --time_budget 600 --eval_interval_sec 60 --target_errors 0.5 0.2 0.1
+# The results are saved in saved/<run-name>/time_to_accuracy.json (and a plot of the curves).
+
+METHODS = ['MPB', 'MAML', 'AverageTransfer']
+
+
+def get_method_prm(base_prm, method, args):
+    ''' Sets the method-specific parameters (with the defaults of main_Meta_Bayes.py / main_MAML.py)'''
+    prm = deepcopy(base_prm)
+    if method == 'MPB':
+        prm.n_meta_train_epochs = args.max_epochs
+        prm.n_meta_test_epochs = args.n_meta_test_epochs
+    elif method == 'MAML':
+        prm.alpha = args.alpha
+        prm.n_meta_train_grad_steps = 1
+        prm.n_meta_test_grad_steps = args.n_meta_test_grad_steps
+        prm.n_meta_train_iterations = args.max_epochs * int(np.ceil(prm.n_train_tasks / prm.meta_batch_size))
+        prm.MAML_Use_Test_Data = False
+    elif method == 'AverageTransfer':
+        prm.num_epochs = args.n_epochs_per_task
+        prm.n_meta_test_epochs = args.n_meta_test_epochs
+        prm.kappa_prior = 2e3
+    else:
+        raise ValueError('Invalid method')
+    return prm
+
+
+def get_rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def run_meta_test(method, model, test_tasks_data, prm):
+    ''' Average meta-test error of the learned meta-model (prior / initial point) '''
+    was_training = model.training
+    test_err_vec = np.zeros(len(test_tasks_data))
+    for i_task, task_data in enumerate(test_tasks_data):
+        if method == 'MAML':
+            test_err_vec[i_task], _ = meta_test_MAML.run_learning(task_data, model, prm, verbose=0)
+        else:
+            test_err_vec[i_task], _ = meta_test_Bayes.run_learning(task_data, model, prm, init_from_prior=True,
+                                                                   verbose=0)
+    # the meta-test learning backpropagates through the prior, don't leave gradients for the meta-training:
+    model.zero_grad()
+    model.train(was_training)
+    return test_err_vec.mean()
+
+
+class TimeToAccuracyRecorder(object):
+    ''' A step callback for the meta-trainers, which periodically evaluates the meta-test error
+     and stops the training when the time budget is exhausted '''
+
+    def __init__(self, method, test_tasks_data, prm, time_budget, eval_interval_sec, eval_every_steps):
+        self.method = method
+        self.test_tasks_data = test_tasks_data
+        self.prm = prm
+        self.time_budget = time_budget
+        self.eval_interval_sec = eval_interval_sec
+        self.eval_every_steps = eval_every_steps
+        self.curve = []
+        self.n_samples = 0
+        self.i_step = 0
+        self.eval_time = 0.0
+        self.last_eval_train_time = 0.0
+        self.start_time = None
+
+    def start(self):
+        self.start_time = timeit.default_timer()
+
+    def train_time(self):
+        # wall-clock time, without the evaluations
+        return timeit.default_timer() - self.start_time - self.eval_time
+
+    def evaluate(self, model):
+        eval_start = timeit.default_timer()
+        rng_state = get_rng_state()
+        train_time = self.train_time()
+        test_err = run_meta_test(self.method, model, self.test_tasks_data, self.prm)
+        set_rng_state(rng_state)
+        self.curve.append({'meta_step': self.i_step, 'train_time_sec': train_time, 'samples': self.n_samples,
+                           'test_err': float(test_err)})
+        self.last_eval_train_time = train_time
+        write_to_log('{} - meta-step {}, training time {:.1f} [sec]: meta-test error {:.3}%'.format(
+            self.method, self.i_step, train_time, 100 * test_err), self.prm)
+        self.eval_time += timeit.default_timer() - eval_start
+
+    def __call__(self, i_step, model, info):
+        self.i_step = i_step
+        n_samples = int(info['sample_count'])
+        if self.method == 'MAML':
+            # the sample count is of the validation batches, each task also takes inner steps with training batches
+            n_samples *= 1 + self.prm.n_meta_train_grad_steps
+        self.n_samples += n_samples
+        train_time = self.train_time()
+        if (self.eval_every_steps and i_step % self.eval_every_steps == 0) or \
+                (self.eval_interval_sec and train_time - self.last_eval_train_time >= self.eval_interval_sec):
+            self.evaluate(model)
+        return train_time >= self.time_budget
+
+    def finish(self, model):
+        ''' Evaluates the final model (if it was not evaluated at the last step) '''
+        total_train_time = self.train_time()
+        if not self.curve or self.curve[-1]['meta_step'] != self.i_step:
+            self.evaluate(model)
+        return total_train_time
+
+
+def summarize(curve, total_train_time, n_samples, target_errors):
+    summary = {'final_test_err': curve[-1]['test_err'], 'best_test_err': min(point['test_err'] for point in curve),
+               'train_time_sec': total_train_time, 'samples': n_samples,
+               'samples_per_sec': n_samples / max(total_train_time, 1e-12), 'time_to_target': {},
+               'steps_to_target': {}}
+    for target in target_errors:
+        reached = [point for point in curve if point['test_err'] <= target]
+        summary['time_to_target'][str(target)] = reached[0]['train_time_sec'] if reached else None
+        summary['steps_to_target'][str(target)] = reached[0]['meta_step'] if reached else None
+    return summary
+
+
+def run_method(method, train_data_loaders, test_tasks_data, base_prm, args):
+    prm = get_method_prm(base_prm, method, args)
+    write_to_log('---- Running {} (time budget: {} [sec])'.format(method, args.time_budget), prm)
+    set_random_seed(prm.seed)
+    recorder = TimeToAccuracyRecorder(method, test_tasks_data, prm, args.time_budget, args.eval_interval_sec,
+                                      args.eval_every_steps)
+    recorder.start()
+    if method == 'MPB':
+        model = meta_train_Bayes_finite_tasks.run_meta_learning(train_data_loaders, prm, step_callback=recorder)
+    elif method == 'MAML':
+        model = meta_train_MAML_finite_tasks.run_meta_learning(train_data_loaders, prm, step_callback=recorder)
+    else:
+        model = meta_train_Average_Transfer.run_meta_learning(train_data_loaders, prm, step_callback=recorder)
+    total_train_time = recorder.finish(model)
+    return {'curve': recorder.curve,
+            'summary': summarize(recorder.curve, total_train_time, recorder.n_samples, args.target_errors)}
+
+
+def write_report(results, prm):
+    targets = sorted(results['settings']['target_errors'], reverse=True)
+    header = '{:<18}{:>12}{:>12}{:>12}{:>14}'.format('Method', 'Final-Err', 'Best-Err', 'Time[sec]', 'Samples/sec')
+    header += ''.join('{:>16}'.format('T(err<={})'.format(target)) for target in targets)
+    lines = [header]
+    for method, method_results in results['methods'].items():
+        summary = method_results['summary']
+        line = '{:<18}{:>11.2f}%{:>11.2f}%{:>12.1f}{:>14.1f}'.format(
+            method, 100 * summary['final_test_err'], 100 * summary['best_test_err'], summary['train_time_sec'],
+            summary['samples_per_sec'])
+        for target in targets:
+            time_to_target = summary['time_to_target'][str(target)]
+            line += '{:>16}'.format('-' if time_to_target is None else '{:.1f}'.format(time_to_target))
+        lines.append(line)
+    write_to_log('---- Time-to-accuracy results:', prm)
+    write_to_log(lines, prm)
+
+
+def plot_curves(results, file_path):
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(1, 2, figsize=(12, 4.5))
+    for method, method_results in results['methods'].items():
+        curve = method_results['curve']
+        test_err = [100 * point['test_err'] for point in curve]
+        axes[0].plot([point['train_time_sec'] for point in curve], test_err, marker='o', label=method)
+        axes[1].plot([point['meta_step'] for point in curve], test_err, marker='o', label=method)
+    axes[0].set_xlabel('Training time [sec]')
+    axes[1].set_xlabel('Meta-steps (Average-Transfer: gradient steps)')
+    for ax in axes:
+        ax.set_ylabel('Meta-test error [%]')
+        ax.grid(True)
+        ax.legend()
+    fig.tight_layout()
+    fig.savefig(file_path)
+    plt.close(fig)
+    print('Plot saved in ' + file_path)
+
+
+# -------------------------------------------------------------------------------------------
+#  Main script
+# -------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--run-name', type=str, help='Name of dir to save results in (if empty, name by time)',
+                        default='time_to_accuracy')
+
+    parser.add_argument('--seed', type=int, help='random seed',
+                        default=1)
+
+    parser.add_argument('--methods', type=str, nargs='+', help='Methods to compare: ' + ' / '.join(METHODS),
+                        default=METHODS)
+
+    parser.add_argument('--time_budget', type=float, help='Training time budget of each method [sec]',
+                        default=600)
+
+    parser.add_argument('--eval_interval_sec', type=float,
+                        help='Evaluate the meta-test error every this training time [sec] (0 = not by time)',
+                        default=60)
+
+    parser.add_argument('--eval_every_steps', type=int,
+                        help='Evaluate the meta-test error every this number of meta-steps (0 = not by steps)',
+                        default=0)
+
+    parser.add_argument('--target_errors', type=float, nargs='+', help='Target meta-test errors for time-to-target',
+                        default=[0.5, 0.3, 0.2, 0.1])
+
+    # ----- Task Parameters ---------------------------------------------#
+
+    parser.add_argument('--data-source', type=str, help="Data: 'Synthetic' / 'MNIST' / 'CIFAR10' / Omniglot",
+                        default='Synthetic')
+
+    parser.add_argument('--data-transform', type=str, help="Data transformation",
+                        default='Permute_Labels')
+
+    parser.add_argument('--n_train_tasks', type=int, help='Number of meta-training tasks',
+                        default=5)
+
+    parser.add_argument('--n_test_tasks', type=int, help='Number of meta-test tasks',
+                        default=5)
+
+    parser.add_argument('--limit_train_samples_in_test_tasks', type=int,
+                        help='Upper limit for the number of training samples in the meta-test tasks (0 = unlimited)',
+                        default=2000)
+
+    parser.add_argument('--N_Way', type=int, help='Number of classes in a task (for Omniglot)',
+                        default=5)
+
+    parser.add_argument('--K_Shot_MetaTrain', type=int, help='Number of training samples per class (for Omniglot)',
+                        default=100)
+
+    parser.add_argument('--K_Shot_MetaTest', type=int, help='Number of training samples per class (for Omniglot)',
+                        default=100)
+
+    # ----- Algorithm Parameters ---------------------------------------------#
+
+    parser.add_argument('--model-name', type=str, help="Define model type (hypothesis class)'",
+                        default='ConvNet3')
+
+    parser.add_argument('--batch-size', type=int, help='input batch size for training',
+                        default=128)
+
+    parser.add_argument('--meta_batch_size', type=int, help='Maximal number of tasks in each meta-batch',
+                        default=5)
+
+    parser.add_argument('--max_epochs', type=int, help='Maximal number of meta-training epochs (if not stopped by'
+                                                       ' the time budget)',
+                        default=1000)
+
+    parser.add_argument('--n_meta_test_epochs', type=int, help='MPB / AverageTransfer: epochs of meta-test learning',
+                        default=20)
+
+    parser.add_argument('--n_epochs_per_task', type=int, help='AverageTransfer: epochs of learning each train task',
+                        default=50)
+
+    parser.add_argument('--alpha', type=float, help='MAML: step size for the inner gradient step',
+                        default=0.4)
+
+    parser.add_argument('--n_meta_test_grad_steps', type=int, help='MAML: gradient steps in meta-testing',
+                        default=3)
+
+    parser.add_argument('--gpu_index', type=int, help='The index of GPU device to run on',
+                        default=0)
+
+    args = parser.parse_args()
+
+    prm = get_default_prm(run_name=args.run_name, seed=args.seed, data_source=args.data_source,
+                          data_transform=args.data_transform, n_train_tasks=args.n_train_tasks,
+                          meta_batch_size=args.meta_batch_size, N_Way=args.N_Way,
+                          K_Shot_MetaTrain=args.K_Shot_MetaTrain, K_Shot_MetaTest=args.K_Shot_MetaTest,
+                          model_name=args.model_name, batch_size=args.batch_size,
+                          chars_split_type='random', n_meta_train_chars=1200, n_pixels_shuffles=200)
+    if torch.cuda.is_available():
+        prm.device = torch.device('cuda:' + str(args.gpu_index))
+    if prm.data_source != 'Synthetic':
+        from Data_Path import get_data_path
+        prm.data_path = get_data_path()
+    create_result_dir(prm)
+
+    # The same fixed task set for all the methods:
+    set_random_seed(prm.seed)
+    task_generator = Task_Generator(prm)
+    train_data_loaders = task_generator.create_meta_batch(prm, args.n_train_tasks, meta_split='meta_train')
+    limit_train_samples = args.limit_train_samples_in_test_tasks or None
+    test_tasks_data = task_generator.create_meta_batch(prm, args.n_test_tasks, meta_split='meta_test',
+                                                       limit_train_samples=limit_train_samples)
+
+    results = {'machine': get_machine_info(prm.device), 'settings': vars(args), 'methods': {}}
+    for method in args.methods:
+        results['methods'][method] = run_method(method, train_data_loaders, test_tasks_data, prm, args)
+        save_results(results, os.path.join(prm.result_dir, 'time_to_accuracy.json'))
+
+    write_report(results, prm)
+    plot_curves(results, os.path.join(prm.result_dir, 'time_to_accuracy.png'))
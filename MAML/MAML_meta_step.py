@@ -11,7 +11,9 @@ from collections import OrderedDict
 
 import torch
 from Utils import  data_gen
-from Utils.common import count_correct
+from Utils.common import count_correct_tensor
+from Utils.profiling import get_profiler
+from Utils.mixed_precision import run_forward
 
 def meta_step(prm, model, mb_data_loaders, mb_iterators, loss_criterion):
 
@@ -20,6 +22,7 @@ def meta_step(prm, model, mb_data_loaders, mb_iterators, loss_criterion):
     sample_count = 0
 
     n_tasks_in_mb = len(mb_data_loaders)
+    profiler = get_profiler()
 
     # ----------- loop over tasks in meta-batch -----------------------------------#
     for i_task in range(n_tasks_in_mb):
@@ -30,9 +33,10 @@ def meta_step(prm, model, mb_data_loaders, mb_iterators, loss_criterion):
         for i_step in range(prm.n_meta_train_grad_steps):
 
             # get batch variables:
-            batch_data = data_gen.get_next_batch_cyclic(mb_iterators[i_task],
-                                                        mb_data_loaders[i_task]['train'])
-            inputs, targets = data_gen.get_batch_vars(batch_data, prm)
+            with profiler.phase('data'):
+                batch_data = data_gen.get_next_batch_cyclic(mb_iterators[i_task],
+                                                            mb_data_loaders[i_task]['train'])
+                inputs, targets = data_gen.get_batch_vars(batch_data, prm)
             batch_size = inputs.shape[0]
 
             # Debug
@@ -41,33 +45,38 @@ def meta_step(prm, model, mb_data_loaders, mb_iterators, loss_criterion):
             # plt.imshow(inputs[0].cpu().data[0].numpy())  # show first image
             # plt.show()
 
-            if i_step == 0:
-                outputs = model(inputs)
-            else:
-                outputs = model(inputs, fast_weights)
-            # Empirical Loss on current task:
-            task_loss = loss_criterion(outputs, targets)
-            grads = torch.autograd.grad(task_loss, fast_weights.values(), create_graph=True)
-
-            fast_weights = OrderedDict((name, param - prm.alpha * grad)
-                                       for ((name, param), grad) in zip(fast_weights.items(), grads))
+            with profiler.phase('forward'):
+                if i_step == 0:
+                    outputs = run_forward(model, inputs, prm)
+                else:
+                    outputs = run_forward(model, inputs, prm, fast_weights)
+                # Empirical Loss on current task:
+                task_loss = loss_criterion(outputs, targets)
+            with profiler.phase('inner_grad'):
+                grads = torch.autograd.grad(task_loss, fast_weights.values(), create_graph=True)
+
+                fast_weights = OrderedDict((name, param - prm.alpha * grad)
+                                           for ((name, param), grad) in zip(fast_weights.items(), grads))
         # end grad steps loop
 
         # Sample new  (validation) data batch for this task:
-        if hasattr(prm, 'MAML_Use_Test_Data') and prm.MAML_Use_Test_Data:
-            batch_data = data_gen.get_next_batch_cyclic(mb_iterators[i_task],
-                                                        mb_data_loaders[i_task]['test'])
-        else:
-            batch_data = data_gen.get_next_batch_cyclic(mb_iterators[i_task],
-                                                     mb_data_loaders[i_task]['train'])
-
-
-        inputs, targets = data_gen.get_batch_vars(batch_data, prm)
-        outputs = model(inputs, fast_weights)
-        total_objective += (1 / batch_size) * loss_criterion(outputs, targets)
-        correct_count += count_correct(outputs, targets)
+        with profiler.phase('data'):
+            if hasattr(prm, 'MAML_Use_Test_Data') and prm.MAML_Use_Test_Data:
+                batch_data = data_gen.get_next_batch_cyclic(mb_iterators[i_task],
+                                                            mb_data_loaders[i_task]['test'])
+            else:
+                batch_data = data_gen.get_next_batch_cyclic(mb_iterators[i_task],
+                                                         mb_data_loaders[i_task]['train'])
+
+
+            inputs, targets = data_gen.get_batch_vars(batch_data, prm)
+        with profiler.phase('forward'):
+            outputs = run_forward(model, inputs, prm, fast_weights)
+            total_objective += (1 / batch_size) * loss_criterion(outputs, targets)
+        correct_count += count_correct_tensor(outputs, targets)
         sample_count += batch_size
     # end loop over tasks in  meta-batch
 
+    # note: the correct count is kept on the device (see MetricsAccumulator)
     info = {'sample_count': sample_count, 'correct_count': correct_count}
     return total_objective, info
@@ -12,6 +12,7 @@ from Models.deterministic_models import get_model
 from Utils.data_gen import Task_Generator
 from Utils.common import save_model_state, load_model_state, create_result_dir, set_random_seed, write_to_log, save_run_data, boolean_string
 from Data_Path import get_data_path
+from Utils.profiling import init_profiler, get_layer_stats
 
 torch.backends.cudnn.benchmark = True # For speed improvement with convnets with fixed-length inputs - https://discuss.pytorch.org/t/pytorch-performance/3079/7
 
@@ -44,7 +45,7 @@ parser.add_argument('--n_test_tasks', type=int,
 
 #----- Task Parameters ---------------------------------------------#
 
-parser.add_argument('--data-source', type=str, help="Data: 'MNIST' / 'CIFAR10' / Omniglot / SmallImageNet",
+parser.add_argument('--data-source', type=str, help="Data: 'MNIST' / 'CIFAR10' / Omniglot / SmallImageNet / Synthetic",
                     default='Omniglot')
 
 parser.add_argument('--n_train_tasks', type=int, help='Number of meta-training tasks (0 = infinite)',
@@ -56,10 +57,35 @@ parser.add_argument('--data-transform', type=str, help="Data transformation",
 parser.add_argument('--n_pixels_shuffles', type=int, help='In case of "Shuffled_Pixels": how many pixels swaps',
                     default=300)
 
+# Synthetic data (generated in memory, see Utils/synthetic_data.py):
+parser.add_argument('--synthetic_input_shape', type=int, nargs=3, help='In case of "Synthetic": input shape (C, H, W)',
+                    default=[1, 28, 28])
+
+parser.add_argument('--synthetic_n_classes', type=int, help='In case of "Synthetic": number of classes in a task',
+                    default=10)
+
+parser.add_argument('--synthetic_n_train_samples', type=int,
+                    help='In case of "Synthetic": number of training samples in a task',
+                    default=600)
+
+parser.add_argument('--synthetic_n_test_samples', type=int, help='In case of "Synthetic": number of test samples in a task',
+                    default=100)
+
+parser.add_argument('--synthetic_n_tasks', type=int,
+                    help='In case of "Synthetic": number of distinct tasks in each meta-split (0 = unlimited)',
+                    default=0)
+
 parser.add_argument('--limit_train_samples_in_test_tasks', type=int,
                     help='Upper limit for the number of training sampels in the meta-test tasks (0 = unlimited)',
                     default=0)
 
+parser.add_argument('--num_workers', type=int, help='Number of data loading worker processes per data loader',
+                    default=4)
+
+parser.add_argument('--cache_datasets', type=boolean_string,
+                    help='Keep the decoded and transformed samples in memory (effective with num_workers=0)',
+                    default=False)
+
 # N-Way K-Shot Parameters:
 parser.add_argument('--N_Way', type=int, help='Number of classes in a task (for Omniglot)',
                     default=5)
@@ -111,6 +137,22 @@ parser.add_argument('--batch-size', type=int, help='input batch size for trainin
 
 parser.add_argument('--lr', type=float, help='initial learning rate',
                     default=1e-3)
+
+parser.add_argument('--mixed_precision', type=str,
+                    help="'fp32' / 'bf16' (bf16 autocast of the forward computations, see Utils/mixed_precision.py)",
+                    default='fp32')
+
+parser.add_argument('--compile_forward', type=boolean_string, default=False,
+                    help='Compile the forward (+ loss) of the models with torch.compile (see Utils/compiled.py)')
+
+parser.add_argument('--compile_cache_limit', type=int,
+                    help='For compile_forward: maximal number of compiled versions of each function',
+                    default=16)
+
+parser.add_argument('--profile_layers', type=boolean_string,
+                    help='Record the FLOPs, bytes moved and time of each layer (only layers applied as modules,'
+                         ' i.e. not the steps with fast weights)',
+                    default=False)
 # -------------------------------------------------------------------------------------------
 
 prm = parser.parse_args()
@@ -118,6 +160,7 @@ prm.device = torch.device("cuda:3" if torch.cuda.is_available() else "cpu")
 prm.data_path = get_data_path()
 set_random_seed(prm.seed)
 create_result_dir(prm)
+init_profiler(prm)
 
 
 #  Define optimizer:
@@ -203,7 +246,10 @@ for i_task in range(n_test_tasks):
     test_err_vec[i_task], _ = meta_test_MAML.run_learning(task_data, meta_model, prm, verbose=0)
 
 # save result
-save_run_data(prm, {'test_err_vec': test_err_vec})
+run_data = {'test_err_vec': test_err_vec}
+if prm.profile_layers:
+    run_data['layer_stats'] = get_layer_stats().summary()
+save_run_data(prm, run_data)
 
 # -------------------------------------------------------------------------------------------
 #  Print results
@@ -211,6 +257,8 @@ save_run_data(prm, {'test_err_vec': test_err_vec})
 write_to_log('---- Final Results: ', prm)
 write_to_log('Meta-Testing - Avg test err: {:.3}%, STD: {:.3}%'
              .format(100 * test_err_vec.mean(), 100 * test_err_vec.std()), prm)
+if prm.profile_layers:
+    get_layer_stats().write_report(prm)
 
 stop_time = timeit.default_timer()
 write_to_log('Total runtime: ' +
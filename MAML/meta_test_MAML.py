@@ -8,8 +8,9 @@ import timeit
 
 from Models.deterministic_models import get_model
 from Utils import common as cmn, data_gen
-from Utils.common import grad_step, correct_rate, write_to_log, count_correct
+from Utils.common import grad_step, correct_rate, write_to_log, count_correct_tensor
 from Utils.Losses import get_loss_func
+from Utils.mixed_precision import run_forward
 from torch.optim import SGD
 
 def run_learning(task_data, meta_model, prm, verbose=1):
@@ -54,7 +55,7 @@ def run_learning(task_data, meta_model, prm, verbose=1):
             batch_size = inputs.shape[0]
 
             # Calculate empirical loss:
-            outputs = task_model(inputs)
+            outputs = run_forward(task_model, inputs, prm)
             task_objective = (1 / batch_size) * loss_criterion(outputs, targets)
 
             # Take gradient step with the task weights:
@@ -74,12 +75,13 @@ def run_learning(task_data, meta_model, prm, verbose=1):
         for batch_data in test_loader:
             inputs, targets = data_gen.get_batch_vars(batch_data, prm)
             batch_size = inputs.shape[0]
-            outputs = model(inputs)
+            outputs = run_forward(model, inputs, prm)
             test_loss += (1 / batch_size) * loss_criterion(outputs, targets)  # sum the mean loss in batch
-            n_correct += count_correct(outputs, targets)
+            n_correct += count_correct_tensor(outputs, targets)  # kept on the device until the end
 
         n_test_samples = len(test_loader.dataset)
         n_test_batches = len(test_loader)
+        n_correct = int(n_correct)
         test_loss = test_loss.item() / n_test_batches
         test_acc = n_correct / n_test_samples
         print('\nTest set: Average loss: {:.4}, Accuracy: {:.3} ( {}/{})\n'.format(
@@ -14,10 +14,14 @@ from Utils import common as cmn
 from Utils.common import grad_step, write_to_log
 from Utils.Losses import get_loss_func
 from MAML.MAML_meta_step import meta_step
+from Utils.profiling import get_profiler
 # -------------------------------------------------------------------------------------------
 #  Learning function
 # -------------------------------------------------------------------------------------------
-def run_meta_learning(train_data_loaders, prm):
+def run_meta_learning(train_data_loaders, prm, step_callback=None):
+    ''' Meta-training with a finite set of tasks.
+     step_callback (optional) - called after each meta-step as step_callback(i_step, model, info),
+     if it returns True the training is stopped (e.g. when a time budget is exhausted) '''
 
     # -------------------------------------------------------------------------------------------
     #  Setting-up
@@ -46,6 +50,8 @@ def run_meta_learning(train_data_loaders, prm):
     n_batches_per_task = np.max(n_batch_list)
     # note: if some tasks have less data that other tasks - it may be sampled more than once in an epoch
 
+    training_state = {'i_step': 0, 'stop': False}
+
     # -------------------------------------------------------------------------------------------
     #  Training epoch  function
     # -------------------------------------------------------------------------------------------
@@ -66,6 +72,9 @@ def run_meta_learning(train_data_loaders, prm):
         meta_batch_starts = list(range(0, len(task_order), prm.meta_batch_size))
         n_meta_batches = len(meta_batch_starts)
 
+        # the metrics are kept on the device, and moved to the host only when printed:
+        metrics = cmn.MetricsAccumulator()
+
         # ----------- meta-batches loop (batches of tasks) -----------------------------------#
         for i_meta_batch in range(n_meta_batches):
 
@@ -81,13 +90,24 @@ def run_meta_learning(train_data_loaders, prm):
             total_objective, info = meta_step(prm, model, mb_data_loaders, mb_iterators, loss_criterion)
 
             # Take gradient step with the meta-parameters (theta) based on validation data:
-            grad_step(total_objective, meta_optimizer, lr_schedule, prm.lr, i_epoch)
+            with get_profiler().phase('backward_and_step'):
+                grad_step(total_objective, meta_optimizer, lr_schedule, prm.lr, i_epoch)
+            get_profiler().step()
+
+            metrics.add('objective', total_objective)
+            metrics.add_dict(info)
 
-            # Print status:
+            # Print status (averages since the last print):
             log_interval = 200
             if i_meta_batch % log_interval == 0:
-                batch_acc = info['correct_count'] / info['sample_count']
-                print(cmn.status_string(i_epoch, num_epochs, i_meta_batch, n_meta_batches, batch_acc, total_objective.item()))
+                means, sums = metrics.reduce()
+                batch_acc = sums['correct_count'] / sums['sample_count']
+                print(cmn.status_string(i_epoch, num_epochs, i_meta_batch, n_meta_batches, batch_acc, means['objective']))
+
+            training_state['i_step'] += 1
+            if step_callback is not None and step_callback(training_state['i_step'], model, info):
+                training_state['stop'] = True
+                break
         # end  meta-batches loop
 
     # end run_epoch()
@@ -110,6 +130,8 @@ def run_meta_learning(train_data_loaders, prm):
     # Training loop:
     for i_epoch in range(num_epochs):
         run_train_epoch(i_epoch)
+        if training_state['stop']:
+            break
 
     stop_time = timeit.default_timer()
 
@@ -12,6 +12,7 @@ from Utils import common as cmn, data_gen
 from Utils.common import grad_step, write_to_log
 from Utils.Losses import get_loss_func
 from MAML.MAML_meta_step import meta_step
+from Utils.profiling import get_profiler
 # -------------------------------------------------------------------------------------------
 #  Learning function
 # -------------------------------------------------------------------------------------------
@@ -39,6 +40,9 @@ def run_meta_learning(prm, task_generator):
     meta_optimizer = optim_func(meta_params, **optim_args)
 
     meta_batch_size = prm.meta_batch_size
+
+    # the metrics are kept on the device, and moved to the host only when printed:
+    metrics = cmn.MetricsAccumulator()
     # -------------------------------------------------------------------------------------------
     #  Training epoch  function
     # -------------------------------------------------------------------------------------------
@@ -56,13 +60,19 @@ def run_meta_learning(prm, task_generator):
         total_objective, info = meta_step(prm, model, mb_data_loaders, mb_iterators, loss_criterion)
 
         # Take gradient step with the meta-parameters (theta) based on validation data:
-        grad_step(total_objective, meta_optimizer, lr_schedule, prm.lr, i_iter)
+        with get_profiler().phase('backward_and_step'):
+            grad_step(total_objective, meta_optimizer, lr_schedule, prm.lr, i_iter)
+        get_profiler().step()
+
+        metrics.add('objective', total_objective)
+        metrics.add_dict(info)
 
-        # Print status:
+        # Print status (averages since the last print):
         log_interval = 5
         if (i_iter) % log_interval == 0:
-            batch_acc = info['correct_count'] / info['sample_count']
-            print(cmn.status_string(i_iter, n_iterations, 1, 1, batch_acc, total_objective.item()))
+            means, sums = metrics.reduce()
+            batch_acc = sums['correct_count'] / sums['sample_count']
+            print(cmn.status_string(i_iter, n_iterations, 1, 1, batch_acc, means['objective']))
 
 
     # end run_meta_iteration()
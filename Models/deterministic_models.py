@@ -10,6 +10,7 @@ import torch.nn.functional as F
 from Utils import data_gen
 from Models.layer_inits import init_layers
 from Utils.common import list_mult
+from Utils.profiling import get_layer_stats
 # -------------------------------------------------------------------------------------------
 # Main function
 # -------------------------------------------------------------------------------------------
@@ -37,6 +38,10 @@ def get_model(prm):
     model.weights_count = count_weights(model)
     model.to(prm.device)  # GPU or CPU
 
+    # Per-layer statistics (if enabled):
+    if get_layer_stats() is not None:
+        model.register_layer_stats(get_layer_stats())
+
     return model
 
 
@@ -87,6 +92,14 @@ class base_model(nn.Module):
     def _init_weights(self):
         init_layers(self)
 
+    def register_layer_stats(self, layer_stats):
+        ''' Registers hooks which record the FLOPs, bytes and time of each layer (see Utils.profiling) '''
+        handles = []
+        for layer_name, m in self.named_modules():
+            if isinstance(m, (nn.Linear, nn.Conv2d, nn.BatchNorm2d)):
+                handles += layer_stats.register_layer(layer_name, m)
+        return handles
+
 
     def copy_weights(self, net):
         ''' Set this module's weights to be the same as those of 'net' '''
@@ -0,0 +1,108 @@
+from __future__ import absolute_import, division, print_function
+
+import torch
+import torch.nn as nn
+from Models import stochastic_models
+from Models.stochastic_layers import StochasticLayer
+from Utils import data_gen
+
+# -------------------------------------------------------------------------------------------
+#  Freezing stochastic models into deterministic inference modules
+# -------------------------------------------------------------------------------------------
+# For deployment of a learned posterior (e.g. with test_type 'MaxPosterior'), a stochastic model is converted into
+# the same network with standard layers (stochastic_models.get_model with model_type='Standard', so the layers have
+# the same names) which holds fixed weights:
+#  * freeze_model - the posterior means (the same outputs as the stochastic model with eps_std=0).
+#  * freeze_ensemble - an ensemble of n_members networks with weights sampled from the posterior, which predicts
+#    by the average of the members' outputs (as test_type 'AvgVote').
+# The frozen modules have no variance path, no RNG and no Python branching per layer, and can be exported with
+# export_model to TorchScript (traced) or ONNX (needs the onnx package).
+
+EXPORT_FORMATS = ['torchscript', 'onnx']
+
+
+def freeze_model(model, prm):
+    ''' Returns a deterministic network with the posterior means of the stochastic model (in eval mode) '''
+    return get_frozen_network(model, prm, get_layers_weights(model, i_sample=None))
+
+
+def freeze_ensemble(model, prm, n_members):
+    ''' Returns an ensemble of n_members deterministic networks with weights sampled from the posterior of the
+     stochastic model (see StochasticLayer.sample_weights), in eval mode '''
+    model.sample_weights(n_members)
+    try:
+        members = [get_frozen_network(model, prm, get_layers_weights(model, i_sample))
+                   for i_sample in range(n_members)]
+    finally:
+        model.clear_weight_samples()
+    return EnsembleModel(members).eval()
+
+
+class EnsembleModel(nn.Module):
+    ''' Predicts by the average of the outputs of the members '''
+    def __init__(self, members):
+        super(EnsembleModel, self).__init__()
+        self.members = nn.ModuleList(members)
+
+    def forward(self, x):
+        outputs = self.members[0](x)
+        for member in self.members[1:]:
+            outputs = outputs + member(x)
+        return outputs / len(self.members)
+
+
+def get_layers_weights(model, i_sample=None):
+    ''' The weights of the stochastic layers by their names in the standard network: the posterior means
+     (i_sample=None) or the i_sample-th pre-sampled weights '''
+    weights = {}
+    for layer_name, m in model.named_modules():
+        if isinstance(m, StochasticLayer):
+            if i_sample is None:
+                weight, bias = m.w_mu, (m.b_mu if m.use_bias else None)
+            else:
+                weight, bias = m.weight_samples[i_sample]
+            weights[layer_name + '.weight'] = weight
+            if bias is not None:
+                weights[layer_name + '.bias'] = bias
+    return weights
+
+
+def get_frozen_network(model, prm, layers_weights):
+    prm_frozen = prm
+    if getattr(prm, 'model_name', None) != model.model_name:
+        from copy import deepcopy
+        prm_frozen = deepcopy(prm)
+        prm_frozen.model_name = model.model_name
+    frozen = stochastic_models.get_model(prm_frozen, model_type='Standard')
+    state_dict = {}
+    for name, tensor in model.state_dict().items():
+        # the other modules (e.g. batch-norm) are the same in both networks
+        if name.split('.')[-1] not in ('w_mu', 'w_log_var', 'b_mu', 'b_log_var'):
+            state_dict[name] = tensor
+    state_dict.update(layers_weights)
+    frozen.load_state_dict({name: tensor.detach().clone() for name, tensor in state_dict.items()})
+    for param in frozen.parameters():
+        param.requires_grad_(False)
+    return frozen.eval()
+
+
+# -------------------------------------------------------------------------------------------
+#  Export
+# -------------------------------------------------------------------------------------------
+def export_model(frozen, prm, path, export_format='torchscript'):
+    ''' Exports a frozen model (or ensemble) for inference: 'torchscript' - a traced module (torch.jit.load),
+     'onnx' - an ONNX graph with a dynamic batch size (needs the onnx package). Returns the path '''
+    frozen.eval()
+    input_shape = data_gen.get_info(prm)['input_shape']
+    example_inputs = torch.zeros((2,) + tuple(input_shape), device=prm.device)
+    with torch.no_grad():
+        if export_format == 'torchscript':
+            traced = torch.jit.trace(frozen, example_inputs)
+            traced = torch.jit.freeze(traced) if hasattr(torch.jit, 'freeze') else traced
+            traced.save(path)
+        elif export_format == 'onnx':
+            torch.onnx.export(frozen, (example_inputs,), path, input_names=['inputs'], output_names=['outputs'],
+                              dynamic_axes={'inputs': {0: 'batch_size'}, 'outputs': {0: 'batch_size'}})
+        else:
+            raise ValueError('Invalid export_format')
+    return path
@@ -0,0 +1,116 @@
+from __future__ import absolute_import, division, print_function
+
+import io
+import timeit
+from copy import deepcopy
+import torch
+from Models.freeze import freeze_model, freeze_ensemble
+from Utils import data_gen
+from Utils.common import count_correct
+
+# -------------------------------------------------------------------------------------------
+#  Int8 post-training quantization of learned posteriors
+# -------------------------------------------------------------------------------------------
+# The deterministic snapshot of a posterior (the posterior means or an ensemble of sampled networks, see
+# Models/freeze.py) is quantized to int8 for CPU inference by static post-training quantization (FX graph mode):
+# observers are inserted, calibrated on batches of the task's training loader, and the model is converted to int8
+# kernels (operations without int8 kernels, e.g. elu, run in fp32 between de-quantize / quantize).
+# eval_quantization measures the test error of the fp32 and int8 models (the accuracy delta), the inference time
+# per batch and the model size, and quantize_posteriors does it for all the posteriors of a meta-test run.
+# Notes:
+#   * The quantized kernels run on CPU (prm.quant_backend, by default 'x86' / 'fbgemm' if supported, else
+#     'qnnpack'), the quantized model and the timing are on the CPU.
+#   * Needs a version of PyTorch with torch.ao.quantization.quantize_fx.
+
+
+def get_quant_backend(prm):
+    if hasattr(prm, 'quant_backend') and prm.quant_backend:
+        return prm.quant_backend
+    for backend in ['x86', 'fbgemm', 'qnnpack']:
+        if backend in torch.backends.quantized.supported_engines:
+            return backend
+    raise ValueError('No quantized backend is supported')
+
+
+def quantize_model(frozen_model, calib_loader, prm, n_calib_batches=10):
+    ''' Returns an int8 version (on CPU) of the frozen model, calibrated on (at most n_calib_batches, 0 = all)
+     batches of calib_loader '''
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    backend = get_quant_backend(prm)
+    torch.backends.quantized.engine = backend
+    model = deepcopy(frozen_model).cpu().eval()
+    example_inputs = (get_cpu_inputs(next(iter(calib_loader)), prm),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs)
+    with torch.no_grad():
+        for i_batch, batch_data in enumerate(calib_loader):
+            if n_calib_batches and i_batch >= n_calib_batches:
+                break
+            prepared(get_cpu_inputs(batch_data, prm))
+    return convert_fx(prepared)
+
+
+def get_cpu_inputs(batch_data, prm):
+    inputs, _ = data_gen.get_batch_vars(batch_data, prm)
+    return inputs.cpu()
+
+
+def eval_cpu_model(model, loader, prm):
+    ''' The error of the model on the loader (on CPU), and the mean inference time per batch [ms] '''
+    n_correct, n_samples, total_time = 0, 0, 0.0
+    with torch.no_grad():
+        for batch_data in loader:
+            inputs, targets = data_gen.get_batch_vars(batch_data, prm)
+            inputs, targets = inputs.cpu(), targets.cpu()
+            start_time = timeit.default_timer()
+            outputs = model(inputs)
+            total_time += timeit.default_timer() - start_time
+            n_correct += count_correct(outputs, targets)
+            n_samples += inputs.shape[0]
+    return 1 - n_correct / n_samples, 1e3 * total_time / len(loader)
+
+
+def get_model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def eval_quantization(frozen_model, quantized_model, loader, prm):
+    ''' Compares the fp32 frozen model and the int8 model on the loader (both on CPU) '''
+    fp32_model = deepcopy(frozen_model).cpu().eval()
+    fp32_err, fp32_ms = eval_cpu_model(fp32_model, loader, prm)
+    int8_err, int8_ms = eval_cpu_model(quantized_model, loader, prm)
+    return {'fp32_err': fp32_err, 'int8_err': int8_err, 'err_delta': int8_err - fp32_err,
+            'fp32_ms_per_batch': fp32_ms, 'int8_ms_per_batch': int8_ms, 'speedup': fp32_ms / max(int8_ms, 1e-12),
+            'fp32_size_mb': get_model_size_mb(fp32_model), 'int8_size_mb': get_model_size_mb(quantized_model)}
+
+
+def quantize_posteriors(post_models, tasks_data, prm, n_members=0, n_calib_batches=10):
+    ''' Quantizes the posteriors of the tasks (e.g. of a meta-test run): the snapshot of each posterior (the means,
+     or an ensemble of n_members sampled networks) is calibrated on the task's training loader and evaluated on its
+     test loader. Returns the int8 models and the results (of each task, and their averages) '''
+    quantized_models = []
+    tasks_results = []
+    for post_model, task_data in zip(post_models, tasks_data):
+        if n_members > 0:
+            frozen_model = freeze_ensemble(post_model, prm, n_members)
+        else:
+            frozen_model = freeze_model(post_model, prm)
+        quantized_model = quantize_model(frozen_model, task_data['train'], prm, n_calib_batches)
+        quantized_models.append(quantized_model)
+        tasks_results.append(eval_quantization(frozen_model, quantized_model, task_data['test'], prm))
+    results = {'tasks': tasks_results}
+    for key in tasks_results[0]:
+        results['avg_' + key] = sum(res[key] for res in tasks_results) / len(tasks_results)
+    return quantized_models, results
+
+
+def save_quantized_model(quantized_model, prm, path):
+    ''' Saves the int8 model as a traced TorchScript module (torch.jit.load) '''
+    input_shape = data_gen.get_info(prm)['input_shape']
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized_model, torch.zeros((2,) + tuple(input_shape)))
+    traced.save(path)
+    return path
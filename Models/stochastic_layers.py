@@ -1,10 +1,14 @@
 from __future__ import absolute_import, division, print_function
 
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from Models.stochastic_inits import init_stochastic_conv2d, init_stochastic_linear
 from Utils.common import list_mult
+from Utils.profiling import stochastic_path_flops_and_bytes
+from Utils.rng_streams import get_rng_streams
+from Utils.mixed_precision import fp32_region
 
 # -------------------------------------------------------------------------------------------
 #  Stochastic linear layer
@@ -13,6 +17,18 @@ class StochasticLayer(nn.Module):
     # base class of stochastic layers with re-parametrization
     # self.init  and self.operation should be filled by derived classes
 
+    # the noise type of the re-parametrization trick (see draw_noise) and the gradient estimator ('local_reparam' /
+    # 'flipout', see forward), the defaults also apply to saved models:
+    noise_type = 'iid'
+    noise_state = None
+    estimator = 'local_reparam'
+    # the key of the layer's RNG streams (see set_rng_key and Utils/rng_streams.py), None = the global RNG:
+    rng_key = None
+    rng_state = None
+    # pre-sampled concrete weights (see sample_weights), None = the re-parametrization in each forward:
+    weight_samples = None
+    i_weight_sample = 0
+
     def create_stochastic_layer(self, weights_shape, bias_size, prm):
         # create the layer parameters
         # values initialization is done later
@@ -27,15 +43,22 @@ class StochasticLayer(nn.Module):
             self.b_mu = get_param(bias_size)
             self.b_log_var = get_param(bias_size)
             self.b = {'mean': self.b_mu, 'log_var': self.b_log_var}
+        self.layer_stats = None  # set by the model if per-layer statistics are recorded
+        self.noise_type = prm.noise_type if hasattr(prm, 'noise_type') else 'iid'
+        self.estimator = prm.stochastic_estimator if hasattr(prm, 'stochastic_estimator') else 'local_reparam'
+        self.noise_state = None
 
 
 
     def forward(self, x):
 
         # Layer computations (based on "Variational Dropout and the Local
-        # Reparameterization Trick", Kingma et.al 2015)
+        # Reparameterization Trick", Kingma et.al 2015), or Flipout (see flipout_perturbation)
         # self.operation should be linear or conv
 
+        if self.weight_samples is not None and self.eps_std != 0.0:
+            return self.forward_sampled_weights(x)
+
         if self.use_bias:
             b_var = torch.exp(self.b_log_var)
             bias_mean = self.b['mean']
@@ -43,30 +66,181 @@ class StochasticLayer(nn.Module):
             b_var = None
             bias_mean = None
 
+        layer_stats = self.layer_stats
+        if layer_stats is not None:
+            start_time = layer_stats.timer()
+
         out_mean = self.operation(x, self.w['mean'], bias=bias_mean)
 
+        if layer_stats is not None:
+            layer_stats.add_forward(self.layer_name, 'mean', start_time,
+                                    *stochastic_path_flops_and_bytes('mean', x, self.w_mu, out_mean, bias_mean))
+            start_time = layer_stats.timer()
+
         eps_std = self.eps_std
         if eps_std == 0.0:
             layer_out = out_mean
-        else:
-            w_var = torch.exp(self.w_log_var)
-            out_var = self.operation(x.pow(2), w_var, bias=b_var)
+        elif self.estimator == 'flipout':
+            # (in mixed precision, the perturbation is drawn in fp32, its operation runs in bf16 and the sum in fp32,
+            #  see Utils/mixed_precision.py)
+            layer_out = out_mean.float() + self.flipout_perturbation(x, eps_std, self.rng_generator('forward')).float()
+
+            if layer_stats is not None:
+                layer_stats.add_forward(self.layer_name, 'flipout', start_time,
+                                        *stochastic_path_flops_and_bytes('flipout', x, self.w_log_var, out_mean,
+                                                                         self.b_log_var if self.use_bias else None))
+        elif self.estimator == 'local_reparam':
+            # the variance path is numerically sensitive, so it runs in fp32 also in mixed precision
+            #  (see Utils/mixed_precision.py)
+            with fp32_region(x.device.type):
+                w_var = torch.exp(self.w_log_var)
+                out_var = self.operation(x.float().pow(2), w_var, bias=b_var)
+
+                # Draw Gaussian random noise, N(0, eps_std) in the size of the
+                # layer output:
+                noise = self.draw_noise(out_var, eps_std, self.rng_generator('forward'))
+                # noise = eps_std * torch.randn_like(out_mean, requires_grad=False)
+
+                # out_var = F.relu(out_var) # to avoid nan due to numerical errors
+                layer_out = out_mean.float() + noise * torch.sqrt(out_var)
+
+            if layer_stats is not None:
+                layer_stats.add_forward(self.layer_name, 'var', start_time,
+                                        *stochastic_path_flops_and_bytes('var', x, w_var, out_var, b_var))
 
-            # Draw Gaussian random noise, N(0, eps_std) in the size of the
-            # layer output:
-            noise = out_mean.data.new(out_mean.size()).normal_(0, eps_std)
-            # noise = eps_std * torch.randn_like(out_mean, requires_grad=False)
+        else:
+            raise ValueError('Invalid stochastic_estimator')
 
-            # out_var = F.relu(out_var) # to avoid nan due to numerical errors
-            layer_out = out_mean + noise * torch.sqrt(out_var)
+        return layer_out
 
+    def forward_sampled_weights(self, x):
+        ''' The forward with the current pre-sampled weights (a plain operation, without the variance path) '''
+        weight, bias = self.weight_samples[self.i_weight_sample]
+        layer_stats = self.layer_stats
+        if layer_stats is not None:
+            start_time = layer_stats.timer()
+        layer_out = self.operation(x, weight, bias=bias)
+        if layer_stats is not None:
+            layer_stats.add_forward(self.layer_name, 'mean', start_time,
+                                    *stochastic_path_flops_and_bytes('mean', x, weight, layer_out, bias))
         return layer_out
 
+    def sample_weights(self, n_samples):
+        ''' Draws n_samples concrete weights (and biases) from the layer's distribution, N(mu, eps_std^2 * var).
+         Until clear_weight_samples(), the forward uses the sample selected by set_weight_sample with a plain
+         operation, so the same weights are used for all the inputs (the noise is iid, noise_type and estimator
+         do not apply) '''
+        self.weight_samples = []
+        with torch.no_grad():
+            for i_sample in range(n_samples):
+                generator = self.rng_generator('weights')
+                weight = self.w_mu + torch.exp(0.5 * self.w_log_var) * \
+                         self.w_mu.new(self.w_mu.size()).normal_(0, self.eps_std, generator=generator)
+                if self.use_bias:
+                    bias = self.b_mu + torch.exp(0.5 * self.b_log_var) * \
+                           self.b_mu.new(self.b_mu.size()).normal_(0, self.eps_std, generator=generator)
+                else:
+                    bias = None
+                self.weight_samples.append((weight, bias))
+        self.i_weight_sample = 0
+
+    def set_weight_sample(self, i_sample):
+        self.i_weight_sample = i_sample
+
+    def clear_weight_samples(self):
+        self.weight_samples = None
+
+    def flipout_perturbation(self, x, eps_std, generator=None):
+        ''' The output perturbation of Flipout ("Flipout: Efficient Pseudo-Independent Weight Perturbations on
+         Mini-Batches", Wen et.al 2018): one weight perturbation dW ~ N(0, eps_std^2 * var) is drawn per forward pass,
+         and it is decorrelated between the examples by random signs of the inputs and outputs of each example
+         (per feature / per channel): op(x * s_in, dW, db) * s_out.
+         The marginal distribution of the weights of each example is the same as in the local re-parametrization
+         (note: the noise is always iid, noise_type applies only to the local re-parametrization) '''
+        w_delta = torch.exp(0.5 * self.w_log_var) * \
+                  self.w_log_var.data.new(self.w_log_var.size()).normal_(0, eps_std, generator=generator)
+        if self.use_bias:
+            b_delta = torch.exp(0.5 * self.b_log_var) * \
+                      self.b_log_var.data.new(self.b_log_var.size()).normal_(0, eps_std, generator=generator)
+        else:
+            b_delta = None
+        out_delta = self.operation(x * random_signs(x, generator), w_delta, bias=b_delta)
+        return out_delta * random_signs(out_delta, generator)
+
+    def set_estimator(self, estimator):
+        old_estimator = self.estimator
+        self.estimator = estimator
+        return old_estimator
+
     def set_eps_std(self, eps_std):
         old_eps_std = self.eps_std
         self.eps_std = eps_std
         return old_eps_std
 
+    def draw_noise(self, out_mean, eps_std, generator=None):
+        ''' Draws the noise of the re-parametrization trick according to self.noise_type:
+         'iid' - independent Gaussian draws in each forward pass.
+         'antithetic' - pairs of consecutive forward passes use (eps, -eps).
+         'qmc' - randomized quasi-Monte-Carlo: the k-th forward pass uses the k-th point of the (base 2) Sobol
+          sequence, shifted by a uniform random variable per output element (fixed within the sequence), mapped
+          to a Gaussian by the inverse CDF.
+         The correlated draws restart after reset_noise() or if the output shape changes.
+         generator - of the layer's RNG stream (None = the global RNG) '''
+        if self.noise_type == 'iid':
+            return out_mean.data.new(out_mean.size()).normal_(0, eps_std, generator=generator)
+
+        state = self.noise_state
+        if state is None or state['shape'] != out_mean.shape:
+            state = self.noise_state = {'shape': out_mean.shape, 'count': 0}
+
+        if self.noise_type == 'antithetic':
+            if state['count'] % 2 == 0:
+                state['eps'] = out_mean.data.new(out_mean.size()).normal_(0, 1, generator=generator)
+                noise = state['eps']
+            else:
+                noise = -state['eps']
+        elif self.noise_type == 'qmc':
+            if state['count'] == 0:
+                state['shift'] = out_mean.data.new(out_mean.size()).uniform_(0, 1, generator=generator)
+            u = torch.remainder(state['shift'] + radical_inverse(state['count']), 1.0)
+            u = u.clamp(QMC_EPS, 1 - QMC_EPS)
+            noise = math.sqrt(2) * torch.erfinv(2 * u - 1)
+        else:
+            raise ValueError('Invalid noise_type')
+        state['count'] += 1
+        return eps_std * noise
+
+    def set_noise_type(self, noise_type):
+        old_noise_type = self.noise_type
+        self.noise_type = noise_type
+        self.noise_state = None
+        return old_noise_type
+
+    def reset_noise(self):
+        ''' Starts a new sequence of correlated noise draws (for antithetic / qmc noise),
+         and a new step of the layer's RNG streams (in the current train / eval mode) '''
+        self.noise_state = None
+        if self.rng_state is not None:
+            phase = 'train' if self.training else 'eval'
+            self.rng_state[phase] += 1
+            self.rng_state['draws'] = {}
+
+    def set_rng_key(self, key):
+        ''' Sets the key of the layer's RNG streams (and restarts the steps count) '''
+        self.rng_key = key
+        self.rng_state = {'train': 0, 'eval': 0, 'draws': {}}
+
+    def rng_generator(self, draw_type):
+        ''' Returns the generator of the next draw of the type in the current step (e.g. the MC index),
+         if RNG streams are used (see Utils/rng_streams.py), otherwise None (the global RNG) '''
+        rng_streams = get_rng_streams()
+        if rng_streams is None or self.rng_key is None:
+            return None
+        phase = 'train' if self.training else 'eval'
+        i_draw = self.rng_state['draws'].get(draw_type, 0)
+        self.rng_state['draws'][draw_type] = i_draw + 1
+        return rng_streams.generator(self.w_mu.device, self.rng_key, phase, self.rng_state[phase], draw_type, i_draw)
+
 # -------------------------------------------------------------------------------------------
 #  Stochastic linear layer
 # -------------------------------------------------------------------------------------------
@@ -131,6 +305,25 @@ class StochasticConv2d(StochasticLayer):
 # -------------------------------------------------------------------------------------------
 #  Auxilary functions
 # -------------------------------------------------------------------------------------------
+QMC_EPS = 1e-6  # the uniform variables are clamped away from 0 and 1 before the inverse CDF
+
+
+def radical_inverse(k):
+    # the k-th point of the van der Corput sequence in base 2 (the 1-D Sobol sequence)
+    result, scale = 0.0, 0.5
+    while k:
+        result += scale * (k & 1)
+        k >>= 1
+        scale *= 0.5
+    return result
+
+
+def random_signs(x, generator=None):
+    # random signs (+1 / -1) per example and per feature / channel, in a shape which broadcasts to x
+    shape = x.shape[:2] + (1,) * (x.dim() - 2)
+    return x.data.new(shape).bernoulli_(0.5, generator=generator).mul_(2).sub_(1)
+
+
 def make_pair(x):
     if isinstance(x, int):
         return (x, x)
@@ -7,9 +7,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from Utils import data_gen
-from Utils.common import list_mult
+from Utils.common import list_mult, write_to_log
 from Models.stochastic_layers import StochasticLinear, StochasticConv2d, StochasticLayer
 from Models.layer_inits import init_layers
+from Utils.profiling import get_layer_stats
 
 
 # -------------------------------------------------------------------------------------------
@@ -24,10 +25,12 @@ def get_size_of_conv_output(input_shape, conv_func):
     return conv_out_size
 
 def count_weights(model):
-    # note: don't counts batch-norm parameters
+    # note: don't counts batch-norm parameters,
+    #  in a stochastic model counts only the stochastic layers (the deterministic layers of a semi-stochastic model
+    #  are point estimates, which are not part of the prior / posterior distributions)
     count = 0
     for m in model.modules():
-        if isinstance(m, nn.Conv2d) or isinstance(m, nn.Linear):
+        if (isinstance(m, nn.Conv2d) or isinstance(m, nn.Linear)) and model.model_type != 'Stochastic':
             count += list_mult(m.weight.shape)
             if hasattr(m, 'bias'):
                 count += list_mult(m.bias.shape)
@@ -36,6 +39,98 @@ def count_weights(model):
     return count
 
 
+def get_stochastic_layers_names(model, prm):
+    ''' The names of the layers which are stochastic, by prm.stochastic_layers: a list of layer names
+     (e.g. ['fc1', 'fc_out']), or the number of top layers (e.g. 1 = only the output layer), None = all the layers '''
+    all_names = [layer_name for layer_name, m in model.named_modules() if isinstance(m, StochasticLayer)]
+    layers_spec = prm.stochastic_layers if hasattr(prm, 'stochastic_layers') else None
+    if layers_spec is None:
+        return all_names
+    if isinstance(layers_spec, (list, tuple)) and len(layers_spec) == 1 and str(layers_spec[0]).isdigit():
+        layers_spec = int(layers_spec[0])
+    if isinstance(layers_spec, int):
+        names = all_names[max(len(all_names) - layers_spec, 0):] if layers_spec > 0 else []
+    else:
+        names = list(layers_spec)
+        for layer_name in names:
+            if layer_name not in all_names:
+                raise ValueError('Invalid stochastic layer name: {} (the layers are: {})'.format(
+                    layer_name, ', '.join(all_names)))
+    if not names:
+        raise ValueError('A stochastic model needs at least one stochastic layer')
+    return names
+
+
+def set_deterministic_layers(model, stochastic_names):
+    ''' Replaces the stochastic layers which are not in stochastic_names by standard (deterministic) layers of
+     the same shape '''
+    is_stochastic = []
+    for layer_name, m in list(model.named_modules()):
+        if isinstance(m, StochasticLayer):
+            is_stochastic.append(layer_name in stochastic_names)
+            if layer_name not in stochastic_names:
+                setattr(model, layer_name, get_deterministic_layer(m))
+                model.deterministic_layers += (layer_name,)
+    if hasattr(model, 'layers_names'):
+        model.layers_names = tuple(name for name, keep in zip(model.layers_names, is_stochastic) if keep)
+
+
+def get_deterministic_layer(layer):
+    if isinstance(layer, StochasticLinear):
+        return nn.Linear(layer.in_dim, layer.out_dim, bias=layer.use_bias)
+    elif isinstance(layer, StochasticConv2d):
+        return nn.Conv2d(layer.in_channels, layer.out_channels, layer.kernel_size, stride=layer.stride,
+                         padding=layer.padding, dilation=layer.dilation, bias=layer.use_bias)
+    raise ValueError('Invalid stochastic layer')
+
+
+def is_deterministic_param(model, param_name):
+    return param_name.split('.')[0] in model.deterministic_layers
+
+
+def share_deterministic_layers(prior_model, post_model):
+    ''' Semi-stochastic meta-learning: the posterior uses the deterministic layers of the prior (the same modules),
+     so these layers are learned at the meta level (by the prior's optimizer) from the empirical losses of all the
+     tasks. Returns the parameters of the posterior which are learned per task (without the shared layers) '''
+    for layer_name in prior_model.deterministic_layers:
+        setattr(post_model, layer_name, getattr(prior_model, layer_name))
+    return [param for param_name, param in post_model.named_parameters()
+            if not is_deterministic_param(post_model, param_name)]
+
+
+def fix_deterministic_layers(model):
+    ''' Meta-testing of a semi-stochastic model: the deterministic layers keep the values learned in meta-training
+     (only the stochastic layers are learned for the new task) '''
+    for param_name, param in model.named_parameters():
+        if is_deterministic_param(model, param_name):
+            param.requires_grad_(False)
+
+
+def get_deterministic_state(model):
+    ''' A copy of the weights of the deterministic layers (see deterministic_layers_change) '''
+    return {param_name: param.detach().clone() for param_name, param in model.named_parameters()
+            if is_deterministic_param(model, param_name)}
+
+
+def deterministic_layers_change(model, init_state):
+    ''' The relative (L2) change of the weights of the deterministic layers since init_state was taken
+     (e.g. a check that the deterministic layers of the prior are learned in meta-training) '''
+    params = dict(model.named_parameters())
+    diff_sqr = sum([(params[param_name].detach() - init_param).pow(2).sum() for param_name, init_param in
+                    init_state.items()])
+    init_sqr = sum([init_param.pow(2).sum() for init_param in init_state.values()])
+    return float(torch.sqrt(diff_sqr / init_sqr))
+
+
+def write_deterministic_change(prior_model, init_state, prm):
+    ''' Checks that the deterministic layers of the prior (shared with the posteriors) were learned in meta-training '''
+    change = deterministic_layers_change(prior_model, init_state)
+    write_to_log('Deterministic layers ({}) - relative change in meta-training: {:.4}'.format(
+        ', '.join(prior_model.deterministic_layers), change), prm)
+    if change == 0.0:
+        write_to_log('Warning: the deterministic layers of the prior were not updated in meta-training', prm)
+
+
 #  -------------------------------------------------------------------------------------------
 #  Main function
 #  -------------------------------------------------------------------------------------------
@@ -88,6 +183,10 @@ def get_model(prm, model_type='Stochastic'):
     else:
         raise ValueError('Invalid model_name')
 
+    # Semi-stochastic model: the layers which are not in prm.stochastic_layers are deterministic (point estimates)
+    if model_type == 'Stochastic':
+        set_deterministic_layers(model, get_stochastic_layers_names(model, prm))
+
     # Move model to device (GPU\CPU):
     model.to(prm.device)
     # DEBUG check: [(x[0], x[1].device) for x in model.named_parameters()]
@@ -97,6 +196,13 @@ def get_model(prm, model_type='Stochastic'):
 
     model.weights_count = count_weights(model)
 
+    # The default key of the model's RNG streams (the training loops set a key per task):
+    model.set_rng_key()
+
+    # Per-layer statistics (if enabled):
+    if get_layer_stats() is not None:
+        model.register_layer_stats(get_layer_stats())
+
     # # For debug: set the STD of epsilon variable for re-parametrization trick (default=1.0)
     # if hasattr(prm, 'override_eps_std'):
     #     model.set_eps_std(prm.override_eps_std)  # debug
@@ -108,6 +214,9 @@ def get_model(prm, model_type='Stochastic'):
 #   Base class for all stochastic models
 # -------------------------------------------------------------------------------------------
 class general_model(nn.Module):
+    # the names of the deterministic layers of a semi-stochastic model (see set_deterministic_layers):
+    deterministic_layers = ()
+
     def __init__(self):
         super(general_model, self).__init__()
 
@@ -118,9 +227,75 @@ class general_model(nn.Module):
                 old_eps_std = m.set_eps_std(eps_std)
         return old_eps_std
 
+    def set_noise_type(self, noise_type):
+        ''' Sets the noise type of the re-parametrization trick ('iid' / 'antithetic' / 'qmc') '''
+        old_noise_type = None
+        for m in self.modules():
+            if isinstance(m, StochasticLayer):
+                old_noise_type = m.set_noise_type(noise_type)
+        return old_noise_type
+
+    def set_estimator(self, estimator):
+        ''' Sets the gradient estimator of the stochastic layers ('local_reparam' / 'flipout') '''
+        old_estimator = None
+        for m in self.modules():
+            if isinstance(m, StochasticLayer):
+                old_estimator = m.set_estimator(estimator)
+        return old_estimator
+
+    def reset_noise(self):
+        ''' Starts a new sequence of correlated noise draws (should be called before the Monte-Carlo
+         draws of each batch) '''
+        for m in self.modules():
+            if isinstance(m, StochasticLayer):
+                m.reset_noise()
+
+    def sample_weights(self, n_samples):
+        ''' Pre-samples n_samples concrete weights of each stochastic layer, the forward then uses the sample
+         selected by set_weight_sample (see StochasticLayer.sample_weights), until clear_weight_samples() '''
+        for m in self.modules():
+            if isinstance(m, StochasticLayer):
+                m.sample_weights(n_samples)
+
+    def set_weight_sample(self, i_sample):
+        for m in self.modules():
+            if isinstance(m, StochasticLayer):
+                m.set_weight_sample(i_sample)
+
+    def clear_weight_samples(self):
+        for m in self.modules():
+            if isinstance(m, StochasticLayer):
+                m.clear_weight_samples()
+
+    def set_rng_key(self, *key):
+        ''' Sets the key of the RNG streams of the model's noise (e.g. the task id of a posterior), each layer's
+         stream key is (key, layer name). Used only if RNG streams are enabled (see Utils/rng_streams.py) '''
+        for layer_name, m in self.named_modules():
+            if isinstance(m, StochasticLayer):
+                m.set_rng_key(key + (layer_name,))
+
+    def _dropout(self, x, layer, p=0.5):
+        ''' Dropout of the input of the layer (with the mask drawn from the layer's RNG stream, if used) '''
+        generator = layer.rng_generator('dropout') if isinstance(layer, StochasticLayer) and self.training else None
+        if generator is None:
+            return F.dropout(x, p, training=self.training)
+        mask = x.data.new(x.size()).bernoulli_(1 - p, generator=generator)
+        return x * mask / (1 - p)
+
     def _init_weights(self, log_var_init):
         init_layers(self, log_var_init)
 
+    def register_layer_stats(self, layer_stats):
+        ''' Registers hooks which record the FLOPs, bytes and time of each layer (see Utils.profiling) '''
+        handles = []
+        for layer_name, m in self.named_modules():
+            if isinstance(m, StochasticLayer):
+                m.layer_stats, m.layer_name = layer_stats, layer_name
+                handles += layer_stats.register_layer(layer_name, m, split_paths=True)
+            elif isinstance(m, (nn.Linear, nn.Conv2d, nn.BatchNorm2d)):
+                handles += layer_stats.register_layer(layer_name, m)
+        return handles
+
 
 # -------------------------------------------------------------------------------------------
 # Models collection
@@ -189,7 +364,7 @@ class ConvNet3(general_model):
         x = self._forward_features(x)
         x = x.view(x.size(0), -1)
         x = F.elu(self.fc1(x))
-        x = F.dropout(x, training=self.training)
+        x = self._dropout(x, self.fc_out)
         x = self.fc_out(x)
         return x
 
@@ -331,35 +506,3 @@ class OmConvNet_NoBN_elu(general_model):
         x = x.view(x.size(0), -1)
         x = self.fc_out(x)
         return x
-# # -------------------------------------------------------------------------------------------
-# class ConvNet3SemiStoch(general_model):
-#     def __init__(self, model_type, model_name, linear_layer, conv2d_layer, task_info):
-#         super(ConvNet3SemiStoch, self).__init__()
-#         self.model_type = model_type
-#         self.model_name = model_name
-#         input_shape = task_info['input_shape']
-#         color_channels = input_shape[0]
-#         output_dim = task_info['output_dim']
-#         n_filt1 = 10
-#         n_filt2 = 20
-#         n_hidden_fc1 = 50
-#         self.conv1 = nn.Conv2d(color_channels, n_filt1, kernel_size=5)
-#         self.conv2 = nn.Conv2d(n_filt1, n_filt2, kernel_size=5)
-#         conv_feat_size = get_size_of_conv_output(input_shape, self._forward_features)
-#         self.fc1 = linear_layer(conv_feat_size, n_hidden_fc1)
-#         self.fc_out = linear_layer(n_hidden_fc1, output_dim)
-# 
-#         # self._init_weights(log_var_init)  # Initialize weights
-
-#     def _forward_features(self, x):
-#         x = F.elu(F.max_pool2d(self.conv1(x), 2))
-#         x = F.elu(F.max_pool2d(self.conv2(x), 2))
-#         return x
-# 
-#     def forward(self, x):
-#         x = self._forward_features(x)
-#         x = x.view(x.size(0), -1)
-#         x = F.elu(self.fc1(x))
-#         x = F.dropout(x, training=self.training)
-#         x = self.fc_out(x)
-#         return x
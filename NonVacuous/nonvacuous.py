@@ -14,6 +14,7 @@ from Models.stochastic_models import get_model
 from Utils.Bayes_utils import set_model_values, run_eval_Bayes
 from Utils.complexity_terms import get_net_densities_divergence
 from Utils.data_gen import get_info
+from Utils.eval_cache import init_eval_cache, get_eval_cache
 
 torch.backends.cudnn.benchmark = True  # For speed improvement with models with fixed-length inputs
 
@@ -43,9 +44,36 @@ parser.add_argument('--test-batch-size',type=int,  help='input batch size for te
 parser.add_argument('--n_MC_eval',type=int,  help='number of monte-carlo runs for expected loss estimation and bound evaluation',
                     default=10)
 
+parser.add_argument('--noise_type', type=str,
+                    help="Noise of the re-parametrization trick in training: 'iid' / 'antithetic' / 'qmc'",
+                    default='iid')
+
+parser.add_argument('--noise_type_eval', type=str,
+                    help="Noise of the re-parametrization trick in evaluation: 'iid' / 'antithetic' / 'qmc'",
+                    default='iid')
+
+parser.add_argument('--eval_weight_sampling', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Evaluate the draws from the posterior with concrete weights sampled once per draw and '
+                         'shared by all the batches (plain forward, without the variance path)')
+
+parser.add_argument('--eval_tolerance', type=float,
+                    help='Sequential evaluation of the expected loss: stop the monte-carlo passes when the confidence '
+                         'interval is narrower than +- eval_tolerance (0 = n_MC_eval full passes)',
+                    default=0.0)
+
+parser.add_argument('--eval_confidence', type=float, help='For eval_tolerance: the confidence of the interval',
+                    default=0.95)
+
+parser.add_argument('--eval_cache', default=True, type=lambda x: (str(x).lower() == 'true'),
+                    help='Cache the evaluation results and outputs of the same posterior and data '
+                         '(see Utils/eval_cache.py)')
+
+parser.add_argument('--eval_cache_size', type=int, help='For eval_cache: maximal number of cached evaluations',
+                    default=32)
+
 # ----- Task Parameters ---------------------------------------------#
 
-parser.add_argument('--data-source', type=str, help="Data: 'MNIST' / 'CIFAR10' / Omniglot / SmallImageNet / binarized_MNIST",
+parser.add_argument('--data-source', type=str, help="Data: 'MNIST' / 'CIFAR10' / Omniglot / SmallImageNet / Synthetic / binarized_MNIST",
                     default='MNIST')
 
 parser.add_argument('--data-transform', type=str, help="Data transformation:  'None' / 'Permute_Pixels' / 'Permute_Labels'/ Shuffled_Pixels ",
@@ -55,6 +83,24 @@ parser.add_argument('--limit_train_samples', type=int,
                     help='Upper limit for the number of training samples (0 = unlimited)',
                     default=0)  # 0
 
+# Synthetic data (generated in memory, see Utils/synthetic_data.py):
+parser.add_argument('--synthetic_input_shape', type=int, nargs=3, help='In case of "Synthetic": input shape (C, H, W)',
+                    default=[1, 28, 28])
+
+parser.add_argument('--synthetic_n_classes', type=int, help='In case of "Synthetic": number of classes in a task',
+                    default=10)
+
+parser.add_argument('--synthetic_n_train_samples', type=int,
+                    help='In case of "Synthetic": number of training samples in a task',
+                    default=600)
+
+parser.add_argument('--synthetic_n_test_samples', type=int, help='In case of "Synthetic": number of test samples in a task',
+                    default=100)
+
+parser.add_argument('--synthetic_n_tasks', type=int,
+                    help='In case of "Synthetic": number of distinct tasks in each meta-split (0 = unlimited)',
+                    default=0)
+
 # ----- Algorithm Parameters ---------------------------------------------#
 
 parser.add_argument('--loss-type', type=str, help="Data: 'CrossEntropy' / 'L2_SVM' / Logistic_binary",
@@ -63,6 +109,12 @@ parser.add_argument('--loss-type', type=str, help="Data: 'CrossEntropy' / 'L2_SV
 parser.add_argument('--model-name', type=str, help="Define model type (hypothesis class)'",
                     default='OmConvNet_NoBN')  # OmConvNet / 'FcNet3' / 'ConvNet3' / OmConvNet_NoBN / OmConvNet_NoBN_elu
 
+parser.add_argument('--stochastic_layers', type=str, nargs='+',
+                    help='Semi-stochastic model: the names of the stochastic layers (e.g. fc1 fc_out), or the number '
+                         'of top layers which are stochastic (e.g. 1), the other layers are deterministic '
+                         '(default: all the layers are stochastic)',
+                    default=None)
+
 parser.add_argument('--batch-size', type=int, help='input batch size for training',
                     default=128)
 
@@ -80,6 +132,7 @@ parser.add_argument('--lr', type=float, help='learning rate (initial)',
 
 prm = parser.parse_args()
 prm.device = torch.device("cuda:" + str(prm.gpu_index) if torch.cuda.is_available() else "cpu")
+init_eval_cache(prm)  # before prm is replaced by the loaded parameters
 
 prm.log_var_init = {'mean': -5, 'std': 0.1}  # The initial value for the log-var parameter (rho) of each weight of the posteriror, in case init_from_prior==False
 
@@ -250,6 +303,9 @@ for loss_type in losses:
             write_to_log('\t\tBound: {} =  {:.4}'.
                          format(prt.complexity_type, bound_val), prm)
 
+if get_eval_cache() is not None:
+    print('Evaluation cache: {}'.format(get_eval_cache().summary()))
+
 
 # -------------------------------------------------------------------------------------------
 #  Run standard deterministic learning for comparision
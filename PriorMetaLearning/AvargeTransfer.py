@@ -9,14 +9,12 @@ import numpy as np
 import torch
 import torch.optim as optim
 
-from PriorMetaLearning import meta_test_Bayes, meta_train_Bayes_finite_tasks, meta_train_Bayes_infinite_tasks
+from PriorMetaLearning import meta_test_Bayes, meta_train_Bayes_finite_tasks, meta_train_Bayes_infinite_tasks, \
+    meta_train_Average_Transfer
 from Data_Path import get_data_path
-from Models import stochastic_models, deterministic_models
-from Single_Task import learn_single_standard
+from Models import stochastic_models
 from Utils.data_gen import Task_Generator
 from Utils.common import save_model_state, load_model_state, create_result_dir, set_random_seed, write_to_log
-from torch.nn.utils import parameters_to_vector, vector_to_parameters
-from Models.stochastic_layers import StochasticLayer
 
 torch.backends.cudnn.benchmark = True  # For speed improvement with models with fixed-length inputs
 
@@ -142,34 +140,8 @@ if prm.mode == 'MetaTrain':
     train_data_loaders = task_generator.create_meta_batch(prm, n_train_tasks, meta_split='meta_train')
 
 
-    # Run standard learning for each task and average the parameters:
-    avg_param_vec = None
-    for i_task in range(n_train_tasks):
-        print('Learning train-task {} out of {}'.format(i_task+1, n_train_tasks))
-        data_loader = train_data_loaders[i_task]
-        test_err, curr_model = learn_single_standard.run_learning(data_loader, prm, verbose=0)
-        if i_task == 0:
-            avg_param_vec = parameters_to_vector(curr_model.parameters()) * (1 / n_train_tasks)
-        else:
-            avg_param_vec += parameters_to_vector(curr_model.parameters()) * (1 / n_train_tasks)
-
-    avg_model = deterministic_models.get_model(prm)
-    vector_to_parameters(avg_param_vec, avg_model.parameters())
-
-    # create the prior model:
-    prior_model = stochastic_models.get_model(prm)
-    prior_layers_list = [layer for layer in prior_model.modules() if isinstance(layer, StochasticLayer)]
-    avg_model_layers_list = [layer for layer in avg_model.modules()
-                             if isinstance(layer, torch.nn.Conv2d) or isinstance(layer, torch.nn.Linear)]
-    assert len(avg_model_layers_list)==len(prior_layers_list), "lists not equal"
-
-    for i_layer, prior_layer in enumerate(prior_layers_list):
-        if hasattr(prior_layer, 'w'):
-            prior_layer.w['log_var'] = torch.nn.Parameter(torch.zeros(1, device=prm.device))
-            prior_layer.w['mean'] = avg_model_layers_list[i_layer].weight
-        if hasattr(prior_layer, 'b'):
-            prior_layer.b['log_var'] = torch.nn.Parameter(torch.zeros(1, device=prm.device))
-            prior_layer.b['mean'] = avg_model_layers_list[i_layer].bias
+    # Run standard learning for each task and use the average of the parameters as the prior:
+    prior_model = meta_train_Average_Transfer.run_meta_learning(train_data_loaders, prm)
 
 
     # save learned prior:
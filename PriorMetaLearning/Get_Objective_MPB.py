@@ -2,25 +2,51 @@ from __future__ import absolute_import, division, print_function
 
 import torch
 from Utils import data_gen
-from Utils.complexity_terms import get_task_complexity, get_meta_complexity_term, get_hyper_divergnce
-from Utils.common import count_correct
+from Utils.complexity_terms import get_task_complexity, get_meta_complexity_term, get_hyper_divergnce, \
+    get_complexity_loss_derivative, get_net_densities_divergence
+from Utils.common import count_correct_tensor
+from Utils.profiling import get_profiler
+from Utils.mixed_precision import run_forward_loss
 
 # -------------------------------------------------------------------------------------------
 #
 # -------------------------------------------------------------------------------------------
-def get_objective(prior_model, prm, mb_data_loaders, mb_iterators, mb_posteriors_models, loss_criterion, n_train_tasks):
+def get_objective(prior_model, prm, mb_data_loaders, mb_iterators, mb_posteriors_models, loss_criterion, n_train_tasks,
+                  hyper_dvrg=None, mc_controller=None, prior_stats=None):
     '''  Calculate objective based on tasks in meta-batch '''
     # note: it is OK if some tasks appear several times in the meta-batch
+    # note: hyper_dvrg can be given (e.g. a pre-computed value for a detached prior snapshot),
+    #  otherwise it is calculated from prior_model
+    # note: if prior_stats is given (a PriorGradStats, for a detached prior snapshot), the tasks' divergences are
+    #  registered in it, so the prior's gradient can be accumulated without the prior's graph
+    # note: if mc_controller is given (see Utils/adaptive_MC.py), it sets the number of MC samples instead of prm.n_MC
 
     n_tasks_in_mb = len(mb_data_loaders)
+    profiler = get_profiler()
+
+    # Streamed mode: backpropagate each task's (or MC sample's) contribution right away,
+    #  so only one task's graph is kept alive at a time (see stream_mode())
+    streamed = stream_mode(prm)
 
     correct_count = 0
     sample_count = 0
 
     # Hyper-prior term:
-    hyper_dvrg = get_hyper_divergnce(prm, prior_model)
-    meta_complex_term = get_meta_complexity_term(hyper_dvrg, prm, n_train_tasks)
-
+    with profiler.phase('complexity'):
+        if hyper_dvrg is None:
+            hyper_dvrg = get_hyper_divergnce(prm, prior_model)
+        meta_complex_term = get_meta_complexity_term(hyper_dvrg, prm, n_train_tasks)
+
+    if streamed != 'None':
+        # The hyper-divergence is shared by all tasks, so the tasks' terms are backpropagated into a detached copy,
+        #  and its accumulated gradient is backpropagated into the prior once, at the end.
+        hyper_dvrg_leaf = hyper_dvrg.detach().requires_grad_()
+        # The weights of the empirical loss and of the complexity of each task in the total objective:
+        if prm.complexity_type == 'Variational_Bayes':
+            loss_weight_factor, complexity_weight = n_train_tasks / n_tasks_in_mb, n_train_tasks / n_tasks_in_mb
+        else:
+            loss_weight_factor, complexity_weight = 1 / n_tasks_in_mb, 1 / n_tasks_in_mb
+        complexity_loss_derivative = get_complexity_loss_derivative(prm)
 
     avg_empiric_loss_per_task = torch.zeros(n_tasks_in_mb, device=prm.device)
     complexity_per_task = torch.zeros(n_tasks_in_mb, device=prm.device)
@@ -32,11 +58,12 @@ def get_objective(prior_model, prm, mb_data_loaders, mb_iterators, mb_posteriors
         n_samples = mb_data_loaders[i_task]['n_train_samples']
         n_samples_per_task[i_task] = n_samples
 
-        # get sample-batch data from current task to calculate the empirical loss estimate:
-        batch_data = data_gen.get_next_batch_cyclic(mb_iterators[i_task], mb_data_loaders[i_task]['train'])
+        with profiler.phase('data'):
+            # get sample-batch data from current task to calculate the empirical loss estimate:
+            batch_data = data_gen.get_next_batch_cyclic(mb_iterators[i_task], mb_data_loaders[i_task]['train'])
 
-        # get batch variables:
-        inputs, targets = data_gen.get_batch_vars(batch_data, prm)
+            # get batch variables:
+            inputs, targets = data_gen.get_batch_vars(batch_data, prm)
         batch_size = inputs.shape[0]
 
         # The posterior model corresponding to the task in the batch:
@@ -44,12 +71,27 @@ def get_objective(prior_model, prm, mb_data_loaders, mb_iterators, mb_posteriors
         post_model.train()
 
         # Monte-Carlo iterations:
-        n_MC = prm.n_MC
+        if mc_controller is None:
+            n_MC = prm.n_MC
+        elif i_task == 0:
+            # (the controller probes the gradient variance with the first task of the meta-batch)
+            n_MC = mc_controller.step(post_model, inputs, targets, loss_criterion)
+        else:
+            n_MC = mc_controller.n_MC
 
         avg_empiric_loss = 0.0
         complexity = 0.0
 
+        # In MC-streamed mode, the weight of each MC sample's loss in the total objective:
+        if streamed == 'MC':
+            if prm.complexity_type == 'Variational_Bayes':
+                loss_weight = loss_weight_factor * n_samples
+            else:
+                loss_weight = loss_weight_factor
+            mc_loss_weight = (loss_weight + complexity_weight * complexity_loss_derivative) / n_MC
+
         # Monte-Carlo loop
+        post_model.reset_noise()  # a new sequence of (antithetic / qmc) noise draws for this batch
         for i_MC in range(n_MC):
 
             # Debug
@@ -59,27 +101,66 @@ def get_objective(prior_model, prm, mb_data_loaders, mb_iterators, mb_posteriors
             # plt.show()
 
             # Empirical Loss on current task:
-            outputs = post_model(inputs)
-            avg_empiric_loss_curr = (1 / batch_size) * loss_criterion(outputs, targets)
+            with profiler.phase('forward'):
+                outputs, empiric_loss_curr = run_forward_loss(post_model, inputs, targets, loss_criterion, prm)
+                avg_empiric_loss_curr = (1 / batch_size) * empiric_loss_curr
 
-            correct_count += count_correct(outputs, targets)  # for print
+            correct_count += count_correct_tensor(outputs, targets)  # for print
             sample_count += inputs.size(0)
 
             # Intra-task complexity of current task:
             # curr_complexity = get_task_complexity(prm, prior_model, post_model,
             #     n_samples, avg_empiric_loss_curr, hyper_dvrg, n_train_tasks=n_train_tasks, noised_prior=True)
 
+            if streamed == 'MC':
+                with profiler.phase('backward'):
+                    (mc_loss_weight * avg_empiric_loss_curr).backward()
+                avg_empiric_loss_curr = avg_empiric_loss_curr.detach()
+
             avg_empiric_loss += (1 / n_MC) * avg_empiric_loss_curr
             # complexity +=  (1 / n_MC) * curr_complexity
         # end Monte-Carlo loop
 
-        complexity = get_task_complexity(prm, prior_model, post_model,
-                                         n_samples, avg_empiric_loss, hyper_dvrg,
-                                         n_train_tasks=n_train_tasks, noised_prior=True)
+        with profiler.phase('complexity'):
+            dvrg = None
+            if prior_stats is not None:
+                dvrg = get_net_densities_divergence(prior_model, post_model, prm, noised_prior=True)
+                prior_stats.add_task(post_model, dvrg)
+            if streamed == 'None':
+                complexity = get_task_complexity(prm, prior_model, post_model,
+                                                 n_samples, avg_empiric_loss, hyper_dvrg,
+                                                 n_train_tasks=n_train_tasks, dvrg=dvrg, noised_prior=True)
+            else:
+                complexity = get_task_complexity(prm, prior_model, post_model,
+                                                 n_samples, avg_empiric_loss, hyper_dvrg_leaf,
+                                                 n_train_tasks=n_train_tasks, dvrg=dvrg, noised_prior=True)
+        if streamed != 'None':
+            if streamed == 'Task':
+                if prm.complexity_type == 'Variational_Bayes':
+                    task_objective = loss_weight_factor * n_samples * avg_empiric_loss + complexity_weight * complexity
+                else:
+                    task_objective = loss_weight_factor * avg_empiric_loss + complexity_weight * complexity
+            else:
+                # the empirical loss was already backpropagated (including its effect through the complexity term)
+                task_objective = complexity_weight * complexity
+            if task_objective.requires_grad:
+                with profiler.phase('backward'):
+                    task_objective.backward()
+            avg_empiric_loss, complexity = avg_empiric_loss.detach(), complexity.detach()
+
         avg_empiric_loss_per_task[i_task] = avg_empiric_loss
         complexity_per_task[i_task] = complexity
     # end loop over tasks in meta-batch
 
+    if streamed != 'None':
+        # Backpropagate the meta-complexity term and the tasks' gradients w.r.t. the hyper-divergence:
+        shared_objective = meta_complex_term
+        if hyper_dvrg_leaf.grad is not None:
+            shared_objective = shared_objective + (hyper_dvrg * hyper_dvrg_leaf.grad).sum()
+        if torch.is_tensor(shared_objective) and shared_objective.requires_grad:
+            with profiler.phase('backward'):
+                shared_objective.backward()
+        meta_complex_term = meta_complex_term.detach() if torch.is_tensor(meta_complex_term) else meta_complex_term
 
     # Approximated total objective:
     if prm.complexity_type == 'Variational_Bayes':
@@ -93,8 +174,29 @@ def get_objective(prior_model, prm, mb_data_loaders, mb_iterators, mb_posteriors
         total_objective =\
             avg_empiric_loss_per_task.mean() + complexity_per_task.mean() + meta_complex_term
 
+    # note: the info values are kept on the device (see MetricsAccumulator), to avoid a host synchronization per step
     info = {'sample_count': sample_count, 'correct_count': correct_count,
-                  'avg_empirical_loss': avg_empiric_loss_per_task.mean().item(),
-                  'avg_intra_task_comp': complexity_per_task.mean().item(),
-                  'meta_comp': meta_complex_term.item()}
+                  'avg_empirical_loss': avg_empiric_loss_per_task.mean().detach(),
+                  'avg_intra_task_comp': complexity_per_task.mean().detach(),
+                  'meta_comp': meta_complex_term.detach() if torch.is_tensor(meta_complex_term) else meta_complex_term}
     return total_objective, info
+
+
+# -------------------------------------------------------------------------------------------
+#  Streamed backward mode
+# -------------------------------------------------------------------------------------------
+def stream_mode(prm):
+    ''' The streamed-backward mode of get_objective (prm.streamed_backward):
+     'None' - the objective is returned with its graph, and the caller runs backward() on it.
+     'Task' - each task's contribution is backpropagated right away (the graph of a single task is alive at a time).
+     'MC' - each MC sample's loss is backpropagated right away (the graph of a single forward pass is alive at a time).
+     In the streamed modes, the gradients are accumulated into the parameters' .grad (so the caller should zero them
+     before calling get_objective) and the returned objective is detached.'''
+    mode = prm.streamed_backward if hasattr(prm, 'streamed_backward') else 'None'
+    if mode not in ['None', 'Task', 'MC']:
+        raise ValueError('Invalid streamed_backward')
+    if mode == 'MC' and get_complexity_loss_derivative(prm) is None:
+        # the complexity term is non-linear in the empirical loss, so the weight of each MC sample is only known after
+        # all the samples are drawn - in this case, the MC graphs of a task are kept until the task is backpropagated.
+        mode = 'Task'
+    return mode
@@ -0,0 +1,302 @@
+from __future__ import absolute_import, division, print_function
+
+import gc
+import os
+import random
+import timeit
+import threading
+from copy import deepcopy
+import torch
+import torch.utils.data as data_utils
+
+from Models.stochastic_models import get_model
+from Utils.common import write_to_log
+from Utils.cost_model import estimate_costs
+from Utils.Losses import get_loss_func
+from Utils.adaptive_MC import is_adaptive_MC, get_max_n_MC
+from PriorMetaLearning.Get_Objective_MPB import get_objective, stream_mode
+
+# -------------------------------------------------------------------------------------------
+#  Automatic tuning of the meta-step size under a memory cap
+# -------------------------------------------------------------------------------------------
+# tune() - run before meta-training: probes a few meta-steps of growing configurations (batch_size, meta_batch_size
+#   and n_MC, each up to the value in prm), measures their peak memory and throughput, and sets in prm the largest
+#   configuration which fits prm.memory_cap_mb. Configurations which the cost model (Utils/cost_model.py) predicts
+#   to exceed the cap are not probed.
+# MemoryGuard - a step_callback of the meta-training, which tracks the memory during training and backs off
+#   (see MemoryGuard.back_off) if the memory gets near the cap or keeps growing.
+# The memory is of the device of the run: on GPU - the memory allocated by torch, on CPU - the resident set size
+# (RSS) of the process (so it includes the data sets and everything else in the process).
+
+CAP_MARGIN = 0.9  # the fraction of the cap a configuration may use (the rest is a safety margin)
+TUNED_DIMS = ['batch_size', 'meta_batch_size', 'n_MC']  # the order in which the configuration is grown
+MIN_BATCH_SIZE = 16
+
+
+def get_memory(device):
+    ''' The current memory usage [bytes] '''
+    if device.type == 'cuda':
+        return torch.cuda.memory_allocated(device)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        # not Linux, use the peak RSS instead
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryMonitor(object):
+    ''' Measures the peak memory of a code block (on CPU, by polling the RSS in a background thread) '''
+
+    def __init__(self, device, poll_interval=0.002):
+        self.device, self.poll_interval = device, poll_interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _poll(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, get_memory(self.device))
+            self._stop.wait(self.poll_interval)
+
+    def __enter__(self):
+        self.peak = get_memory(self.device)
+        if self.device.type == 'cuda':
+            if hasattr(torch.cuda, 'reset_max_memory_allocated'):
+                torch.cuda.reset_max_memory_allocated(self.device)
+        else:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._poll)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self.device.type == 'cuda':
+            self.peak = max(self.peak, torch.cuda.max_memory_allocated(self.device))
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, get_memory(self.device))
+
+
+def free_memory(device):
+    gc.collect()
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+
+
+def rebatch_data_loaders(data_loaders, batch_size, prm):
+    ''' The same tasks' data sets, with loaders of another training batch size '''
+    num_workers = prm.num_workers if hasattr(prm, 'num_workers') else 4
+    new_data_loaders = []
+    for data_loader in data_loaders:
+        new_data_loader = dict(data_loader)
+        new_data_loader['train'] = data_utils.DataLoader(data_loader['train'].dataset, batch_size=batch_size,
+                                                         shuffle=True, num_workers=num_workers, pin_memory=True)
+        new_data_loaders.append(new_data_loader)
+    return new_data_loaders
+
+
+# -------------------------------------------------------------------------------------------
+#  Probing a configuration
+# -------------------------------------------------------------------------------------------
+def probe(prm, data_loaders, n_posteriors, n_steps=3):
+    ''' Runs n_steps meta-steps (with the prior, n_posteriors posteriors and their optimizers, as in meta-training).
+     Returns the peak memory [bytes] and the throughput of the steps after the first one '''
+    prm = deepcopy(prm)
+    prm.num_workers = 0  # the probe measures the memory of the training process itself
+    data_loaders = rebatch_data_loaders(data_loaders, prm.batch_size, prm)
+    loss_criterion = get_loss_func(prm)
+    with MemoryMonitor(prm.device) as monitor:
+        prior_model = get_model(prm)
+        posteriors_models = [get_model(prm) for _ in range(n_posteriors)]
+        all_post_param = sum([list(post_model.parameters()) for post_model in posteriors_models], [])
+        posteriors_optimizer = prm.optim_func(all_post_param, **prm.optim_args)
+        prior_optimizer = prm.optim_func(prior_model.parameters(), **prm.optim_args)
+        iterators = [iter(data_loader['train']) for data_loader in data_loaders]
+        n_train_tasks = prm.n_train_tasks if prm.n_train_tasks else len(data_loaders)
+        n_samples = 0
+        for i_step in range(n_steps + 1):
+            if i_step == 1:
+                # the first step is a warm-up (allocations, cuDNN algorithm selection)
+                if prm.device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start_time = timeit.default_timer()
+            task_ids = random.sample(range(n_posteriors), min(prm.meta_batch_size, n_posteriors))
+            posteriors_optimizer.zero_grad()
+            prior_optimizer.zero_grad()
+            total_objective, info = get_objective(prior_model, prm, [data_loaders[i] for i in task_ids],
+                                                  [iterators[i] for i in task_ids],
+                                                  [posteriors_models[i] for i in task_ids],
+                                                  loss_criterion, n_train_tasks)
+            if stream_mode(prm) == 'None':
+                total_objective.backward()
+            posteriors_optimizer.step()
+            prior_optimizer.step()
+            if i_step > 0:
+                n_samples += int(info['sample_count'])
+        if prm.device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = timeit.default_timer() - start_time
+    del prior_model, posteriors_models, posteriors_optimizer, prior_optimizer, iterators
+    free_memory(prm.device)
+    return {'peak_bytes': monitor.peak, 'step_time': elapsed / n_steps, 'samples_per_sec': n_samples / elapsed}
+
+
+def get_config(prm):
+    return {dim: getattr(prm, dim) for dim in TUNED_DIMS}
+
+
+def set_config(prm, config):
+    for dim, value in config.items():
+        setattr(prm, dim, value)
+
+
+# -------------------------------------------------------------------------------------------
+#  Tuning
+# -------------------------------------------------------------------------------------------
+def tune(prm, data_loaders=None, task_generator=None, n_probe_steps=3):
+    ''' Sets in prm the largest configuration of (batch_size, meta_batch_size, n_MC), up to their values in prm,
+     whose meta-steps fit in prm.memory_cap_mb.
+     With adaptive MC, n_MC is tuned up to prm.max_n_MC (the largest n_MC the controller may set), and prm.max_n_MC is
+     set to the tuned n_MC.
+     data_loaders - the training tasks (finite tasks case), or task_generator - to draw probe tasks (infinite case).
+     Returns the data loaders with the tuned batch size (if given) '''
+    cap_bytes = 1e6 * prm.memory_cap_mb
+    max_config = get_config(prm)
+    if is_adaptive_MC(prm):
+        max_config['n_MC'] = max(max_config['n_MC'], get_max_n_MC(prm))
+    if prm.n_train_tasks:
+        max_config['meta_batch_size'] = min(max_config['meta_batch_size'], prm.n_train_tasks)
+        probe_loaders = data_loaders
+    else:
+        probe_loaders = task_generator.create_meta_batch(prm, prm.meta_batch_size, meta_split='meta_train')
+
+    free_memory(prm.device)
+    base_memory = get_memory(prm.device)
+    write_to_log('---- Auto-tuning the meta-step size (memory cap: {:.0f} MB, current usage: {:.0f} MB)'.format(
+        prm.memory_cap_mb, 1e-6 * base_memory), prm)
+
+    probes = []
+
+    def try_config(config):
+        curr_prm = deepcopy(prm)
+        set_config(curr_prm, config)
+        estimated = base_memory + estimate_costs(curr_prm)['meta_train']['peak_bytes']
+        if estimated > CAP_MARGIN * cap_bytes:
+            result = {'fits': False, 'estimated_bytes': estimated}
+        else:
+            # all the training tasks have posteriors (in the infinite tasks case - the tasks of the meta-batch):
+            n_posteriors = prm.n_train_tasks if prm.n_train_tasks else config['meta_batch_size']
+            result = probe(curr_prm, probe_loaders, n_posteriors, n_probe_steps)
+            result['estimated_bytes'] = estimated
+            result['fits'] = result['peak_bytes'] <= CAP_MARGIN * cap_bytes
+        probes.append(dict(result, config=dict(config)))
+        write_to_log('batch_size={batch_size}, meta_batch_size={meta_batch_size}, n_MC={n_MC}: '.format(**config) +
+                     ('peak memory {:.0f} MB, {:.0f} samples/sec'.format(1e-6 * result['peak_bytes'],
+                                                                        result['samples_per_sec'])
+                      if 'peak_bytes' in result else 'not probed') +
+                     ' (estimated {:.0f} MB) - {}'.format(1e-6 * estimated, 'fits' if result['fits'] else 'too large'),
+                     prm)
+        return result['fits']
+
+    # Start from the smallest configuration, and grow each dimension (by doubling) while it fits:
+    config = {'batch_size': min(MIN_BATCH_SIZE, max_config['batch_size']), 'meta_batch_size': 1, 'n_MC': 1}
+    if not try_config(config):
+        write_to_log('Warning: the smallest configuration does not fit the memory cap', prm)
+    else:
+        for dim in TUNED_DIMS:
+            while config[dim] < max_config[dim]:
+                candidate = dict(config)
+                candidate[dim] = min(2 * config[dim], max_config[dim])
+                if not try_config(candidate):
+                    break
+                config = candidate
+
+    init_n_MC = prm.n_MC
+    set_config(prm, config)
+    prm.auto_tune_probes = probes
+    write_to_log('Tuned configuration: batch_size={batch_size}, meta_batch_size={meta_batch_size}, '
+                 'n_MC={n_MC}'.format(**config), prm)
+    if is_adaptive_MC(prm):
+        # the controller sets n_MC, up to the tuned value (and starts from the given n_MC):
+        prm.max_n_MC = config['n_MC']
+        prm.n_MC = min(init_n_MC, config['n_MC'])
+        write_to_log('Adaptive MC: max_n_MC={}'.format(prm.max_n_MC), prm)
+    if data_loaders is not None:
+        return rebatch_data_loaders(data_loaders, prm.batch_size, prm)
+    return None
+
+
+# -------------------------------------------------------------------------------------------
+#  Memory tracking during training
+# -------------------------------------------------------------------------------------------
+class MemoryGuard(object):
+    ''' A step_callback of the meta-training functions, which checks the memory every prm.memory_check_interval
+     meta-steps, and backs off if the usage is above the cap margin, or if it grew in each of the last
+     GROWTH_CHECKS checks (by more than GROWTH_FRACTION of the cap in total) '''
+    GROWTH_CHECKS = 5
+    GROWTH_FRACTION = 0.05
+
+    def __init__(self, prm):
+        self.prm = prm
+        self.cap_bytes = 1e6 * prm.memory_cap_mb
+        self.check_interval = prm.memory_check_interval if hasattr(prm, 'memory_check_interval') else 10
+        self.history = []
+        self.events = []
+        self.exhausted = False
+
+    def __call__(self, i_step, model, info):
+        if i_step % self.check_interval != 0:
+            return False
+        device = self.prm.device
+        if device.type == 'cuda':
+            # the peak since the last check:
+            usage = torch.cuda.max_memory_allocated(device)
+            if hasattr(torch.cuda, 'reset_max_memory_allocated'):
+                torch.cuda.reset_max_memory_allocated(device)
+        else:
+            usage = get_memory(device)
+        self.history = (self.history + [usage])[-(self.GROWTH_CHECKS + 1):]
+        growing = len(self.history) > self.GROWTH_CHECKS and \
+            all(curr > prev for prev, curr in zip(self.history[:-1], self.history[1:])) and \
+            self.history[-1] - self.history[0] > self.GROWTH_FRACTION * self.cap_bytes
+        if usage > CAP_MARGIN * self.cap_bytes or growing:
+            reason = 'usage {:.0f} MB of {:.0f} MB cap'.format(1e-6 * usage, self.prm.memory_cap_mb) + \
+                     (', growing' if growing else '')
+            self.back_off(i_step, reason)
+        return False
+
+    def back_off(self, i_step, reason):
+        ''' Reduces the memory of the next meta-steps, in order: streaming the backward pass (the same gradients),
+         halving n_MC (with adaptive MC - halving the maximal n_MC of the controller, which re-reads it in every step),
+         halving meta_batch_size (the rest of the epoch in progress is split into meta-batches of the new size, so all
+         its tasks' batches are still taken) '''
+        prm = self.prm
+        streamed = stream_mode(prm)
+        if streamed == 'None':
+            prm.streamed_backward = 'Task'
+        elif streamed == 'Task':
+            prm.streamed_backward = 'MC'  # (stream_mode() keeps 'Task' if the complexity term does not allow it)
+        if stream_mode(prm) != streamed:
+            change = 'streamed_backward={}'.format(prm.streamed_backward)
+        elif is_adaptive_MC(prm) and get_max_n_MC(prm) > 1:
+            prm.max_n_MC = get_max_n_MC(prm) // 2
+            prm.n_MC = min(prm.n_MC, prm.max_n_MC)
+            change = 'max_n_MC={}'.format(prm.max_n_MC)
+        elif not is_adaptive_MC(prm) and prm.n_MC > 1:
+            prm.n_MC = prm.n_MC // 2
+            change = 'n_MC={}'.format(prm.n_MC)
+        elif prm.meta_batch_size > 1:
+            prm.meta_batch_size = prm.meta_batch_size // 2
+            change = 'meta_batch_size={}'.format(prm.meta_batch_size)
+        else:
+            if not self.exhausted:
+                write_to_log('Memory guard: {} at step {}, nothing left to back off'.format(reason, i_step), prm)
+            self.exhausted = True
+            return
+        self.events.append({'step': i_step, 'reason': reason, 'change': change})
+        write_to_log('Memory guard: {} at step {}, backing off to {}'.format(reason, i_step, change), prm)
+        self.history = []
+        free_memory(prm.device)
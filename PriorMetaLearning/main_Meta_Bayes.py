@@ -13,6 +13,9 @@ from Utils.common import save_model_state, load_model_state, create_result_dir,
 from Models.stochastic_models import get_model
 from PriorMetaLearning import meta_test_Bayes, meta_train_Bayes_finite_tasks, meta_train_Bayes_infinite_tasks
 from PriorMetaLearning.Analyze_Prior import run_prior_analysis
+from PriorMetaLearning import auto_tune
+from Utils.profiling import init_profiler, get_layer_stats
+from Utils.rng_streams import init_rng_streams
 
 torch.backends.cudnn.benchmark = True  # For speed improvement with models with fixed-length inputs
 # -------------------------------------------------------------------------------------------
@@ -49,7 +52,7 @@ parser.add_argument('--n_test_tasks', type=int,
 
 # ----- Task Parameters ---------------------------------------------#
 
-parser.add_argument('--data-source', type=str, help="Data: 'MNIST' / 'CIFAR10' / Omniglot / SmallImageNet",
+parser.add_argument('--data-source', type=str, help="Data: 'MNIST' / 'CIFAR10' / Omniglot / SmallImageNet / Synthetic",
                     default='MNIST')
 
 parser.add_argument('--n_train_tasks', type=int, help='Number of meta-training tasks (0 = infinite)',
@@ -61,10 +64,34 @@ parser.add_argument('--data-transform', type=str, help="Data transformation:  'N
 parser.add_argument('--n_pixels_shuffles', type=int, help='In case of "Shuffled_Pixels": how many pixels swaps',
                     default=200)
 
+# Synthetic data (generated in memory, see Utils/synthetic_data.py):
+parser.add_argument('--synthetic_input_shape', type=int, nargs=3, help='In case of "Synthetic": input shape (C, H, W)',
+                    default=[1, 28, 28])
+
+parser.add_argument('--synthetic_n_classes', type=int, help='In case of "Synthetic": number of classes in a task',
+                    default=10)
+
+parser.add_argument('--synthetic_n_train_samples', type=int,
+                    help='In case of "Synthetic": number of training samples in a task',
+                    default=600)
+
+parser.add_argument('--synthetic_n_test_samples', type=int, help='In case of "Synthetic": number of test samples in a task',
+                    default=100)
+
+parser.add_argument('--synthetic_n_tasks', type=int,
+                    help='In case of "Synthetic": number of distinct tasks in each meta-split (0 = unlimited)',
+                    default=0)
+
 parser.add_argument('--limit_train_samples_in_test_tasks', type=int,
                     help='Upper limit for the number of training samples in the meta-test tasks (0 = unlimited)',
                     default=0)
 
+parser.add_argument('--num_workers', type=int, help='Number of data loading worker processes per data loader',
+                    default=4)
+
+parser.add_argument('--cache_datasets', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Keep the decoded and transformed samples in memory (effective with num_workers=0)')
+
 # N-Way K-Shot Parameters:
 parser.add_argument('--N_Way', type=int, help='Number of classes in a task (for Omniglot)',
                     default=5)
@@ -107,6 +134,12 @@ parser.add_argument('--loss-type', type=str, help="Loss function",
 parser.add_argument('--model-name', type=str, help="Define model type (hypothesis class)'",
                     default='ConvNet3')  # OmConvNet / 'FcNet3' / 'ConvNet3'
 
+parser.add_argument('--stochastic_layers', type=str, nargs='+',
+                    help='Semi-stochastic model: the names of the stochastic layers (e.g. fc1 fc_out), or the number '
+                         'of top layers which are stochastic (e.g. 1), the other layers are deterministic '
+                         '(default: all the layers are stochastic)',
+                    default=None)
+
 parser.add_argument('--batch-size', type=int, help='input batch size for training',
                     default=128)
 
@@ -117,6 +150,97 @@ parser.add_argument('--n_inner_steps', type=int,
                     help='For infinite tasks case, number of steps for training per meta-batch of tasks',
                     default=50)  #
 
+parser.add_argument('--prior_update_interval', type=int,
+                    help='For infinite tasks case, number of inner steps between prior updates '
+                         '(the prior gradients are accumulated in between)',
+                    default=1)
+
+parser.add_argument('--posterior_steps_per_prior_step', type=int,
+                    help='For finite tasks case, two-time-scale schedule: number of posterior steps per prior step '
+                         '(in between, a detached snapshot of the prior is used, and the statistics of the '
+                         'prior\'s gradient are accumulated)',
+                    default=1)
+
+parser.add_argument('--streamed_backward', type=str,
+                    help="Backpropagate each task's (or MC sample's) contribution right away to cap the meta-step memory:"
+                         " 'None' / 'Task' / 'MC'",
+                    default='None')
+
+parser.add_argument('--n_MC', type=int, help='Number of Monte-Carlo iterations (for each training batch)',
+                    default=1)
+
+parser.add_argument('--adaptive_MC', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Adapt the number of MC samples to the gradient variance (see Utils/adaptive_MC.py)')
+
+parser.add_argument('--MC_target_snr', type=float, help='For adaptive MC: target signal-to-noise ratio of the gradient',
+                    default=1.0)
+
+parser.add_argument('--MC_probe_interval', type=int, help='For adaptive MC: number of steps between variance probes',
+                    default=50)
+
+parser.add_argument('--MC_probe_samples', type=int, help='For adaptive MC: number of extra samples in a probe',
+                    default=4)
+
+parser.add_argument('--max_n_MC', type=int, help='For adaptive MC: maximal number of MC samples',
+                    default=16)
+
+parser.add_argument('--noise_type', type=str,
+                    help="Noise of the re-parametrization trick in training: 'iid' / 'antithetic' / 'qmc'",
+                    default='iid')
+
+parser.add_argument('--noise_type_eval', type=str,
+                    help="Noise of the re-parametrization trick in evaluation: 'iid' / 'antithetic' / 'qmc'",
+                    default='iid')
+
+parser.add_argument('--eval_weight_sampling', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Evaluate the draws from the posterior with concrete weights sampled once per draw and '
+                         'shared by all the batches (plain forward, without the variance path)')
+
+parser.add_argument('--stochastic_estimator', type=str,
+                    help="Gradient estimator of the stochastic layers: 'local_reparam' / 'flipout'",
+                    default='local_reparam')
+
+parser.add_argument('--rng_streams', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Draw the weights noise from counter-based RNG streams per task, step, layer and MC index '
+                         '(reproducible in any order, see Utils/rng_streams.py)')
+
+parser.add_argument('--mixed_precision', type=str,
+                    help="'fp32' / 'bf16' (bf16 autocast of the forward computations, see Utils/mixed_precision.py)",
+                    default='fp32')
+
+parser.add_argument('--compile_forward', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Compile the forward (+ loss) of the models with torch.compile (see Utils/compiled.py)')
+
+parser.add_argument('--compile_cache_limit', type=int,
+                    help='For compile_forward: maximal number of compiled versions of each function',
+                    default=16)
+
+parser.add_argument('--quantize_posteriors', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Int8 post-training quantization of the meta-test posteriors for CPU inference, with the '
+                         'accuracy delta (see Models/quantization.py)')
+
+parser.add_argument('--quantize_ensemble', type=int,
+                    help='For quantize_posteriors: number of networks sampled from each posterior '
+                         '(0 = a single network with the posterior means)',
+                    default=0)
+
+parser.add_argument('--quant_calib_batches', type=int,
+                    help='For quantize_posteriors: number of training batches of each task for the calibration '
+                         '(0 = all)',
+                    default=10)
+
+parser.add_argument('--memory_cap_mb', type=float,
+                    help='Memory cap [MB] of the run on its device (on CPU - of the process RSS), '
+                         'the training backs off if it gets near the cap (0 = no cap)',
+                    default=0)
+
+parser.add_argument('--auto_tune', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Before meta-training, tune batch-size, meta_batch_size and n_MC (up to their given values)'
+                         ' to the largest configuration which fits memory_cap_mb')
+
+parser.add_argument('--memory_check_interval', type=int, help='Number of meta-steps between memory checks',
+                    default=10)
+
 parser.add_argument('--n_meta_test_epochs', type=int, help='number of epochs to train',
                     default=200)  #
 
@@ -133,6 +257,16 @@ parser.add_argument('--divergence_type', type=str, help="",
 
 parser.add_argument('--init_from_prior', default=True, type=lambda x: (str(x).lower() == 'true'))
 
+parser.add_argument('--profile_phases', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Time the phases of the training steps (data / forward / complexity / backward / step)')
+
+parser.add_argument('--profile_layers', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Record the FLOPs, bytes moved and time of each layer (mean and variance paths separately)')
+
+parser.add_argument('--profile_trace_steps', type=int, nargs=2,
+                    help='If given - [first, last] training steps to capture in a torch profiler trace',
+                    default=None)
+
 
 # -------------------------------------------------------------------------------------------
 #  More parameters
@@ -146,9 +280,6 @@ prm.data_path = get_data_path()
 # Weights initialization (for Bayesian net):
 prm.log_var_init = {'mean': -10, 'std': 0.1} # The initial value for the log-var parameter (rho) of each weight
 
-# Number of Monte-Carlo iterations:
-prm.n_MC = 1
-
 #  Define optimizer:
 prm.optim_func, prm.optim_args = optim.Adam,  {'lr': prm.lr}  #'weight_decay': 1e-4
 # prm.optim_func, prm.optim_args = optim.Adam,  {'lr': prm.lr, 'amsgrad': True}  #'weight_decay': 1e-4
@@ -177,6 +308,9 @@ prm.test_type = 'MaxPosterior' # 'MaxPosterior' / 'MajorityVote' / 'AvgVote'
 create_result_dir(prm)
 
 set_random_seed(prm.seed)
+init_rng_streams(prm)
+
+profiler = init_profiler(prm)
 
 
 # path to save the learned meta-parameters
@@ -190,6 +324,9 @@ task_generator = Task_Generator(prm)
 
 start_time = timeit.default_timer()
 
+# Tracks the memory during meta-training, and backs off if it gets near the cap:
+memory_guard = auto_tune.MemoryGuard(prm) if prm.memory_cap_mb else None
+
 if prm.mode == 'MetaTrain':
 
     n_train_tasks = prm.n_train_tasks
@@ -198,9 +335,12 @@ if prm.mode == 'MetaTrain':
         # Generate the data sets of the training tasks:
         write_to_log('--- Generating {} training-tasks'.format(n_train_tasks), prm)
         train_data_loaders = task_generator.create_meta_batch(prm, n_train_tasks, meta_split='meta_train')
+        if prm.auto_tune and prm.memory_cap_mb:
+            train_data_loaders = auto_tune.tune(prm, train_data_loaders)
 
         # Meta-training to learn prior:
-        prior_model = meta_train_Bayes_finite_tasks.run_meta_learning(train_data_loaders, prm)
+        prior_model = meta_train_Bayes_finite_tasks.run_meta_learning(train_data_loaders, prm,
+                                                                      step_callback=memory_guard)
         # save learned prior:
         save_model_state(prior_model, save_path)
         write_to_log('Trained prior saved in ' + save_path, prm)
@@ -209,8 +349,12 @@ if prm.mode == 'MetaTrain':
         write_to_log('---- Infinite train tasks - New training tasks are '
                      'drawn from tasks distribution in each iteration...', prm)
 
+        if prm.auto_tune and prm.memory_cap_mb:
+            auto_tune.tune(prm, task_generator=task_generator)
+
         # Meta-training to learn meta-prior (theta params):
-        prior_model = meta_train_Bayes_infinite_tasks.run_meta_learning(task_generator, prm)
+        prior_model = meta_train_Bayes_infinite_tasks.run_meta_learning(task_generator, prm,
+                                                                        step_callback=memory_guard)
 
 
 elif prm.mode == 'LoadMetaModel':
@@ -247,14 +391,43 @@ test_tasks_data = task_generator.create_meta_batch(prm, n_test_tasks, meta_split
 write_to_log('Meta-Testing with transferred prior....', prm)
 
 test_err_vec = np.zeros(n_test_tasks)
+test_posteriors = []
 for i_task in range(n_test_tasks):
     print('Meta-Testing task {} out of {}...'.format(1+i_task, n_test_tasks))
     task_data = test_tasks_data[i_task]
-    test_err_vec[i_task], _ = meta_test_Bayes.run_learning(task_data, prior_model, prm, init_from_prior, verbose=0)
+    test_err_vec[i_task], post_model = meta_test_Bayes.run_learning(task_data, prior_model, prm, init_from_prior,
+                                                                    verbose=0, task_id=i_task)
+    if prm.quantize_posteriors:
+        test_posteriors.append(post_model)
+
+# Int8 quantization of the posteriors:
+if prm.quantize_posteriors:
+    from Models.quantization import quantize_posteriors, save_quantized_model
+    quantized_models, quant_results = quantize_posteriors(test_posteriors, test_tasks_data, prm,
+                                                          prm.quantize_ensemble, prm.quant_calib_batches)
+    for i_task, quantized_model in enumerate(quantized_models):
+        save_quantized_model(quantized_model, prm,
+                             os.path.join(prm.result_dir, 'quantized_task_{}.pt'.format(i_task)))
+    write_to_log('Int8 posteriors - avg test err: fp32 {:.3}%, int8 {:.3}% (delta {:.3}%), inference speedup {:.2f},'
+                 ' size {:.3} MB -> {:.3} MB'.format(
+                  100 * quant_results['avg_fp32_err'], 100 * quant_results['avg_int8_err'],
+                  100 * quant_results['avg_err_delta'], quant_results['avg_speedup'],
+                  quant_results['avg_fp32_size_mb'], quant_results['avg_int8_size_mb']), prm)
 
 
 # save result
-save_run_data(prm, {'test_err_vec': test_err_vec})
+run_data = {'test_err_vec': test_err_vec}
+if prm.quantize_posteriors:
+    run_data['quantization'] = quant_results
+if prm.profile_phases:
+    run_data['profile'] = profiler.summary()
+if prm.profile_layers:
+    run_data['layer_stats'] = get_layer_stats().summary()
+if hasattr(prm, 'auto_tune_probes'):
+    run_data['auto_tune_probes'] = prm.auto_tune_probes
+if memory_guard is not None:
+    run_data['memory_guard_events'] = memory_guard.events
+save_run_data(prm, run_data)
 
 # -------------------------------------------------------------------------------------------
 #  Print results
@@ -270,6 +443,9 @@ write_to_log('Total runtime: ' +
 write_to_log('----- Final Results: ', prm)
 write_to_log('----- Meta-Testing - Avg test err: {:.3}%, STD: {:.3}%'
              .format(100 * test_err_vec.mean(), 100 * test_err_vec.std()), prm)
+profiler.write_summary(prm)
+if prm.profile_layers:
+    get_layer_stats().write_report(prm)
 
 # -------------------------------------------------------------------------------------------
 #  Compare to standard learning
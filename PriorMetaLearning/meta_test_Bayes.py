@@ -3,15 +3,19 @@ from __future__ import absolute_import, division, print_function
 
 import timeit
 
-from Models.stochastic_models import get_model
+from Models.stochastic_models import get_model, fix_deterministic_layers
 from Utils import common as cmn, data_gen
 from Utils.Bayes_utils import run_eval_Bayes
 from Utils.complexity_terms import get_task_complexity
-from Utils.common import grad_step, count_correct, write_to_log
+from Utils.common import grad_step, count_correct_tensor, write_to_log
 from Utils.Losses import get_loss_func
+from Utils.profiling import get_profiler
+from Utils.adaptive_MC import get_mc_controller
+from Utils.mixed_precision import run_forward
 
 
-def run_learning(task_data, prior_model, prm, init_from_prior=True, verbose=1):
+def run_learning(task_data, prior_model, prm, init_from_prior=True, verbose=1, task_id=None):
+    # note: task_id (optional) is the key of the posterior's RNG streams (if RNG streams are used)
 
     # -------------------------------------------------------------------------------------------
     #  Setting-up
@@ -25,9 +29,12 @@ def run_learning(task_data, prior_model, prm, init_from_prior=True, verbose=1):
 
     # Create posterior model for the new task:
     post_model = get_model(prm)
+    post_model.set_rng_key('meta_test', task_id)
 
     if init_from_prior:
         post_model.load_state_dict(prior_model.state_dict())
+        # the deterministic layers of a semi-stochastic model were learned in meta-training:
+        fix_deterministic_layers(post_model)
 
         # prior_model_dict = prior_model.state_dict()
         # post_model_dict = post_model.state_dict()
@@ -51,6 +58,9 @@ def run_learning(task_data, prior_model, prm, init_from_prior=True, verbose=1):
     #  Get optimizer:
     optimizer = optim_func(post_model.parameters(), **optim_args)
 
+    # Adaptive number of MC samples (if prm.adaptive_MC):
+    mc_controller = get_mc_controller(prm, verbose)
+
 
     # -------------------------------------------------------------------------------------------
     #  Training epoch  function
@@ -61,25 +71,33 @@ def run_learning(task_data, prior_model, prm, init_from_prior=True, verbose=1):
 
         post_model.train()
 
+        # the metrics are kept on the device, and moved to the host only when printed:
+        metrics = cmn.MetricsAccumulator()
+        profiler = get_profiler()
+
         for batch_idx, batch_data in enumerate(train_loader):
 
             # get batch data:
-            inputs, targets = data_gen.get_batch_vars(batch_data, prm)
+            with profiler.phase('data'):
+                inputs, targets = data_gen.get_batch_vars(batch_data, prm)
             batch_size = inputs.shape[0]
 
             correct_count = 0
             sample_count = 0
 
             # Monte-Carlo iterations:
-            n_MC = prm.n_MC
+            n_MC = prm.n_MC if mc_controller is None else mc_controller.step(post_model, inputs, targets,
+                                                                             loss_criterion)
             avg_empiric_loss = 0
             complexity_term = 0
 
+            post_model.reset_noise()  # a new sequence of (antithetic / qmc) noise draws for this batch
             for i_MC in range(n_MC):
 
                 # Calculate empirical loss:
-                outputs = post_model(inputs)
-                avg_empiric_loss_curr = (1 / batch_size) * loss_criterion(outputs, targets)
+                with profiler.phase('forward'):
+                    outputs = run_forward(post_model, inputs, prm)
+                    avg_empiric_loss_curr = (1 / batch_size) * loss_criterion(outputs, targets)
 
                 # complexity_curr = get_task_complexity(prm, prior_model, post_model,
                 #                                            n_train_samples, avg_empiric_loss_curr)
@@ -87,11 +105,12 @@ def run_learning(task_data, prior_model, prm, init_from_prior=True, verbose=1):
                 avg_empiric_loss += (1 / n_MC) * avg_empiric_loss_curr
                 # complexity_term += (1 / n_MC) * complexity_curr
 
-                correct_count += count_correct(outputs, targets)
+                correct_count += count_correct_tensor(outputs, targets)
                 sample_count += inputs.size(0)
             # end monte-carlo loop
 
-            complexity_term = get_task_complexity(prm, prior_model, post_model,  n_train_samples, avg_empiric_loss)
+            with profiler.phase('complexity'):
+                complexity_term = get_task_complexity(prm, prior_model, post_model,  n_train_samples, avg_empiric_loss)
 
             # Approximated total objective (for current batch):
             if prm.complexity_type == 'Variational_Bayes':
@@ -102,15 +121,22 @@ def run_learning(task_data, prior_model, prm, init_from_prior=True, verbose=1):
                 total_objective = avg_empiric_loss + complexity_term
 
             # Take gradient step with the posterior:
-            grad_step(total_objective, optimizer, lr_schedule, prm.lr, i_epoch)
+            with profiler.phase('backward_and_step'):
+                grad_step(total_objective, optimizer, lr_schedule, prm.lr, i_epoch)
+            profiler.step()
+
 
+            metrics.add_dict({'objective': total_objective, 'avg_empirical_loss': avg_empiric_loss,
+                              'complexity': complexity_term, 'correct_count': correct_count,
+                              'sample_count': sample_count})
 
-            # Print status:
+            # Print status (averages since the last print):
             if batch_idx % log_interval == 0:
-                batch_acc = correct_count / sample_count
-                print(cmn.status_string(i_epoch, prm.n_meta_test_epochs, batch_idx, n_batches, batch_acc, total_objective.item()) +
+                means, sums = metrics.reduce()
+                batch_acc = sums['correct_count'] / sums['sample_count']
+                print(cmn.status_string(i_epoch, prm.n_meta_test_epochs, batch_idx, n_batches, batch_acc, means['objective']) +
                       ' Empiric Loss: {:.4}\t Intra-Comp. {:.4}'.
-                      format(avg_empiric_loss.item(), complexity_term.item()))
+                      format(means['avg_empirical_loss'], means['complexity']))
         # end batch loop
     # end run_train_epoch()
 
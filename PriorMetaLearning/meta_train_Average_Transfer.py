@@ -0,0 +1,67 @@
+from __future__ import absolute_import, division, print_function
+
+import torch
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+
+from Models import stochastic_models, deterministic_models
+from Models.stochastic_layers import StochasticLayer
+from Single_Task import learn_single_standard
+
+
+# -------------------------------------------------------------------------------------------
+#  Learning function
+# -------------------------------------------------------------------------------------------
+def run_meta_learning(train_data_loaders, prm, step_callback=None):
+    ''' Average transfer: run standard learning for each training task, and use the average of the learned
+     weights as the means of the prior.
+     step_callback (optional) - called after each task is learned as step_callback(i_step, prior_model, info),
+     with the prior of the tasks learned so far (i_step is the total number of gradient steps,
+     info['sample_count'] the number of training samples processed for the task),
+     if it returns True the training is stopped (and the prior is of the tasks learned so far) '''
+
+    n_train_tasks = len(train_data_loaders)
+
+    # Run standard learning for each task and average the parameters:
+    sum_param_vec = None
+    i_step = 0
+    n_learned_tasks = 0
+    for i_task in range(n_train_tasks):
+        print('Learning train-task {} out of {}'.format(i_task+1, n_train_tasks))
+        data_loader = train_data_loaders[i_task]
+        test_err, curr_model = learn_single_standard.run_learning(data_loader, prm, verbose=0)
+        if i_task == 0:
+            sum_param_vec = parameters_to_vector(curr_model.parameters()).detach()
+        else:
+            sum_param_vec += parameters_to_vector(curr_model.parameters()).detach()
+        n_learned_tasks += 1
+        i_step += prm.num_epochs * len(data_loader['train'])
+
+        if step_callback is not None:
+            info = {'sample_count': prm.num_epochs * data_loader['n_train_samples']}
+            prior_model = get_prior_from_average(sum_param_vec * (1 / n_learned_tasks), prm)
+            if step_callback(i_step, prior_model, info):
+                break
+
+    return get_prior_from_average(sum_param_vec * (1 / n_learned_tasks), prm)
+
+
+def get_prior_from_average(avg_param_vec, prm):
+    ''' Creates a stochastic prior model with the averaged weights as means '''
+    avg_model = deterministic_models.get_model(prm)
+    vector_to_parameters(avg_param_vec, avg_model.parameters())
+
+    # create the prior model:
+    prior_model = stochastic_models.get_model(prm)
+    prior_layers_list = [layer for layer in prior_model.modules() if isinstance(layer, StochasticLayer)]
+    avg_model_layers_list = [layer for layer in avg_model.modules()
+                             if isinstance(layer, torch.nn.Conv2d) or isinstance(layer, torch.nn.Linear)]
+    assert len(avg_model_layers_list)==len(prior_layers_list), "lists not equal"
+
+    for i_layer, prior_layer in enumerate(prior_layers_list):
+        if hasattr(prior_layer, 'w'):
+            prior_layer.w['log_var'] = torch.nn.Parameter(torch.zeros(1, device=prm.device))
+            prior_layer.w['mean'] = avg_model_layers_list[i_layer].weight
+        if hasattr(prior_layer, 'b'):
+            prior_layer.b['log_var'] = torch.nn.Parameter(torch.zeros(1, device=prm.device))
+            prior_layer.b['mean'] = avg_model_layers_list[i_layer].bias
+    return prior_model
@@ -3,20 +3,28 @@ from __future__ import absolute_import, division, print_function
 
 import timeit
 import random, math
+from copy import deepcopy
 import numpy as np
-from Models.stochastic_models import get_model
+from Models.stochastic_models import get_model, share_deterministic_layers, get_deterministic_state, \
+    write_deterministic_change
 from Utils import common as cmn
 from Utils.Bayes_utils import run_eval_Bayes
-from Utils.common import grad_step, write_to_log
+from Utils.common import write_to_log, accumulated_grad_step
 from Utils.Losses import get_loss_func
-from PriorMetaLearning.Get_Objective_MPB import get_objective
+from Utils.complexity_terms import get_hyper_divergnce, PriorGradStats
+from Utils.profiling import get_profiler, sync_timer
+from Utils.adaptive_MC import get_mc_controller
+from PriorMetaLearning.Get_Objective_MPB import get_objective, stream_mode
 
 # -------------------------------------------------------------------------------------------
 #  Learning function
 # -------------------------------------------------------------------------------------------
 
 
-def run_meta_learning(data_loaders, prm):
+def run_meta_learning(data_loaders, prm, step_callback=None):
+    ''' Meta-training with a finite set of tasks.
+     step_callback (optional) - called after each meta-step as step_callback(i_step, prior_model, info),
+     if it returns True the training is stopped (e.g. when a time budget is exhausted) '''
 
     # -------------------------------------------------------------------------------------------
     #  Setting-up
@@ -34,17 +42,46 @@ def run_meta_learning(data_loaders, prm):
 
     # Create posterior models for each task:
     posteriors_models = [get_model(prm) for _ in range(n_train_tasks)]
+    for task_id, post_model in enumerate(posteriors_models):
+        post_model.set_rng_key('meta_train', task_id)  # (if RNG streams are used, see Utils/rng_streams.py)
 
     # Create a 'dummy' model to generate the set of parameters of the shared prior:
     prior_model = get_model(prm)
 
-    # Gather all tasks posterior params:
-    all_post_param = sum([list(posterior_model.parameters()) for posterior_model in posteriors_models], [])
-
-    # Create optimizer for all parameters (posteriors + prior)
-    prior_params = list(prior_model.parameters())
-    all_params = all_post_param + prior_params
-    all_optimizer = optim_func(all_params, **optim_args)
+    # Gather all tasks posterior params
+    # (the deterministic layers of a semi-stochastic model are shared with the prior, and learned with it):
+    all_post_param = sum([share_deterministic_layers(prior_model, posterior_model)
+                          for posterior_model in posteriors_models], [])
+    init_deterministic = get_deterministic_state(prior_model)
+
+    # Create optimizers for the posteriors and for the prior
+    # (note: since the optimizer state is per-parameter, this is the same as one optimizer for all parameters)
+    posteriors_optimizer = optim_func(all_post_param, **optim_args)
+    prior_optimizer = optim_func(prior_model.parameters(), **optim_args)
+
+    # Adaptive number of MC samples (if prm.adaptive_MC):
+    mc_controller = get_mc_controller(prm)
+
+    # Two-time-scale schedule: the posteriors take a step in every meta-step, and the prior in every k-th meta-step.
+    # In the k-1 steps in between, the objective is computed with a detached snapshot of the prior (so the prior's
+    # graph and gradient are skipped entirely), and the statistics which determine the prior's gradient are accumulated
+    # (see PriorGradStats), so the prior update is with the gradients of all the k meta-batches.
+    k_steps = prm.posterior_steps_per_prior_step if hasattr(prm, 'posterior_steps_per_prior_step') else 1
+    prior_accumulation = {'n_accumulated': 0}
+    prior_stats = PriorGradStats(prm)
+    prior_snapshot = {'model': None, 'hyper_dvrg': None}
+    if k_steps > 1:
+        prior_snapshot['model'] = deepcopy(prior_model)
+        for param in prior_snapshot['model'].parameters():
+            param.requires_grad_(False)
+        prior_snapshot['hyper_dvrg'] = get_hyper_divergnce(prm, prior_snapshot['model'])
+
+    # Time and objective statistics of the step types, for the report
+    # ('prior_sync' - the prior's gradient from the accumulated statistics, and the refresh of the snapshot):
+    schedule_stats = {'full': {'count': 0, 'time': 0.0}, 'posterior_only': {'count': 0, 'time': 0.0},
+                      'prior_sync': {'count': 0, 'time': 0.0}}
+    epochs_objective = []
+    training_state = {'stop': False}
 
     # number of sample-batches in each task:
     n_batch_list = [len(data_loader['train']) for data_loader in data_loaders]
@@ -52,6 +89,24 @@ def run_meta_learning(data_loaders, prm):
     n_batches_per_task = np.max(n_batch_list)
 
 
+    def prior_step(i_epoch):
+        # a step of the prior with the gradients accumulated since its last step (averaged),
+        #  the gradients of the posterior-only steps are backpropagated from their statistics:
+        sync_start_time = sync_timer(prm)
+        prior_stats.backward(prior_model)
+        sync_time = sync_timer(prm) - sync_start_time
+        accumulated_grad_step(prior_optimizer, prior_accumulation['n_accumulated'], lr_schedule, prm.lr, i_epoch)
+        prior_accumulation['n_accumulated'] = 0
+        if prior_snapshot['model'] is not None:
+            # refresh the snapshot which is used until the next prior update:
+            sync_start_time = sync_timer(prm)
+            prior_snapshot['model'].load_state_dict(prior_model.state_dict())
+            prior_snapshot['hyper_dvrg'] = get_hyper_divergnce(prm, prior_snapshot['model'])
+            sync_time += sync_timer(prm) - sync_start_time
+        schedule_stats['prior_sync']['count'] += 1
+        schedule_stats['prior_sync']['time'] += sync_time
+        return sync_time
+
     # -------------------------------------------------------------------------------------------
     #  Training epoch  function
     # -------------------------------------------------------------------------------------------
@@ -76,13 +131,28 @@ def run_meta_learning(data_loaders, prm):
         # ----------- meta-batches loop (batches of tasks) -----------------------------------#
         # each meta-batch includes several tasks
         # we take a grad step with theta after each meta-batch
-        meta_batch_starts = list(range(0, len(task_order), prm.meta_batch_size))
+        meta_batch_size = prm.meta_batch_size
+        meta_batch_starts = list(range(0, len(task_order), meta_batch_size))
         n_meta_batches = len(meta_batch_starts)
 
-        for i_meta_batch in range(n_meta_batches):
+        # the metrics are kept on the device, and moved to the host only when printed:
+        metrics = cmn.MetricsAccumulator()
+        epoch_metrics = cmn.MetricsAccumulator()
+        profiler = get_profiler()
+
+        i_meta_batch = 0
+        while i_meta_batch < n_meta_batches:
+
+            if prm.meta_batch_size != meta_batch_size:
+                # the meta-batch size was changed during the epoch (e.g. by the memory guard, see auto_tune.py),
+                # the rest of the epoch's task order is split into meta-batches of the new size:
+                meta_batch_size = prm.meta_batch_size
+                meta_batch_starts = meta_batch_starts[:i_meta_batch] + \
+                    list(range(meta_batch_starts[i_meta_batch], len(task_order), meta_batch_size))
+                n_meta_batches = len(meta_batch_starts)
 
             meta_batch_start = meta_batch_starts[i_meta_batch]
-            task_ids_in_meta_batch = task_order[meta_batch_start: (meta_batch_start + prm.meta_batch_size)]
+            task_ids_in_meta_batch = task_order[meta_batch_start: (meta_batch_start + meta_batch_size)]
             # meta-batch size may be less than  prm.meta_batch_size at the last one
             # note: it is OK if some tasks appear several times in the meta-batch
 
@@ -94,23 +164,67 @@ def run_meta_learning(data_loaders, prm):
             # # prior_weight = 1 - math.exp(-i_step/prior_weight_steps)
             # prior_weight = min(i_step / prior_weight_steps, 1.0)
             i_step += 1
-
-            # Get objective based on tasks in meta-batch:
-            total_objective, info = get_objective(prior_model, prm, mb_data_loaders,
-                                                  mb_iterators, mb_posteriors_models, loss_criterion, n_train_tasks)
-
-            # Take gradient step with the shared prior and all tasks' posteriors:
-            grad_step(total_objective, all_optimizer, lr_schedule, prm.lr, i_epoch)
-
-            # Print status:
+            # the prior is updated in the last of each k steps:
+            update_prior = (prior_accumulation['n_accumulated'] == k_steps - 1)
+            step_start_time = sync_timer(prm)
+
+            # note: zero the gradients before the objective is computed, since in streamed mode
+            #  it already accumulates the gradients (the prior gradients are accumulated until the prior is updated)
+            posteriors_optimizer.zero_grad()
+            if prior_accumulation['n_accumulated'] == 0:
+                prior_optimizer.zero_grad()
+
+            if update_prior:
+                # Get objective based on tasks in meta-batch:
+                total_objective, info = get_objective(prior_model, prm, mb_data_loaders,
+                                                      mb_iterators, mb_posteriors_models, loss_criterion, n_train_tasks,
+                                                      mc_controller=mc_controller)
+            else:
+                # Get objective with the detached prior snapshot (posterior-only step),
+                #  the gradient w.r.t. the hyper-divergence is kept for the prior's statistics:
+                hyper_dvrg = prior_snapshot['hyper_dvrg'].detach().requires_grad_()
+                total_objective, info = get_objective(prior_snapshot['model'], prm, mb_data_loaders, mb_iterators,
+                                                      mb_posteriors_models, loss_criterion, n_train_tasks,
+                                                      hyper_dvrg=hyper_dvrg, mc_controller=mc_controller,
+                                                      prior_stats=prior_stats)
+
+            # Take gradient step with all tasks' posteriors, and with the shared prior in every k-th step:
+            if stream_mode(prm) == 'None':
+                with profiler.phase('backward'):
+                    total_objective.backward()
+            if not update_prior:
+                prior_stats.collect(hyper_dvrg)
+            with profiler.phase('optimizer_step'):
+                accumulated_grad_step(posteriors_optimizer, 1, lr_schedule, prm.lr, i_epoch)
+                prior_accumulation['n_accumulated'] += 1
+                sync_time = prior_step(i_epoch) if update_prior else 0.0
+
+            profiler.step()
+            # (the time of the full step, without the prior's synchronization, is the time of a step with k=1)
+            step_type = 'full' if update_prior else 'posterior_only'
+            schedule_stats[step_type]['count'] += 1
+            schedule_stats[step_type]['time'] += sync_timer(prm) - step_start_time - sync_time
+            epoch_metrics.add('objective', total_objective)
+            metrics.add('objective', total_objective)
+            metrics.add_dict(info)
+
+            # Print status (averages since the last print):
             log_interval = 200
             if i_meta_batch % log_interval == 0:
-                batch_acc = info['correct_count'] / info['sample_count']
+                means, sums = metrics.reduce()
+                batch_acc = sums['correct_count'] / sums['sample_count']
                 print(cmn.status_string(i_epoch,  prm.n_meta_train_epochs, i_meta_batch,
-                                        n_meta_batches, batch_acc, total_objective.item()) +
+                                        n_meta_batches, batch_acc, means['objective']) +
                       ' Empiric-Loss: {:.4}\t Task-Comp. {:.4}\t Meta-Comp.: {:.4}\t'.
-                      format(info['avg_empirical_loss'], info['avg_intra_task_comp'], info['meta_comp']))
+                      format(means['avg_empirical_loss'], means['avg_intra_task_comp'], means['meta_comp']))
+
+            if step_callback is not None and step_callback(i_step, prior_model, info):
+                training_state['stop'] = True
+                break
+            i_meta_batch += 1
         # end  meta-batches loop
+        epoch_means, _ = epoch_metrics.reduce()
+        epochs_objective.append(epoch_means['objective'])
         return i_step
     # end run_epoch()
 
@@ -157,9 +271,19 @@ def run_meta_learning(data_loaders, prm):
     # Training loop:
     for i_epoch in range(prm.n_meta_train_epochs):
         i_step = run_train_epoch(i_epoch, i_step)
+        if training_state['stop']:
+            break
+    if prior_accumulation['n_accumulated']:
+        # take the prior step with the gradients accumulated so far (of posterior-only steps):
+        prior_step(i_epoch)
+    if init_deterministic:
+        write_deterministic_change(prior_model, init_deterministic, prm)
 
     stop_time = timeit.default_timer()
 
+    if k_steps > 1:
+        write_schedule_report(schedule_stats, epochs_objective, k_steps, prm)
+
     # Test:
     test_acc_avg = run_test()
 
@@ -170,3 +294,22 @@ def run_meta_learning(data_loaders, prm):
     return prior_model
 
 
+# -------------------------------------------------------------------------------------------
+#  Two-time-scale schedule report
+# -------------------------------------------------------------------------------------------
+def write_schedule_report(schedule_stats, epochs_objective, k_steps, prm):
+    ''' Report the throughput of the posterior and prior steps, the estimated speedup over updating the prior in every
+     step (k=1, in which all the steps are full steps), and the objective per epoch (convergence)'''
+    full, post_only, prior_sync = schedule_stats['full'], schedule_stats['posterior_only'], schedule_stats['prior_sync']
+    total_time = full['time'] + post_only['time'] + prior_sync['time']
+    n_steps = full['count'] + post_only['count']
+    avg_full_time = full['time'] / max(full['count'], 1)
+    avg_post_time = post_only['time'] / max(post_only['count'], 1)
+    write_to_log('---- Two-time-scale schedule: {} posterior steps per prior step'.format(k_steps), prm)
+    write_to_log('Full steps: {}, avg time {:.4} [sec]\t Posterior-only steps: {}, avg time {:.4} [sec]\t '
+                 'Prior synchronization: {}, avg time {:.4} [sec]'.format(
+                  full['count'], avg_full_time, post_only['count'], avg_post_time, prior_sync['count'],
+                  prior_sync['time'] / max(prior_sync['count'], 1)), prm)
+    write_to_log('Posterior steps/sec: {:.4}\t Prior steps/sec: {:.4}\t Speedup over k=1 (estimated): {:.3}x'.format(
+        n_steps / total_time, prior_sync['count'] / total_time, n_steps * avg_full_time / total_time), prm)
+    write_to_log('Average objective per epoch: ' + ', '.join(['{:.4}'.format(v) for v in epochs_objective]), prm)
@@ -2,12 +2,15 @@
 from __future__ import absolute_import, division, print_function
 
 import timeit
-from Models.stochastic_models import get_model
+from Models.stochastic_models import get_model, share_deterministic_layers, get_deterministic_state, \
+    write_deterministic_change
 from Utils import common as cmn
 from Utils.Bayes_utils import  run_eval_Bayes
-from Utils.common import grad_step, write_to_log
+from Utils.common import write_to_log, accumulated_grad_step
 from Utils.Losses import get_loss_func
-from PriorMetaLearning.Get_Objective_MPB import get_objective
+from Utils.profiling import get_profiler
+from Utils.adaptive_MC import get_mc_controller
+from PriorMetaLearning.Get_Objective_MPB import get_objective, stream_mode
 
 
 # -------------------------------------------------------------------------------------------
@@ -15,7 +18,10 @@ from PriorMetaLearning.Get_Objective_MPB import get_objective
 # -------------------------------------------------------------------------------------------
 
 
-def run_meta_learning(task_generator, prm):
+def run_meta_learning(task_generator, prm, step_callback=None):
+    ''' Meta-training with a new meta-batch of tasks drawn in each meta-iteration.
+     step_callback (optional) - called after each inner step as step_callback(i_step, prior_model, info),
+     if it returns True the training is stopped '''
 
     # -------------------------------------------------------------------------------------------
     #  Setting-up
@@ -27,6 +33,14 @@ def run_meta_learning(task_generator, prm):
     # Create a 'dummy' model to generate the set of parameters of the shared prior:
     prior_model = get_model(prm)
 
+    # The prior optimizer is kept for the whole run (and not re-created in each meta-iteration),
+    # so its state (e.g. Adam moments) accumulates over the stream of tasks:
+    prior_optimizer = optim_func(prior_model.parameters(), **optim_args)
+    init_deterministic = get_deterministic_state(prior_model)
+
+    # Adaptive number of MC samples (if prm.adaptive_MC), kept for the whole run:
+    mc_controller = get_mc_controller(prm)
+
     meta_batch_size = prm.meta_batch_size
 
     n_meta_iterations = prm.n_meta_train_epochs
@@ -47,14 +61,21 @@ def run_meta_learning(task_generator, prm):
 
     # Training loop:
     test_acc_avg = 0.0
+    training_state = {'i_step': 0, 'stop': False}
     for i_iter in range(n_meta_iterations):
-        prior_model, posteriors_models, test_acc_avg = run_meta_iteration(i_iter, prior_model, task_generator, prm)
+        prior_model, posteriors_models, test_acc_avg = run_meta_iteration(i_iter, prior_model, prior_optimizer,
+                                                                          task_generator, prm, step_callback,
+                                                                          training_state, mc_controller)
+        if training_state['stop']:
+            break
 
     # Note: test_acc_avg is the last checked test error in a meta-training batch
     #  (not the final evaluation which is done on the meta-test tasks)
 
     stop_time = timeit.default_timer()
 
+    if init_deterministic:
+        write_deterministic_change(prior_model, init_deterministic, prm)
 
     # Update Log file:
     cmn.write_final_result(test_acc_avg, stop_time - start_time, prm, result_name=prm.test_type)
@@ -65,9 +86,12 @@ def run_meta_learning(task_generator, prm):
 # -------------------------------------------------------------------------------------------
 #  Training epoch  function
 # -------------------------------------------------------------------------------------------
-def run_meta_iteration(i_iter, prior_model, task_generator, prm):
+def run_meta_iteration(i_iter, prior_model, prior_optimizer, task_generator, prm, step_callback=None,
+                       training_state=None, mc_controller=None):
     # In each meta-iteration we draw a meta-batch of several tasks
-    # Then we take a grad step with prior.
+    # Then we take grad steps with the posteriors and with the prior.
+    # The posteriors are updated in every inner step, the prior in every prm.prior_update_interval steps
+    # (with the gradients accumulated over the interval).
 
     # Unpack parameters:
     optim_func, optim_args, lr_schedule = \
@@ -78,6 +102,7 @@ def run_meta_iteration(i_iter, prior_model, task_generator, prm):
     meta_batch_size = prm.meta_batch_size
     n_inner_steps =  prm.n_inner_steps
     n_meta_iterations = prm.n_meta_train_epochs
+    prior_update_interval = prm.prior_update_interval if hasattr(prm, 'prior_update_interval') else 1
 
     # Generate the data sets of the training-tasks for meta-batch:
     mb_data_loaders = task_generator.create_meta_batch(prm, meta_batch_size, meta_split='meta_train')
@@ -92,35 +117,72 @@ def run_meta_iteration(i_iter, prior_model, task_generator, prm):
     if init_from_prior:
         for post_model in posteriors_models:
             post_model.load_state_dict(prior_model.state_dict())
+    for i_task, post_model in enumerate(posteriors_models):
+        post_model.set_rng_key('meta_train', i_iter, i_task)  # (if RNG streams are used, see Utils/rng_streams.py)
 
 
 
-    # Gather all tasks posterior params:
-    all_post_param = sum([list(posterior_model.parameters()) for posterior_model in posteriors_models], [])
-
-    # Create optimizer for all parameters (posteriors + prior)
-    prior_params = list(prior_model.parameters())
-    all_params = all_post_param + prior_params
-    all_optimizer = optim_func(all_params, **optim_args)
-    # all_optimizer = optim_func(prior_params, **optim_args) ## DeBUG
+    # Gather all tasks posterior params
+    # (the deterministic layers of a semi-stochastic model are shared with the prior, and learned with it):
+    all_post_param = sum([share_deterministic_layers(prior_model, posterior_model)
+                          for posterior_model in posteriors_models], [])
 
+    # Create a short-lived optimizer for the posteriors of the current meta-batch
+    # (the prior optimizer is given, and keeps its state between meta-iterations):
+    posteriors_optimizer = optim_func(all_post_param, **optim_args)
 
     test_acc_avg = 0.0
+    n_accumulated = 0
+    # the metrics are kept on the device, and moved to the host only when printed:
+    metrics = cmn.MetricsAccumulator()
+    profiler = get_profiler()
     for i_inner_step in range(n_inner_steps):
+        # note: zero the gradients before the objective is computed, since in streamed mode it already
+        #  accumulates the gradients (the prior gradients are accumulated until the prior is updated)
+        posteriors_optimizer.zero_grad()
+
         # Get objective based on tasks in meta-batch:
         total_objective, info = get_objective(prior_model, prm, mb_data_loaders, mb_iterators,
-                                              posteriors_models, loss_criterion, prm.n_train_tasks)
-
-        # Take gradient step with the meta-parameters (theta) based on validation data:
-        grad_step(total_objective, all_optimizer, lr_schedule, prm.lr, i_iter)
-
-        # Print status:
+                                              posteriors_models, loss_criterion, prm.n_train_tasks,
+                                              mc_controller=mc_controller)
+
+        # Take gradient step with the posteriors, the prior gradients are accumulated:
+        if stream_mode(prm) == 'None':
+            with profiler.phase('backward'):
+                total_objective.backward()
+        with profiler.phase('optimizer_step'):
+            accumulated_grad_step(posteriors_optimizer, 1, lr_schedule, prm.lr, i_iter)
+        n_accumulated += 1
+
+        # Take gradient step with the prior (always done in the last inner step, so no gradients are left over):
+        if n_accumulated == prior_update_interval or i_inner_step == n_inner_steps - 1:
+            with profiler.phase('optimizer_step'):
+                accumulated_grad_step(prior_optimizer, n_accumulated, lr_schedule, prm.lr, i_iter)
+            prior_optimizer.zero_grad()
+            n_accumulated = 0
+        profiler.step()
+
+        metrics.add('objective', total_objective)
+        metrics.add_dict(info)
+
+        # Print status (averages since the last print):
         log_interval = 20
         if (i_inner_step) % log_interval == 0:
-            batch_acc = info['correct_count'] / info['sample_count']
-            print(cmn.status_string(i_iter, n_meta_iterations, i_inner_step, n_inner_steps, batch_acc, total_objective.data[0]) +
+            means, sums = metrics.reduce()
+            batch_acc = sums['correct_count'] / sums['sample_count']
+            print(cmn.status_string(i_iter, n_meta_iterations, i_inner_step, n_inner_steps, batch_acc, means['objective']) +
                   ' Empiric-Loss: {:.4}\t Task-Comp. {:.4}\t'.
-                  format(info['avg_empirical_loss'], info['avg_intra_task_comp']))
+                  format(means['avg_empirical_loss'], means['avg_intra_task_comp']))
+
+        if step_callback is not None:
+            training_state['i_step'] += 1
+            if step_callback(training_state['i_step'], prior_model, info):
+                training_state['stop'] = True
+                # take the prior step with the gradients accumulated so far:
+                if n_accumulated:
+                    accumulated_grad_step(prior_optimizer, n_accumulated, lr_schedule, prm.lr, i_iter)
+                    prior_optimizer.zero_grad()
+                break
 
     # Print status = on test set of meta-batch:
     log_interval_eval = 10
@@ -10,8 +10,10 @@ from Models.stochastic_models import get_model
 from Utils import common as cmn, data_gen
 from Utils.Bayes_utils import run_eval_Bayes
 from Utils.complexity_terms import get_task_complexity
-from Utils.common import grad_step, correct_rate, write_to_log
+from Utils.common import grad_step, count_correct_tensor, write_to_log
 from Utils.Losses import get_loss_func
+from Utils.adaptive_MC import get_mc_controller
+from Utils.mixed_precision import run_forward
 import matplotlib.pyplot as plt
 # -------------------------------------------------------------------------------------------
 #  Stochastic Single-task learning
@@ -43,12 +45,16 @@ def run_learning(data_loader, prm, prior_model=None, init_from_prior=True, verbo
         post_model = deepcopy(prior_model).to(prm.device)
     else:
         post_model = get_model(prm)
+    post_model.set_rng_key('single_task')  # (if RNG streams are used, see Utils/rng_streams.py)
 
     # post_model.set_eps_std(0.0) # DEBUG: turn off randomness
 
     #  Get optimizer:
     optimizer = optim_func(post_model.parameters(), **optim_args)
 
+    # Adaptive number of MC samples (if prm.adaptive_MC):
+    mc_controller = get_mc_controller(prm, verbose)
+
     # -------------------------------------------------------------------------------------------
     #  Training epoch  function
     # -------------------------------------------------------------------------------------------
@@ -57,6 +63,9 @@ def run_learning(data_loader, prm, prior_model=None, init_from_prior=True, verbo
 
         post_model.train()
 
+        # the metrics are kept on the device, and moved to the host only when printed:
+        metrics = cmn.MetricsAccumulator()
+
         for batch_idx, batch_data in enumerate(train_loader):
 
             # get batch data:
@@ -66,12 +75,14 @@ def run_learning(data_loader, prm, prior_model=None, init_from_prior=True, verbo
 
             # Monte-Carlo iterations:
             avg_empiric_loss = torch.zeros(1, device=prm.device)
-            n_MC = prm.n_MC
+            n_MC = prm.n_MC if mc_controller is None else mc_controller.step(post_model, inputs, targets,
+                                                                             loss_criterion)
 
+            post_model.reset_noise()  # a new sequence of (antithetic / qmc) noise draws for this batch
             for i_MC in range(n_MC):
 
                 # calculate objective:
-                outputs = post_model(inputs)
+                outputs = run_forward(post_model, inputs, prm)
                 avg_empiric_loss_curr = (1 / batch_size) * loss_criterion(outputs, targets)
                 avg_empiric_loss += (1 / n_MC) * avg_empiric_loss_curr
 
@@ -88,12 +99,17 @@ def run_learning(data_loader, prm, prior_model=None, init_from_prior=True, verbo
             # Take gradient step:
             grad_step(objective, optimizer, lr_schedule, prm.lr, i_epoch)
 
-            # Print status:
+            metrics.add_dict({'objective': objective, 'avg_empirical_loss': avg_empiric_loss,
+                              'complexity': complexity_term, 'correct_count': count_correct_tensor(outputs, targets),
+                              'sample_count': batch_size})
+
+            # Print status (averages since the last print):
             log_interval = 1000
             if batch_idx % log_interval == 0:
-                batch_acc = correct_rate(outputs, targets)
-                print(cmn.status_string(i_epoch, prm.num_epochs, batch_idx, n_batches, batch_acc, objective.item()) +
-                      ' Loss: {:.4}\t Comp.: {:.4}'.format(avg_empiric_loss.item(), complexity_term.item()))
+                means, sums = metrics.reduce()
+                batch_acc = sums['correct_count'] / sums['sample_count']
+                print(cmn.status_string(i_epoch, prm.num_epochs, batch_idx, n_batches, batch_acc, means['objective']) +
+                      ' Loss: {:.4}\t Comp.: {:.4}'.format(means['avg_empirical_loss'], means['complexity']))
 
         # End batch loop
 
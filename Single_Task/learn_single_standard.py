@@ -5,7 +5,7 @@ import timeit
 
 from Models.deterministic_models import get_model
 from Utils import common as cmn, data_gen
-from Utils.common import count_correct, grad_step, correct_rate, write_to_log
+from Utils.common import count_correct_tensor, grad_step, write_to_log
 from Utils.Losses import get_loss_func
 
 
@@ -69,6 +69,10 @@ def run_learning(data_loader, prm, verbose=1, initial_model=None):
         log_interval = 500
 
         model.train()
+
+        # the metrics are kept on the device, and moved to the host only when printed:
+        metrics = cmn.MetricsAccumulator()
+
         for batch_idx, batch_data in enumerate(train_loader):
 
             # get batch:
@@ -82,10 +86,14 @@ def run_learning(data_loader, prm, verbose=1, initial_model=None):
             # Take gradient step:
             grad_step(loss, optimizer, lr_schedule, prm.lr, i_epoch)
 
-            # Print status:
+            metrics.add_dict({'loss': loss, 'correct_count': count_correct_tensor(outputs, targets),
+                              'sample_count': batch_size})
+
+            # Print status (averages since the last print):
             if batch_idx % log_interval == 0:
-                batch_acc = correct_rate(outputs, targets)
-                print(cmn.status_string(i_epoch, prm.num_epochs, batch_idx, n_batches, batch_acc, loss.item()))
+                means, sums = metrics.reduce()
+                batch_acc = sums['correct_count'] / sums['sample_count']
+                print(cmn.status_string(i_epoch, prm.num_epochs, batch_idx, n_batches, batch_acc, means['loss']))
 
     # -----------------------------------------------------------------------------------------------------------#
     # Update Log file
@@ -126,12 +134,14 @@ def run_test(model, test_loader, loss_criterion, prm):
         inputs, targets = data_gen.get_batch_vars(batch_data, prm)
         batch_size = inputs.shape[0]
         outputs = model(inputs)
-        test_loss += (1 / batch_size) * loss_criterion(outputs, targets).item()  # sum the mean loss in batch
-        n_correct += count_correct(outputs, targets)
+        # note: the sums are kept on the device until the end of the loop
+        test_loss += (1 / batch_size) * loss_criterion(outputs, targets).detach()  # sum the mean loss in batch
+        n_correct += count_correct_tensor(outputs, targets)
 
     n_test_samples = len(test_loader.dataset)
     n_test_batches = len(test_loader)
-    test_loss = test_loss / n_test_batches
+    n_correct = int(n_correct)
+    test_loss = float(test_loss) / n_test_batches
     test_acc = n_correct / n_test_samples
     print('\n Standard learning: test loss: {:.4}, test err: {:.3} ( {}/{})\n'.format(
         test_loss, 1-test_acc, n_correct, n_test_samples))
@@ -2,10 +2,13 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
+import os
 import torch
 import torch.optim as optim
 from Utils import data_gen
 from Utils.common import set_random_seed, create_result_dir, save_run_data, write_to_log
+from Utils.rng_streams import init_rng_streams
+from Utils.eval_cache import init_eval_cache
 from Single_Task import learn_single_Bayes
 from Data_Path import get_data_path
 
@@ -30,7 +33,7 @@ parser.add_argument('--test-batch-size',type=int,  help='input batch size for te
 
 # ----- Task Parameters ---------------------------------------------#
 
-parser.add_argument('--data-source', type=str, help="Data: 'MNIST' / 'CIFAR10' / Omniglot / SmallImageNet",
+parser.add_argument('--data-source', type=str, help="Data: 'MNIST' / 'CIFAR10' / Omniglot / SmallImageNet / Synthetic",
                     default='MNIST')
 
 parser.add_argument('--data-transform', type=str, help="Data transformation:  'None' / 'Permute_Pixels' / 'Permute_Labels'/ Shuffled_Pixels ",
@@ -73,6 +76,12 @@ parser.add_argument('--loss-type', type=str, help="Data: 'CrossEntropy' / 'L2_SV
 parser.add_argument('--model-name', type=str, help="Define model type (hypothesis class)'",
                     default='ConvNet3')  # OmConvNet / 'FcNet3' / 'ConvNet3' / OmConvNet_NoBN
 
+parser.add_argument('--stochastic_layers', type=str, nargs='+',
+                    help='Semi-stochastic model: the names of the stochastic layers (e.g. fc1 fc_out), or the number '
+                         'of top layers which are stochastic (e.g. 1), the other layers are deterministic '
+                         '(default: all the layers are stochastic)',
+                    default=None)
+
 parser.add_argument('--batch-size', type=int, help='input batch size for training',
                     default=128)
 
@@ -82,6 +91,77 @@ parser.add_argument('--num-epochs', type=int, help='number of epochs to train',
 parser.add_argument('--lr', type=float, help='learning rate (initial)',
                     default=1e-3)
 
+parser.add_argument('--adaptive_MC', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Adapt the number of MC samples to the gradient variance (see Utils/adaptive_MC.py)')
+
+parser.add_argument('--MC_target_snr', type=float, help='For adaptive MC: target signal-to-noise ratio of the gradient',
+                    default=1.0)
+
+parser.add_argument('--MC_probe_interval', type=int, help='For adaptive MC: number of steps between variance probes',
+                    default=50)
+
+parser.add_argument('--MC_probe_samples', type=int, help='For adaptive MC: number of extra samples in a probe',
+                    default=4)
+
+parser.add_argument('--max_n_MC', type=int, help='For adaptive MC: maximal number of MC samples',
+                    default=16)
+
+parser.add_argument('--noise_type', type=str,
+                    help="Noise of the re-parametrization trick in training: 'iid' / 'antithetic' / 'qmc'",
+                    default='iid')
+
+parser.add_argument('--noise_type_eval', type=str,
+                    help="Noise of the re-parametrization trick in evaluation: 'iid' / 'antithetic' / 'qmc'",
+                    default='iid')
+
+parser.add_argument('--eval_weight_sampling', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Evaluate the draws from the posterior with concrete weights sampled once per draw and '
+                         'shared by all the batches (plain forward, without the variance path)')
+
+parser.add_argument('--stochastic_estimator', type=str,
+                    help="Gradient estimator of the stochastic layers: 'local_reparam' / 'flipout'",
+                    default='local_reparam')
+
+parser.add_argument('--rng_streams', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Draw the weights noise from counter-based RNG streams per task, step, layer and MC index '
+                         '(reproducible in any order, see Utils/rng_streams.py)')
+
+parser.add_argument('--eval_tolerance', type=float,
+                    help='Sequential evaluation of the expected loss: stop the monte-carlo passes when the confidence '
+                         'interval is narrower than +- eval_tolerance (0 = n_MC_eval full passes)',
+                    default=0.0)
+
+parser.add_argument('--eval_confidence', type=float, help='For eval_tolerance: the confidence of the interval',
+                    default=0.95)
+
+parser.add_argument('--eval_cache', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Cache the evaluation results and outputs of the same posterior and data '
+                         '(see Utils/eval_cache.py)')
+
+parser.add_argument('--eval_cache_size', type=int, help='For eval_cache: maximal number of cached evaluations',
+                    default=32)
+
+parser.add_argument('--mixed_precision', type=str,
+                    help="'fp32' / 'bf16' (bf16 autocast of the forward computations, see Utils/mixed_precision.py)",
+                    default='fp32')
+
+parser.add_argument('--compile_forward', default=False, type=lambda x: (str(x).lower() == 'true'),
+                    help='Compile the forward (+ loss) of the models with torch.compile (see Utils/compiled.py)')
+
+parser.add_argument('--compile_cache_limit', type=int,
+                    help='For compile_forward: maximal number of compiled versions of each function',
+                    default=16)
+
+parser.add_argument('--export_format', type=str,
+                    help="Export the learned posterior as a deterministic model: '' (no export) / 'torchscript' / 'onnx' "
+                         "(see Models/freeze.py)",
+                    default='')
+
+parser.add_argument('--export_ensemble', type=int,
+                    help='For export_format: number of networks sampled from the posterior in the exported ensemble '
+                         '(0 = a single network with the posterior means)',
+                    default=0)
+
 # parser.add_argument('--override_eps_std', type=float,
 #                     help='For debug: set the STD of epsilon variable for re-parametrization trick (default=1.0)',
 #                     default=1.0)
@@ -92,12 +172,14 @@ prm = parser.parse_args()
 prm.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 prm.data_path = get_data_path()
 set_random_seed(prm.seed)
+init_rng_streams(prm)
+init_eval_cache(prm)
 create_result_dir(prm)
 
 
 prm.log_var_init = {'mean': -10, 'std': 0.1} # The initial value for the log-var parameter (rho) of each weight
 
-# Number of Monte-Carlo iterations (for re-parametrization trick):
+# Number of Monte-Carlo iterations (for re-parametrization trick), the initial value in case of adaptive MC:
 prm.n_MC = 1
 
 # prm.use_randomness_schedeule = True # False / True
@@ -127,3 +209,16 @@ post_model, test_err, test_loss, log_mat = learn_single_Bayes.run_learning(data_
 
 save_run_data(prm, {'test_err': test_err, 'test_loss': test_loss})
 
+# -------------------------------------------------------------------------------------------
+#  Export the learned posterior for inference
+# -------------------------------------------------------------------------------------------
+if prm.export_format:
+    from Models.freeze import freeze_model, freeze_ensemble, export_model
+    if prm.export_ensemble > 0:
+        frozen_model = freeze_ensemble(post_model, prm, prm.export_ensemble)
+    else:
+        frozen_model = freeze_model(post_model, prm)
+    file_ext = {'torchscript': '.pt', 'onnx': '.onnx'}.get(prm.export_format, '')
+    export_path = export_model(frozen_model, prm, os.path.join(prm.result_dir, 'frozen_model' + file_ext),
+                               prm.export_format)
+    write_to_log('Exported the posterior to ' + export_path, prm)
@@ -1,157 +1,311 @@
 
 from __future__ import absolute_import, division, print_function
 
+import math
 import torch
 from Utils import common as cmn, data_gen
-from Utils.common import count_correct
+from Utils.common import count_correct_tensor, get_prediction
 from Models.stochastic_layers import StochasticLayer
 from Utils.Losses import get_loss_func
+from Utils.mixed_precision import run_forward
+from Utils.eval_cache import get_eval_cache
 
 
 
 # -----------------------------------------------------------------------------------------------------------#
 
+TEST_TYPES = ['MaxPosterior', 'Expected', 'MajorityVote', 'AvgVote']
+
+
 def run_eval_Bayes(model, loader, prm, verbose=0):
 
+    if len(loader) == 0:
+        return 0.0, 0.0
+    info = run_eval_Bayes_multi(model, loader, prm, [prm.test_type])[prm.test_type]
+    if verbose:
+        print('Accuracy: {:.3} ({}/{}), loss: {:.4}'.format(float(info['acc']), info['n_correct'],
+                                                                      info['n_samples'], float(info['avg_loss'])))
+        if 'achieved_confidence' in info:
+            print('Sequential estimate: {} evaluations, loss +-{:.3}, error +-{:.3}, confidence {:.3}'.format(
+                info['n_evals'], info['loss_half_width'], info['err_half_width'], info['achieved_confidence']))
+    return info['acc'], info['avg_loss']
+# -------------------------------------------------------------------------------------------
+
+def run_eval_Bayes_multi(model, loader, prm, test_types=TEST_TYPES, n_votes=5):
+    ''' Evaluates several test types in one pass over the loader (see run_eval_test_types),
+      returns a dict with the info (acc, n_correct, n_samples, avg_loss) of each test type '''
+
     with torch.no_grad():    # no need for backprop in test
 
         if len(loader) == 0:
-            return 0.0, 0.0
-        if prm.test_type == 'Expected':
-            info = run_eval_expected(model, loader, prm)
-        elif prm.test_type == 'MaxPosterior':
-            info = run_eval_max_posterior(model, loader, prm)
-        elif prm.test_type == 'MajorityVote':
-            info = run_eval_majority_vote(model, loader, prm, n_votes=5)
-        elif prm.test_type == 'AvgVote':
-            info = run_eval_avg_vote(model, loader, prm, n_votes=5)
+            return {test_type: {'acc': 0.0, 'n_correct': 0, 'n_samples': 0, 'avg_loss': 0.0}
+                    for test_type in test_types}
+        # the noise type of the re-parametrization trick in evaluation (may differ from the one in training):
+        if hasattr(prm, 'noise_type_eval') and prm.noise_type_eval:
+            old_noise_type = model.set_noise_type(prm.noise_type_eval)
         else:
-            raise ValueError('Invalid test_type')
-        if verbose:
-            print('Accuracy: {:.3} ({}/{}), loss: {:.4}'.format(float(info['test_acc']), info['n_correct'],
-                                                                          info['n_samples'], float(info['avg_loss'])))
-    return info['acc'], info['avg_loss']
+            old_noise_type = None
+        # with prm.eval_tolerance, Expected is estimated sequentially (see run_eval_sequential):
+        sequential = 'Expected' in test_types and is_sequential_eval(prm)
+        pass_types = [test_type for test_type in test_types if not (sequential and test_type == 'Expected')]
+        cache = get_eval_cache()
+        if not pass_types:
+            results = {}
+        elif cache is None:
+            results = run_eval_test_types(model, loader, prm, pass_types, n_votes)
+        else:
+            results = run_eval_cached(model, loader, prm, pass_types, n_votes, cache)
+        if sequential:
+            results['Expected'] = run_eval_sequential(model, loader, prm)
+        if old_noise_type is not None:
+            model.set_noise_type(old_noise_type)
+    return results
 # -------------------------------------------------------------------------------------------
 
-def run_eval_max_posterior(model, loader, prm):
-    ''' Estimates the the loss by using the mean network parameters'''
+def run_eval_cached(model, loader, prm, test_types, n_votes, cache):
+    ''' Evaluation with the evaluation cache (see Utils/eval_cache.py): returns the stored results, or computes the
+     results from the stored outputs of the forward passes (if only the loss function differs) '''
+    outputs_key, results_key = cache.get_keys(model, loader, prm, test_types, n_votes)
+    results = cache.get_results(results_key)
+    if results is None:
+        batches_outputs = cache.get_outputs(outputs_key)
+        if batches_outputs is None:
+            batches_outputs = list(get_batches_outputs(model, loader, prm, test_types, n_votes))
+            cache.put_outputs(outputs_key, batches_outputs, loader)
+        results = run_eval_test_types(model, loader, prm, test_types, n_votes, batches_outputs)
+        cache.put_results(results_key, results, loader)
+    return {test_type: dict(info) for test_type, info in results.items()}
+# -------------------------------------------------------------------------------------------
+
+def is_weight_sampling_eval(prm):
+    return hasattr(prm, 'eval_weight_sampling') and prm.eval_weight_sampling
+
+
+def get_batches_outputs(model, loader, prm, test_types, n_votes=5):
+    ''' Runs the forward passes of the test types on each batch of the loader, yields for each batch the targets,
+     the outputs with the mean network parameters (if MaxPosterior is in test_types, else None) and the list of
+     outputs of the draws from the network's distribution (n_MC_eval draws for Expected and n_votes for the votes).
+     With prm.eval_weight_sampling, the draws are concrete weights sampled once before the pass (see
+      StochasticLayer.sample_weights), the i-th draw of all the batches uses the same weights and runs as a plain
+      network (without the variance path of the local re-parametrization) '''
+    with_mean = 'MaxPosterior' in test_types
+    n_MC = prm.n_MC_eval if 'Expected' in test_types else 0  # number of monte-carlo runs for expected loss estimation
+    n_vote_draws = n_votes if ('MajorityVote' in test_types or 'AvgVote' in test_types) else 0
+    n_draws = max(n_MC, n_vote_draws)
+    weight_sampling = is_weight_sampling_eval(prm) and n_draws > 0
+    model.eval()
+    if weight_sampling:
+        model.sample_weights(n_draws)
+    try:
+        for batch_data in loader:
+            inputs, targets = data_gen.get_batch_vars(batch_data, prm)
+            mean_outputs = None
+            if with_mean:
+                old_eps_std = model.set_eps_std(0.0)   # test with max-posterior
+                mean_outputs = run_forward(model, inputs, prm)
+                model.set_eps_std(old_eps_std)  # return model to normal behaviour
+            #  monte-carlo runs
+            draws_outputs = []
+            if n_draws > 0:
+                model.reset_noise()
+                for i_draw in range(n_draws):
+                    if weight_sampling:
+                        model.set_weight_sample(i_draw)
+                    draws_outputs.append(run_forward(model, inputs, prm))
+            yield targets, mean_outputs, draws_outputs
+    finally:
+        if weight_sampling:
+            model.clear_weight_samples()
+# -------------------------------------------------------------------------------------------
+
+def run_eval_test_types(model, loader, prm, test_types, n_votes=5, batches_outputs=None):
+    ''' Computes all the requested test types from the same forward passes of each batch:
+     * MaxPosterior - one forward with the mean network parameters.
+     * Expected - the monte-carlo average of the loss and error over n_MC_eval draws from the network's distribution.
+     * MajorityVote - the majority vote of the predictions of n_votes draws.
+     * AvgVote - the prediction of the average outputs of n_votes draws.
+     The draws are shared (Expected uses the first n_MC_eval draws and the votes the first n_votes), the votes are
+     tallied on the device (scatter_add) and the sums stay on the device until the end of the pass (the pass runs
+     under torch.no_grad(), so the sums do not keep the batches' graphs).
+     batches_outputs - the outputs of the forward passes (see get_batches_outputs), by default computed on the fly.
+     '''
+    for test_type in test_types:
+        if test_type not in TEST_TYPES:
+            raise ValueError('Invalid test_type')
     n_samples = len(loader.dataset)
     loss_criterion = get_loss_func(prm)
+    n_labels = data_gen.get_info(prm)['n_classes']
+    n_MC = prm.n_MC_eval if 'Expected' in test_types else 0
+    n_vote_draws = n_votes if ('MajorityVote' in test_types or 'AvgVote' in test_types) else 0
+    with torch.no_grad():    # no need for backprop in test (also when called directly, e.g. run_eval_expected)
+        if batches_outputs is None:
+            batches_outputs = get_batches_outputs(model, loader, prm, test_types, n_votes)
+        loss_sum = {test_type: 0.0 for test_type in test_types}
+        n_correct = {test_type: 0 for test_type in test_types}
+        for targets, mean_outputs, draws_outputs in batches_outputs:
+
+            if mean_outputs is not None:
+                loss_sum['MaxPosterior'] += loss_criterion(mean_outputs, targets)  # sum the loss contributed from batch
+                n_correct['MaxPosterior'] += count_correct_tensor(mean_outputs, targets)
+            if not draws_outputs:
+                continue
+
+            votes = torch.zeros((targets.shape[0], n_labels), device=targets.device)
+            sum_outputs = 0
+            votes_loss = 0.0
+            for i_draw, outputs in enumerate(draws_outputs):
+                loss = loss_criterion(outputs, targets)
+                if i_draw < n_MC:
+                    loss_sum['Expected'] += loss
+                    n_correct['Expected'] += count_correct_tensor(outputs, targets)
+                if i_draw < n_vote_draws:
+                    votes_loss += loss
+                    pred = get_prediction(outputs).long()  # the index of the max output
+                    votes.scatter_add_(1, pred, torch.ones_like(pred, dtype=votes.dtype))
+                    sum_outputs = sum_outputs + outputs
+            for vote_type, tally in [('MajorityVote', votes), ('AvgVote', sum_outputs)]:
+                if vote_type in test_types:
+                    loss_sum[vote_type] += votes_loss / n_votes  # sum the loss contributed from batch
+                    n_correct[vote_type] += count_correct_tensor(tally, targets)
+
+    results = {}
+    for test_type in test_types:
+        n_evals = n_samples * (n_MC if test_type == 'Expected' else 1)
+        n_correct_type = int(n_correct[test_type])
+        results[test_type] = {'acc': n_correct_type / n_evals, 'n_correct': n_correct_type,
+                              'n_samples': n_samples, 'avg_loss': float(loss_sum[test_type]) / n_evals}
+    return results
+# -------------------------------------------------------------------------------------------
+
+def is_sequential_eval(prm):
+    return hasattr(prm, 'eval_tolerance') and prm.eval_tolerance
+
+
+class RunningRatioCI(object):
+    ''' Running estimate of sum(s_i) / sum(n_i) over observations (s_i, n_i) - the summed loss and the number of
+     samples of each batch - and its confidence interval (the ratio estimator variance, valid for randomly
+     drawn batches) '''
+    def __init__(self):
+        self.k = 0
+        self.sum_s, self.sum_n, self.sum_ss, self.sum_nn, self.sum_sn = 0.0, 0.0, 0.0, 0.0, 0.0
+
+    def update(self, s, n):
+        self.k += 1
+        self.sum_s += s
+        self.sum_n += n
+        self.sum_ss += s * s
+        self.sum_nn += n * n
+        self.sum_sn += s * n
+
+    def mean(self):
+        return self.sum_s / self.sum_n
+
+    def std_err(self):
+        if self.k < 2:
+            return float('inf')
+        m = self.mean()
+        sq_residuals = max(self.sum_ss - 2 * m * self.sum_sn + m * m * self.sum_nn, 0.0)
+        n_avg = self.sum_n / self.k
+        return math.sqrt(sq_residuals / ((self.k - 1) * self.k)) / n_avg
+
+
+def run_eval_sequential(model, loader, prm, min_batches=10):
+    ''' Sequential monte-carlo estimate of the expected loss and error (test_type='Expected'):
+     each batch is evaluated with a new draw from the network's distribution, and the passes over the loader
+     (at most n_MC_eval passes) stop as soon as the confidence intervals (with confidence prm.eval_confidence) of
+     both the loss (prm.loss_type) and the 0-1 error are narrower than +-prm.eval_tolerance (after at least
+     min_batches batches).
+     Returns the info of the estimate, with the half-widths of the intervals ('loss_half_width',
+     'err_half_width') and the achieved confidence of the +-eval_tolerance interval ('achieved_confidence') '''
+    tolerance = prm.eval_tolerance
+    confidence = prm.eval_confidence if hasattr(prm, 'eval_confidence') else 0.95
+    z = math.sqrt(2) * torch.erfinv(torch.tensor(confidence)).item()   # two-sided normal quantile
+    loss_criterion = get_loss_func(prm)
     model.eval()
-    avg_loss = 0
-    n_correct = 0
-    for batch_data in loader:
-        inputs, targets = data_gen.get_batch_vars(batch_data, prm)
-        batch_size = inputs.shape[0]
-        old_eps_std = model.set_eps_std(0.0)   # test with max-posterior
-        outputs = model(inputs)
-        model.set_eps_std(old_eps_std)  # return model to normal behaviour
-        avg_loss += loss_criterion(outputs, targets).item() # sum the loss contributed from batch
-        n_correct += count_correct(outputs, targets)
-
-    avg_loss /= n_samples
-    acc = n_correct / n_samples
-    info = {'acc':acc, 'n_correct':n_correct,
-            'n_samples':n_samples, 'avg_loss':avg_loss}
+    loss_stats, err_stats = RunningRatioCI(), RunningRatioCI()
+    converged = False
+    for i_pass in range(prm.n_MC_eval):
+        for batch_data in loader:
+            inputs, targets = data_gen.get_batch_vars(batch_data, prm)
+            batch_size = inputs.shape[0]
+            model.reset_noise()
+            outputs = run_forward(model, inputs, prm)
+            loss_stats.update(loss_criterion(outputs, targets).item(), batch_size)
+            err_stats.update(batch_size - count_correct_tensor(outputs, targets).item(), batch_size)
+            if loss_stats.k >= min_batches and \
+                    z * max(loss_stats.std_err(), err_stats.std_err()) <= tolerance:
+                converged = True
+                break
+        if converged:
+            break
+
+    std_err = max(loss_stats.std_err(), err_stats.std_err())
+    n_evals = int(err_stats.sum_n)
+    n_correct = n_evals - int(round(err_stats.sum_s))
+    info = {'acc': n_correct / n_evals, 'n_correct': n_correct, 'n_samples': len(loader.dataset),
+            'avg_loss': loss_stats.mean(), 'n_evals': n_evals, 'converged': converged,
+            'loss_half_width': z * loss_stats.std_err(), 'err_half_width': z * err_stats.std_err(),
+            'achieved_confidence': math.erf(tolerance / (std_err * math.sqrt(2))) if std_err > 0 else 1.0}
     return info
+# -------------------------------------------------------------------------------------------
+
+def run_eval_max_posterior(model, loader, prm):
+    ''' Estimates the the loss by using the mean network parameters'''
+    return run_eval_test_types(model, loader, prm, ['MaxPosterior'])['MaxPosterior']
 
 
 # -------------------------------------------------------------------------------------------
 
 def run_eval_expected(model, loader, prm):
     ''' Estimates the expectation of the loss by monte-carlo averaging'''
-    n_samples = len(loader.dataset)
-    loss_criterion = get_loss_func(prm)
-    model.eval()
-    avg_loss = 0.0
-    n_correct = 0
-    n_MC = prm.n_MC_eval # number of monte-carlo runs for expected loss estimation
-    for batch_data in loader:
-        inputs, targets = data_gen.get_batch_vars(batch_data, prm)
-        batch_size = inputs.shape[0]
-        #  monte-carlo runs
-        for i_MC in range(n_MC):
-            outputs = model(inputs)
-            avg_loss += loss_criterion(outputs, targets).item() # sum the loss contributed from batch
-            n_correct += count_correct(outputs, targets)
-
-    avg_loss /= (n_MC * n_samples)
-    acc = n_correct / (n_MC * n_samples)
-    info = {'acc':acc, 'n_correct':n_correct,
-            'n_samples':n_samples, 'avg_loss':avg_loss}
-    return info
+    return run_eval_test_types(model, loader, prm, ['Expected'])['Expected']
 
 # -------------------------------------------------------------------------------------------
 def run_eval_majority_vote(model, loader, prm, n_votes=5):
     ''' Estimates the the loss of the the majority votes over several draws form network's distribution'''
-
-    loss_criterion = get_loss_func(prm)
-    n_samples = len(loader.dataset)
-    n_test_batches = len(loader)
-    model.eval()
-    avg_loss = 0
-    n_correct = 0
-    for batch_data in loader:
-        inputs, targets = data_gen.get_batch_vars(batch_data, prm)
-
-        batch_size = inputs.shape[0] # min(prm.test_batch_size, n_samples)
-        info = data_gen.get_info(prm)
-        n_labels = info['n_classes']
-        votes = torch.zeros((batch_size, n_labels), device=prm.device)
-        loss_from_batch = 0.0
-        for i_vote in range(n_votes):
-
-            outputs = model(inputs)
-            loss_from_batch += loss_criterion(outputs, targets).item()
-            pred = outputs.data.max(1, keepdim=True)[1]  # get the index of the max output
-            for i_sample in range(batch_size):
-                pred_val = pred[i_sample].cpu().numpy()[0]
-                votes[i_sample, pred_val] += 1
-        avg_loss += loss_from_batch / n_votes # sum the loss contributed from batch
-
-        majority_pred = votes.max(1, keepdim=True)[1] # find argmax class for each sample
-        n_correct += majority_pred.eq(targets.data.view_as(majority_pred)).cpu().sum()
-    avg_loss /= n_samples
-    acc = n_correct / n_samples
-    info = {'acc': acc, 'n_correct': n_correct,
-            'n_samples': n_samples, 'avg_loss': avg_loss}
-    return info
+    return run_eval_test_types(model, loader, prm, ['MajorityVote'], n_votes)['MajorityVote']
 # -------------------------------------------------------------------------------------------
 
 def run_eval_avg_vote(model, loader, prm, n_votes=5):
     ''' Estimates the the loss by of the average vote over several draws form network's distribution'''
-
-    loss_criterion = get_loss_func(prm)
-    n_samples = len(loader.dataset)
-    n_test_batches = len(loader)
-    model.eval()
-    avg_loss = 0
-    n_correct = 0
-    for batch_data in loader:
-        inputs, targets = data_gen.get_batch_vars(batch_data, prm)
-
-        batch_size = min(prm.test_batch_size, n_samples)
-        info = data_gen.get_info(prm)
-        n_labels = info['n_classes']
-        votes = torch.zeros((batch_size, n_labels), device=prm.device)
-        loss_from_batch = 0.0
-        for i_vote in range(n_votes):
-
-            outputs = model(inputs)
-            loss_from_batch += loss_criterion(outputs, targets).item()
-            votes += outputs.data
-
-        majority_pred = votes.max(1, keepdim=True)[1]
-        n_correct += majority_pred.eq(targets.data.view_as(majority_pred)).cpu().sum()
-        avg_loss += loss_from_batch / n_votes  # sum the loss contributed from batch
-
-    avg_loss /= n_samples
-    acc = n_correct / n_samples
-    info = {'acc': acc, 'n_correct': n_correct,
-            'n_samples': n_samples, 'avg_loss': avg_loss}
-    return info
+    return run_eval_test_types(model, loader, prm, ['AvgVote'], n_votes)['AvgVote']
 # -------------------------------------------------------------------------------------------
 
+NOISE_TYPES = ['iid', 'antithetic', 'qmc']
+
+
+def compare_noise_types(model, loader, prm, n_MC=None, n_repeats=20, noise_types=NOISE_TYPES):
+    ''' Compares the variance of the Monte-Carlo estimate of the expected loss and error (test_type='Expected'),
+     with each noise type of the re-parametrization trick. The estimate is repeated n_repeats times with n_MC
+     samples (by default prm.n_MC_eval).
+     Returns for each noise type the mean and variance of the estimates, the variance reduction factor relative to
+     'iid' noise and the number of iid samples which gives the same variance (n_MC * factor) '''
+    from copy import deepcopy
+    prm_eval = deepcopy(prm)
+    prm_eval.test_type = 'Expected'
+    if n_MC is not None:
+        prm_eval.n_MC_eval = n_MC
+    results = {}
+    old_noise_type = model.set_noise_type('iid')
+    with torch.no_grad():
+        for noise_type in noise_types:
+            model.set_noise_type(noise_type)
+            losses, errors = [], []
+            for i_repeat in range(n_repeats):
+                info = run_eval_expected(model, loader, prm_eval)
+                losses.append(float(info['avg_loss']))
+                errors.append(1 - float(info['acc']))
+            losses, errors = torch.tensor(losses), torch.tensor(errors)
+            results[noise_type] = {'loss_mean': losses.mean().item(), 'loss_var': losses.var().item(),
+                                   'error_mean': errors.mean().item(), 'error_var': errors.var().item()}
+    model.set_noise_type(old_noise_type)
+
+    if 'iid' in results:
+        for noise_type, res in results.items():
+            res['loss_var_reduction'] = results['iid']['loss_var'] / max(res['loss_var'], 1e-30)
+            res['error_var_reduction'] = results['iid']['error_var'] / max(res['error_var'], 1e-30)
+            res['equivalent_iid_n_MC'] = prm_eval.n_MC_eval * res['loss_var_reduction']
+    return results
 
 # -------------------------------------------------------------------------------------------
 
@@ -0,0 +1,110 @@
+from __future__ import absolute_import, division, print_function
+
+import math
+import torch
+from Utils.common import write_to_log
+
+# -------------------------------------------------------------------------------------------
+#  Adaptive number of Monte-Carlo samples
+# -------------------------------------------------------------------------------------------
+# The gradient of the empirical loss is estimated with n_MC samples of the weights (by the re-parametrization
+# trick), so its variance due to the weights noise is Var_1 / n_MC, where Var_1 is the (total) variance of a
+# single-sample gradient. Every prm.MC_probe_interval steps, the controller draws prm.MC_probe_samples extra
+# single-sample gradients on the current batch, and estimates the squared norm of the mean gradient |G|^2 and Var_1
+# (per layer and in total). It then sets the smallest n_MC for which the signal-to-noise ratio |G|^2 / (Var_1 / n_MC)
+# reaches prm.MC_target_snr (in [1, prm.max_n_MC]).
+# prm.max_n_MC is re-read in every step: with a memory cap, it is the largest n_MC which fits the cap (see
+# PriorMetaLearning/auto_tune.py - it is set by the tuning, and lowered by the memory guard during training).
+# Note: the variance is of the weights noise only (the batch is fixed), the mini-batch sampling noise is not affected
+#  by n_MC.
+
+
+def is_adaptive_MC(prm):
+    return hasattr(prm, 'adaptive_MC') and prm.adaptive_MC
+
+
+def get_max_n_MC(prm):
+    return prm.max_n_MC if hasattr(prm, 'max_n_MC') else 16
+
+
+def get_mc_controller(prm, verbose=1):
+    ''' Returns an AdaptiveMC controller if prm.adaptive_MC is set, otherwise None (a fixed prm.n_MC) '''
+    if is_adaptive_MC(prm):
+        return AdaptiveMC(prm, verbose)
+    return None
+
+
+class AdaptiveMC(object):
+
+    def __init__(self, prm, verbose=1):
+        self.prm = prm
+        self.verbose = verbose
+        self.n_MC = min(prm.n_MC, get_max_n_MC(prm))
+        self.target_snr = prm.MC_target_snr if hasattr(prm, 'MC_target_snr') else 1.0
+        self.probe_interval = prm.MC_probe_interval if hasattr(prm, 'MC_probe_interval') else 50
+        self.n_probe_samples = prm.MC_probe_samples if hasattr(prm, 'MC_probe_samples') else 4
+        self.i_step = 0
+        self.history = []
+
+    def step(self, model, inputs, targets, loss_criterion):
+        ''' Called once in each training step (with a batch of the step), returns the n_MC to use '''
+        if self.i_step % self.probe_interval == 0:
+            self.probe(model, inputs, targets, loss_criterion)
+        # (the maximum may have been lowered since the last probe, e.g. by the memory guard)
+        self.n_MC = min(self.n_MC, get_max_n_MC(self.prm))
+        self.i_step += 1
+        return self.n_MC
+
+    def probe(self, model, inputs, targets, loss_criterion):
+        ''' Estimates the gradient variance from a few extra samples, and updates n_MC '''
+        layers_stats, total_signal, total_var = get_gradient_stats(model, inputs, targets, loss_criterion,
+                                                                   self.n_probe_samples)
+
+        max_n_MC = get_max_n_MC(self.prm)
+        snr_1 = total_signal / max(total_var, 1e-30)  # the SNR of a single-sample gradient
+        if snr_1 > 0:
+            n_MC = int(math.ceil(self.target_snr / snr_1))
+        else:
+            n_MC = max_n_MC
+        self.n_MC = min(max(n_MC, 1), max_n_MC)
+        self.history.append({'step': self.i_step, 'n_MC': self.n_MC, 'snr_1': snr_1, 'grad_var': total_var,
+                             'grad_sqr_norm': total_signal, 'layers': layers_stats})
+        if self.verbose:
+            write_to_log('Adaptive MC, step {}: gradient variance {:.4}, single-sample SNR {:.4} -> n_MC={} '
+                         '(layers SNR: {})'.format(self.i_step, total_var, snr_1, self.n_MC,
+                                                   ', '.join('{}: {:.3}'.format(name, stats['snr_1'])
+                                                             for name, stats in layers_stats.items())), self.prm)
+
+
+def get_gradient_stats(model, inputs, targets, loss_criterion, n_samples):
+    ''' Estimates the squared norm of the mean and the (total) variance of the single-sample gradient of the empirical
+     loss on a batch w.r.t. the parameters of each stochastic layer, from n_samples draws of the weights noise.
+     Returns (layers_stats, total_signal, total_var), where layers_stats[layer_name] is a dict of
+     'grad_sqr_norm', 'grad_var' and 'snr_1' '''
+    from Models.stochastic_layers import StochasticLayer
+    layers = [(name, module) for name, module in model.named_modules() if isinstance(module, StochasticLayer)]
+    params = [list(module.parameters()) for _, module in layers]
+    batch_size = inputs.shape[0]
+
+    # single-sample gradients (w.r.t. the means and log-variances of the weights of each layer):
+    layers_grads = [[] for _ in layers]
+    for i_sample in range(n_samples):
+        loss = (1 / batch_size) * loss_criterion(model(inputs), targets)
+        grads = torch.autograd.grad(loss, sum(params, []))
+        i_grad = 0
+        for i_layer, layer_params in enumerate(params):
+            layer_grad = [grad.detach().view(-1) for grad in grads[i_grad: i_grad + len(layer_params)]]
+            layers_grads[i_layer].append(torch.cat(layer_grad))
+            i_grad += len(layer_params)
+
+    layers_stats = {}
+    total_signal, total_var = 0.0, 0.0
+    for (name, _), grads in zip(layers, layers_grads):
+        grads = torch.stack(grads)
+        var = grads.var(0).sum().item()
+        # the squared norm of the sample mean is biased by the variance of the mean:
+        signal = max(grads.mean(0).pow(2).sum().item() - var / n_samples, 0.0)
+        layers_stats[name] = {'grad_sqr_norm': signal, 'grad_var': var, 'snr_1': signal / max(var, 1e-30)}
+        total_signal += signal
+        total_var += var
+    return layers_stats, total_signal, total_var
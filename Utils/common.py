@@ -66,8 +66,13 @@ def get_prediction(outputs):
 # -----------------------------------------------------------------------------------------------------------#
 
 def count_correct(outputs, targets):
+    return count_correct_tensor(outputs, targets).item()
+# -----------------------------------------------------------------------------------------------------------#
+
+def count_correct_tensor(outputs, targets):
+    ''' Same as count_correct, but the count is kept on the device (no host synchronization)'''
     pred = get_prediction(outputs)
-    return pred.eq(targets.data.view_as(pred)).cpu().sum().item()
+    return pred.eq(targets.data.view_as(pred)).sum()
 # -----------------------------------------------------------------------------------------------------------#
 
 def correct_rate(outputs, targets):
@@ -76,6 +81,35 @@ def correct_rate(outputs, targets):
     return n_correct / n_samples
 # -----------------------------------------------------------------------------------------------------------#
 
+class MetricsAccumulator(object):
+    ''' Accumulates metrics (e.g. correct counts, losses and complexity terms) as device tensors.
+     The values are moved to the host (which forces a synchronization) only when they are reduced for logging'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, name, value):
+        if torch.is_tensor(value):
+            value = value.detach()
+        self.sums[name] = self.sums[name] + value if name in self.sums else value
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def add_dict(self, metrics_dict):
+        for name, value in metrics_dict.items():
+            self.add(name, value)
+
+    def reduce(self):
+        ''' Returns the averages (over the added values) and the sums of the metrics, and resets the accumulator'''
+        sums = {name: float(value) for name, value in self.sums.items()}
+        means = {name: sums[name] / self.counts[name] for name in sums}
+        self.reset()
+        return means, sums
+# -----------------------------------------------------------------------------------------------------------#
+
 def save_model_state(model, f_path):
 
     with open(f_path, 'wb') as f_pointer:
@@ -125,11 +159,14 @@ def load_model_state(model, f_path):
 
 
 
-def net_weights_magnitude(model, prm, p=2, exp_on_logs=True):
+def net_weights_magnitude(model, prm, p=2, exp_on_logs=True, exclude_layers=()):
     ''' Calculates the total p-norm of the weights  |W|_p^p
-        If exp_on_logs flag is on, then parameters with log_var in their name are exponented'''
+        If exp_on_logs flag is on, then parameters with log_var in their name are exponented
+        The parameters of the layers in exclude_layers (names) are not included'''
     total_mag = torch.zeros(1, device=prm.device, requires_grad=True)[0]
     for (param_name, param) in model.named_parameters():
+        if param_name.rsplit('.', 1)[0] in exclude_layers:
+            continue
         if exp_on_logs and 'log_var' in param_name:
             w = torch.exp(0.5*param)
         else:
@@ -152,6 +189,19 @@ def grad_step(objective, optimizer, lr_schedule=None, initial_lr=None, i_epoch=N
     optimizer.step()
 
 
+def accumulated_grad_step(optimizer, n_accumulated, lr_schedule=None, initial_lr=None, i_epoch=None):
+    ''' Take a step with gradients that were already accumulated (summed) over n_accumulated backward passes.
+     The gradients are averaged before the step. Note: zeroing the gradients is left to the caller'''
+    if lr_schedule:
+        adjust_learning_rate_schedule(optimizer, i_epoch, initial_lr, **lr_schedule)
+    if n_accumulated > 1:
+        for param_group in optimizer.param_groups:
+            for param in param_group['params']:
+                if param.grad is not None:
+                    param.grad.data.mul_(1 / n_accumulated)
+    optimizer.step()
+
+
 def adjust_learning_rate_interval(optimizer, epoch, initial_lr, gamma, decay_interval):
     """Sets the learning rate to the initial LR decayed by gamma every decay_interval epochs"""
     lr = initial_lr * (gamma ** (epoch // decay_interval))
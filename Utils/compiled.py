@@ -0,0 +1,62 @@
+from __future__ import absolute_import, division, print_function
+
+import torch
+
+# -------------------------------------------------------------------------------------------
+#  Compiled forward / backward (torch.compile)
+# -------------------------------------------------------------------------------------------
+# With prm.compile_forward, the forward of the models (see mixed_precision.run_forward) and the forward + loss of
+# each MC sample in get_objective (see mixed_precision.run_forward_loss) are compiled with torch.compile, which
+# fuses the many small element-wise operations of the stochastic layers (exp, pow, sqrt, the noise and add) into a
+# few kernels, also in the backward.
+# The compiled functions are shared by all the models (the model is an input of the function, and its parameters
+# are inputs of the graph), so the posteriors of all the tasks use the same compiled code. Recompilation is guarded:
+#  * the functions are compiled with dynamic shapes, so a different batch size (e.g. the last batch of an epoch) or
+#    number of samples in a task does not trigger a recompilation.
+#  * the number of compiled versions of each function is limited by prm.compile_cache_limit (e.g. for the different
+#    models, train / eval mode or eps_std), above it torch.compile falls back to the eager forward.
+# The random noise of the layers is drawn with the eager RNG (inductor's fallback_random), so the compiled forward
+# draws the same noise as the eager one (and uses the generators of the RNG streams, see Utils/rng_streams.py),
+# this also avoids the slow generated random kernels on CPU.
+# Measured speedups (Benchmarks/micro_benchmarks.py --suites compiled, two runs on a 1-thread CPU): ConvNet3
+# 0.95x-1.18x, FcNet3 0.99x-1.02x, the MPB objective (ConvNet3, meta-batch of 5 tasks) 0.92x-1.16x - all within the
+# run-to-run noise - and OmConvNet_NoBN 0.70x-0.80x, so the compiled path is off by default.
+# Note: needs a version of PyTorch with torch.compile. Code which can't be traced (e.g. the RNG streams and the
+#  per-layer statistics) causes graph breaks and runs eagerly.
+
+_compiled_funcs = {}
+
+
+def is_compiled(prm):
+    return hasattr(prm, 'compile_forward') and prm.compile_forward
+
+
+def get_compiled(func, prm):
+    ''' Returns the compiled version of func (compiled once per function and backend) '''
+    backend = prm.compile_backend if hasattr(prm, 'compile_backend') else 'inductor'
+    key = (func, backend)
+    if key not in _compiled_funcs:
+        if not hasattr(torch, 'compile'):
+            raise ValueError('compile_forward needs a PyTorch version with torch.compile')
+        set_cache_limit(prm)
+        if backend == 'inductor':
+            import torch._inductor.config as inductor_config
+            inductor_config.fallback_random = True
+        _compiled_funcs[key] = torch.compile(func, dynamic=True, backend=backend)
+    return _compiled_funcs[key]
+
+
+def set_cache_limit(prm):
+    ''' The maximal number of compiled versions of each function (the dynamo recompile limit) '''
+    import torch._dynamo.config as dynamo_config
+    cache_limit = prm.compile_cache_limit if hasattr(prm, 'compile_cache_limit') else 16
+    if hasattr(dynamo_config, 'recompile_limit'):
+        dynamo_config.recompile_limit = cache_limit
+    else:
+        dynamo_config.cache_size_limit = cache_limit
+
+
+def reset_compiled():
+    ''' Clears the compiled functions (e.g. between benchmarks) '''
+    _compiled_funcs.clear()
+    torch._dynamo.reset()
@@ -18,18 +18,20 @@ def get_hyper_divergnce(prm, prior_model):
 
     # Note:  the hyper-prior is N(0, kappa_prior^2 * I)
     # Note:  the hyper-posterior is N(parameters-of-prior-distribution, kappa_post^2 * I)
+    # Note:  the deterministic layers of a semi-stochastic model are not part of the prior distribution
+    prior_magnitude = net_weights_magnitude(prior_model, prm, p=2, exclude_layers=prior_model.deterministic_layers)
 
     if prm.divergence_type == 'W_NoSqr':
         d = prior_model.weights_count
-        hyper_dvrg = torch.sqrt(net_weights_magnitude(prior_model, prm, p=2) + d * (prm.kappa_prior - prm.kappa_post) ** 2)
+        hyper_dvrg = torch.sqrt(prior_magnitude + d * (prm.kappa_prior - prm.kappa_post) ** 2)
 
     elif prm.divergence_type == 'W_Sqr':
         d = prior_model.weights_count
-        hyper_dvrg = net_weights_magnitude(prior_model, prm, p=2) + d * (prm.kappa_prior - prm.kappa_post) ** 2
+        hyper_dvrg = prior_magnitude + d * (prm.kappa_prior - prm.kappa_post) ** 2
 
     elif prm.divergence_type == 'KL':
         # KLD between hyper-posterior and hyper-prior:
-        hyper_dvrg = (1 / (2 * prm.kappa_prior ** 2)) * net_weights_magnitude(prior_model, prm, p=2)
+        hyper_dvrg = (1 / (2 * prm.kappa_prior ** 2)) * prior_magnitude
     else:
         raise ValueError('Invalid prm.divergence_type')
 
@@ -119,6 +121,18 @@ def get_task_complexity(prm, prior_model, post_model, n_samples, avg_empiric_los
 # -------------------------------------------------------------------------------------------
 
 
+def get_complexity_loss_derivative(prm):
+    ''' The derivative of the intra-task complexity term w.r.t. the empirical loss,
+    in case it is a constant (i.e. the complexity term is linear in the empirical loss), else None'''
+    if prm.complexity_type == 'Seeger':
+        return None
+    elif prm.complexity_type == 'Catoni':
+        return 1.0
+    else:
+        return 0.0
+# -------------------------------------------------------------------------------------------
+
+
 def get_net_densities_divergence(prior_model, post_model, prm, noised_prior=False):
 
     prior_layers_list = [layer for layer in prior_model.children() if isinstance(layer, StochasticLayer)]
@@ -127,10 +141,12 @@ def get_net_densities_divergence(prior_model, post_model, prm, noised_prior=Fals
     total_dvrg = 0
     for i_layer, prior_layer in enumerate(prior_layers_list):
         post_layer = post_layers_list[i_layer]
+        # the noise of the noised prior is drawn from the posterior layer's RNG stream (if RNG streams are used):
+        generator = post_layer.rng_generator('noised_prior') if noised_prior else None
         if hasattr(prior_layer, 'w'):
-            total_dvrg += get_dvrg_element(post_layer.w, prior_layer.w, prm, noised_prior)
+            total_dvrg += get_dvrg_element(post_layer.w, prior_layer.w, prm, noised_prior, generator)
         if hasattr(prior_layer, 'b'):
-            total_dvrg += get_dvrg_element(post_layer.b, prior_layer.b, prm, noised_prior)
+            total_dvrg += get_dvrg_element(post_layer.b, prior_layer.b, prm, noised_prior, generator)
 
     if prm.divergence_type == 'W_NoSqr':
         total_dvrg = torch.sqrt(total_dvrg)
@@ -138,12 +154,12 @@ def get_net_densities_divergence(prior_model, post_model, prm, noised_prior=Fals
     return total_dvrg
 # -------------------------------------------------------------------------------------------
 
-def  get_dvrg_element(post, prior, prm, noised_prior=False):
+def  get_dvrg_element(post, prior, prm, noised_prior=False, generator=None):
     """KL divergence D_{KL}[post(x)||prior(x)] for a fully factorized Gaussian"""
 
     if noised_prior and prm.kappa_post > 0:
-        prior_log_var = add_noise(prior['log_var'], prm.kappa_post)
-        prior_mean = add_noise(prior['mean'], prm.kappa_post)
+        prior_log_var = add_noise(prior['log_var'], prm.kappa_post, generator)
+        prior_mean = add_noise(prior['mean'], prm.kappa_post, generator)
     else:
         prior_log_var = prior['log_var']
         prior_mean = prior['mean']
@@ -170,8 +186,9 @@ def  get_dvrg_element(post, prior, prm, noised_prior=False):
     return div_elem
 # -------------------------------------------------------------------------------------------
 
-def add_noise(param, std):
-    return param + Variable(param.data.new(param.size()).normal_(0, std), requires_grad=False)
+def add_noise(param, std, generator=None):
+    # generator - of an RNG stream (see Utils/rng_streams.py), None = the global RNG
+    return param + Variable(param.data.new(param.size()).normal_(0, std, generator=generator), requires_grad=False)
 # -------------------------------------------------------------------------------------------
 
 def add_noise_to_model(model, std):
@@ -184,4 +201,96 @@ def add_noise_to_model(model, std):
             add_noise(layer.w['mean'], std)
         if hasattr(layer, 'b'):
             add_noise(layer.b['log_var'], std)
-            add_noise(layer.b['mean'], std)
\ No newline at end of file
+            add_noise(layer.b['mean'], std)# -------------------------------------------------------------------------------------------
+
+
+def get_stochastic_elements(model):
+    ''' The distributions (dicts of 'mean' and 'log_var') of the weights and biases of the model's stochastic layers,
+     in the order used by get_net_densities_divergence '''
+    elements = []
+    for layer in model.children():
+        if isinstance(layer, StochasticLayer):
+            if hasattr(layer, 'w'):
+                elements.append(layer.w)
+            if hasattr(layer, 'b'):
+                elements.append(layer.b)
+    return elements
+# -------------------------------------------------------------------------------------------
+
+
+class PriorGradStats(object):
+    ''' Accumulates the statistics which determine the gradient of the objective w.r.t. the prior, in steps in which
+     the prior's graph is skipped (the posterior-only steps of the two-time-scale schedule, which use a detached
+     snapshot of the prior, see meta_train_Bayes_finite_tasks.py).
+     The divergence of each task is a sum over the weights of terms which depend on the posterior only through its
+     moments, so the sum of the divergences weighted by their derivatives (d objective / d divergence) has the same
+     gradient w.r.t. the prior as:
+      KL -  0.5 * sum(C * log_var_p + (B - 2 * mean_p * A + C * mean_p^2) / var_p),
+            where C = sum(c_i), A = sum(c_i * mean_i), B = sum(c_i * (mean_i^2 + var_i))
+      W_Sqr, W_NoSqr -  sum(C * (mean_p^2 + std_p^2) - 2 * mean_p * A - 2 * std_p * B),
+            where A = sum(c_i * mean_i), B = sum(c_i * std_i)
+     and the gradient through the hyper-divergence is (d objective / d hyper-divergence) * hyper-divergence.
+     So the prior's gradient of all the skipped steps is backpropagated later in one pass over the prior (backward()).
+     note: the noise of the noised prior is not applied in backward() (it is small, i.e. kappa_post) '''
+
+    def __init__(self, prm):
+        self.prm = prm
+        self.pending = []  # the (posterior model, divergence) of the tasks in the current step
+        self.reset()
+
+    def reset(self):
+        self.sum_weights = 0.0  # C
+        self.moments = None  # [A, B] for each stochastic element of the model
+        self.hyper_grad = 0.0
+
+    def add_task(self, post_model, dvrg):
+        ''' Called in the step's objective, with the task's divergence from the prior snapshot '''
+        if dvrg.requires_grad:
+            dvrg.retain_grad()
+            self.pending.append((post_model, dvrg))
+
+    def collect(self, hyper_dvrg):
+        ''' Called after the step's backward (before the posteriors are updated), with the step's hyper-divergence
+         (a leaf tensor) - adds the step's statistics '''
+        with torch.no_grad():
+            if hyper_dvrg.grad is not None:
+                self.hyper_grad = self.hyper_grad + hyper_dvrg.grad
+            for post_model, dvrg in self.pending:
+                if dvrg.grad is None:
+                    continue
+                weight = dvrg.grad
+                if self.prm.divergence_type == 'W_NoSqr':
+                    # the weight of the sum under the square root:
+                    weight = weight / (2 * dvrg.detach())
+                self.sum_weights = self.sum_weights + weight
+                elements = get_stochastic_elements(post_model)
+                if self.moments is None:
+                    self.moments = [[torch.zeros_like(post['mean']), torch.zeros_like(post['mean'])]
+                                    for post in elements]
+                for moments, post in zip(self.moments, elements):
+                    moments[0] += weight * post['mean']
+                    if self.prm.divergence_type == 'KL':
+                        moments[1] += weight * (post['mean'].pow(2) + torch.exp(post['log_var']))
+                    else:
+                        moments[1] += weight * torch.exp(0.5 * post['log_var'])
+        self.pending = []
+
+    def backward(self, prior_model):
+        ''' Backpropagates the accumulated gradient into the prior (added to its .grad), and resets the statistics '''
+        surrogate = 0.0
+        if torch.is_tensor(self.hyper_grad):
+            surrogate = surrogate + (self.hyper_grad * get_hyper_divergnce(self.prm, prior_model)).sum()
+        if self.moments is not None:
+            C = self.sum_weights
+            for (A, B), prior in zip(self.moments, get_stochastic_elements(prior_model)):
+                mean_p, log_var_p = prior['mean'], prior['log_var']
+                if self.prm.divergence_type == 'KL':
+                    surrogate = surrogate + 0.5 * torch.sum(
+                        C * log_var_p + (B - 2 * mean_p * A + C * mean_p.pow(2)) * torch.exp(-log_var_p))
+                else:
+                    std_p = torch.exp(0.5 * log_var_p)
+                    surrogate = surrogate + torch.sum(
+                        C * (mean_p.pow(2) + std_p.pow(2)) - 2 * mean_p * A - 2 * std_p * B)
+        if torch.is_tensor(surrogate):
+            surrogate.backward()
+        self.reset()
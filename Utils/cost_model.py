@@ -0,0 +1,263 @@
+from __future__ import absolute_import, division, print_function
+
+import math
+from functools import partial
+from copy import deepcopy
+import torch
+import torch.nn as nn
+
+from Utils import synthetic_data
+from Utils.common import list_mult
+from Utils.data_gen import get_info
+from Utils.profiling import module_flops_and_bytes, backward_flops, stochastic_path_flops_and_bytes
+
+# -------------------------------------------------------------------------------------------
+#  Analytic cost model of a run
+# -------------------------------------------------------------------------------------------
+# Estimates the memory and compute of a meta-learning run from its parameters (prm), before launching it:
+#   * parameters memory - the prior \ meta-model and all the posteriors, with their gradients and Adam state
+#   * peak activations memory of a meta-step (the tensors kept for the backward pass)
+#   * FLOPs per meta-step, per meta-test step and per run
+# The per-sample costs of the architecture are taken from a forward pass of a single dummy sample (on the CPU)
+# through the model of stochastic_models.py (MPB) or deterministic_models.py (MAML).
+# Notes:
+#   * The activations kept by each layer are estimated by its op sequence (e.g. a stochastic layer keeps x^2,
+#     the noise, the STDs and the output). Tensors of functional ops between the layers
+#     (e.g. F.elu, F.max_pool2d) are counted once, by the size of the next layer's input.
+#   * The estimates ignore the allocator overhead and the framework workspace (e.g. cuDNN), so the measured
+#     peak memory is typically somewhat higher (see the calibration in Benchmarks/plan_run.py).
+
+BYTES_PER_ELEMENT = 4  # float32
+ADAM_STATE_PER_PARAM = 2  # exp_avg, exp_avg_sq
+ADAM_FLOPS_PER_PARAM = 12
+# The complexity term (divergence between the posterior and the prior) is element-wise over the weights:
+DIVERGENCE_FLOPS_PER_PARAM = 10
+DIVERGENCE_TENSORS_PER_PARAM = 6
+
+
+def get_n_samples_per_task(prm, meta_split='meta_train'):
+    ''' Number of training and test samples in a task of the data source (for the meta-split) '''
+    data_source = prm.data_source
+    if data_source in ['MNIST', 'binarized_MNIST']:
+        n_train, n_test = 60000, 10000
+    elif data_source == 'CIFAR10':
+        n_train, n_test = 50000, 10000
+    elif data_source in ['Omniglot', 'SmallImageNet']:
+        # N-Way K-Shot (Omniglot has 20 samples per character, SmallImageNet 600 per class)
+        k_shot = prm.K_Shot_MetaTest if meta_split == 'meta_test' else prm.K_Shot_MetaTrain
+        n_per_class = 20 if data_source == 'Omniglot' else 600
+        n_train, n_test = prm.N_Way * k_shot, prm.N_Way * max(n_per_class - k_shot, 0)
+    elif data_source == 'Synthetic':
+        settings = synthetic_data.get_settings(prm)
+        n_train, n_test = settings['synthetic_n_train_samples'], settings['synthetic_n_test_samples']
+    else:
+        raise ValueError('Invalid data_source')
+    if meta_split == 'meta_test' and hasattr(prm, 'limit_train_samples_in_test_tasks') \
+            and prm.limit_train_samples_in_test_tasks:
+        n_train = min(n_train, prm.limit_train_samples_in_test_tasks)
+    return n_train, n_test
+
+
+def get_model_costs(prm, model_type='Stochastic'):
+    ''' Per-sample costs of the model (independent of the batch size):
+     n_params - number of parameters (for stochastic layers: means and log-variances),
+     fwd_flops, bwd_flops - FLOPs of the forward and backward of a sample,
+     act_elements - number of elements kept for the backward pass per sample,
+     layers - per-layer breakdown '''
+    from Models import stochastic_models, deterministic_models
+    from Models.stochastic_layers import StochasticLayer
+
+    prm = deepcopy(prm)
+    prm.device = torch.device('cpu')
+    if model_type == 'Stochastic':
+        model = stochastic_models.get_model(prm)
+    else:
+        model = deterministic_models.get_model(prm)
+    input_shape = get_info(prm)['input_shape']
+
+    layers = []
+    produced = set()  # ids of tensors already counted as the output of a layer
+
+    def hook(layer_name, module, inputs, output):
+        x = inputs[0]
+        if isinstance(module, StochasticLayer):
+            # the mean path and (if not eps_std=0) the variance path:
+            flops, _, bwd = stochastic_path_flops_and_bytes('mean', x, module.w_mu, output,
+                                                            module.b_mu if module.use_bias else None)
+            var_flops, _, var_bwd = stochastic_path_flops_and_bytes('var', x, module.w_mu, output,
+                                                                    module.b_mu if module.use_bias else None)
+            flops, bwd = flops + var_flops, bwd + var_bwd
+            # x^2, the noise, the STDs and the output:
+            kept = x.numel() + 3 * output.numel()
+        elif isinstance(module, (nn.Linear, nn.Conv2d)):
+            flops, _ = module_flops_and_bytes(module, x, output)
+            bwd = backward_flops(module, x, output)
+            kept = output.numel()
+        elif isinstance(module, (nn.BatchNorm2d, nn.MaxPool2d, nn.ReLU, nn.ELU)):
+            flops, _ = module_flops_and_bytes(module, x, output)
+            bwd = backward_flops(module, x, output)
+            # batch-norm keeps the normalized input, max-pool the (int64) indices, in-place activations nothing:
+            if isinstance(module, nn.BatchNorm2d):
+                kept = 2 * output.numel()
+            elif isinstance(module, nn.MaxPool2d):
+                kept = 3 * output.numel()
+            else:
+                kept = 0 if module.inplace else output.numel()
+        else:
+            return
+        if id(x) not in produced and x.dim() > 1 and layers:
+            # the input is the output of functional ops after the previous layer:
+            kept += x.numel()
+        produced.add(id(output))
+        layers.append({'name': layer_name, 'type': type(module).__name__, 'fwd_flops': flops,
+                       'bwd_flops': bwd, 'act_elements': kept, 'output_shape': list(output.shape[1:])})
+
+    handles = []
+    for name, module in model.named_modules():
+        if len(list(module.children())) == 0:
+            handles.append(module.register_forward_hook(partial(hook, name)))
+    model.train()
+    with torch.enable_grad():
+        model(torch.rand(1, *input_shape))
+    for handle in handles:
+        handle.remove()
+
+    n_params = sum(param.numel() for param in model.parameters())
+    return {'n_params': n_params, 'n_weights': model.weights_count,
+            'fwd_flops': sum(layer['fwd_flops'] for layer in layers),
+            'bwd_flops': sum(layer['bwd_flops'] for layer in layers),
+            'act_elements': list_mult(input_shape) + sum(layer['act_elements'] for layer in layers),
+            'layers': layers}
+
+
+def get_method(prm):
+    return prm.method if hasattr(prm, 'method') else 'MPB'
+
+
+# -------------------------------------------------------------------------------------------
+#  Costs of a run
+# -------------------------------------------------------------------------------------------
+def estimate_costs(prm):
+    ''' Estimates the memory [bytes], FLOPs and the number of steps of a run with the parameters prm
+     (prm.method = 'MPB' (default) / 'MAML', with the parameters of main_Meta_Bayes.py / main_MAML.py).
+     Returns a dict which can be saved as JSON '''
+    method = get_method(prm)
+    model = get_model_costs(prm, 'Stochastic' if method == 'MPB' else 'Standard')
+    n_params = model['n_params']
+    n_train_samples, _ = get_n_samples_per_task(prm, 'meta_train')
+    n_test_task_samples, _ = get_n_samples_per_task(prm, 'meta_test')
+    batch_size = min(prm.batch_size, n_train_samples)
+    sample_flops = model['fwd_flops'] + model['bwd_flops']
+    sample_act_bytes = BYTES_PER_ELEMENT * model['act_elements']
+    param_state_bytes = BYTES_PER_ELEMENT * n_params * (2 + ADAM_STATE_PER_PARAM)  # values, grads and Adam state
+
+    if method == 'MPB':
+        n_MC = prm.n_MC if hasattr(prm, 'n_MC') else 1
+        n_tasks_in_mb = min(prm.meta_batch_size, prm.n_train_tasks) if prm.n_train_tasks else prm.meta_batch_size
+        # models kept in memory: the prior and the posteriors of all the training tasks (or of the meta-batch):
+        n_posteriors = prm.n_train_tasks if prm.n_train_tasks else prm.meta_batch_size
+        params_bytes = (1 + n_posteriors) * param_state_bytes
+        k_steps = prm.posterior_steps_per_prior_step if hasattr(prm, 'posterior_steps_per_prior_step') else 1
+        if prm.n_train_tasks and k_steps > 1:
+            # the prior snapshot, and the accumulated statistics of the prior's gradient (see PriorGradStats):
+            params_bytes += 3 * BYTES_PER_ELEMENT * n_params
+        # graphs alive together in the meta-step (see Get_Objective_MPB.stream_mode):
+        streamed = prm.streamed_backward if hasattr(prm, 'streamed_backward') else 'None'
+        n_graphs = {'None': n_tasks_in_mb * n_MC, 'Task': n_MC, 'MC': 1}[streamed]
+        n_dvrg_graphs = n_tasks_in_mb if streamed == 'None' else 1
+        with_complexity = prm.complexity_type != 'NoComplexity'
+        dvrg_flops = 3 * DIVERGENCE_FLOPS_PER_PARAM * n_params if with_complexity else 0  # forward and backward
+        activations_bytes = n_graphs * batch_size * sample_act_bytes
+        if with_complexity:
+            activations_bytes += n_dvrg_graphs * BYTES_PER_ELEMENT * DIVERGENCE_TENSORS_PER_PARAM * n_params
+        # note: since the posteriors optimizer steps all the posteriors' parameters (they keep zeroed gradients),
+        # its cost grows with the number of training tasks
+        step_flops = n_tasks_in_mb * (n_MC * batch_size * sample_flops + dvrg_flops) + \
+            ADAM_FLOPS_PER_PARAM * (1 + n_posteriors) * n_params
+        if prm.n_train_tasks:
+            n_batches_per_task = int(math.ceil(n_train_samples / prm.batch_size))
+            steps_per_epoch = int(math.ceil(prm.n_train_tasks * n_batches_per_task / prm.meta_batch_size))
+            n_meta_train_steps = prm.n_meta_train_epochs * steps_per_epoch
+        else:
+            n_meta_train_steps = prm.n_meta_train_epochs * prm.n_inner_steps
+        # meta-test: learning a posterior for each test task (with the prior):
+        test_batch_size = min(prm.batch_size, n_test_task_samples)
+        test_step_flops = n_MC * test_batch_size * sample_flops + dvrg_flops + ADAM_FLOPS_PER_PARAM * n_params
+        n_meta_test_steps = prm.n_meta_test_epochs * int(math.ceil(n_test_task_samples / prm.batch_size))
+        test_params_bytes = 2 * param_state_bytes
+        test_activations_bytes = n_MC * test_batch_size * sample_act_bytes
+    elif method == 'MAML':
+        n_tasks_in_mb = min(prm.meta_batch_size, prm.n_train_tasks) if prm.n_train_tasks else prm.meta_batch_size
+        n_inner = prm.n_meta_train_grad_steps
+        params_bytes = param_state_bytes
+        # the graphs of all the inner steps of the meta-batch tasks are kept (second order), with the fast weights
+        # and their gradients:
+        activations_bytes = n_tasks_in_mb * ((n_inner + 1) * batch_size * sample_act_bytes +
+                                             2 * n_inner * BYTES_PER_ELEMENT * n_params)
+        # inner steps: forward and backward (with create_graph), the meta-loss forward, and the backward of the
+        # meta-gradient through the inner steps (about twice the first-order backward):
+        step_flops = n_tasks_in_mb * batch_size * ((n_inner + 1) * model['fwd_flops'] +
+                                                   n_inner * model['bwd_flops'] +
+                                                   2 * (n_inner + 1) * model['bwd_flops']) + \
+            ADAM_FLOPS_PER_PARAM * n_params
+        if prm.n_train_tasks:
+            n_batches_per_task = int(math.ceil(n_train_samples / prm.batch_size))
+            n_meta_batches = int(math.ceil(prm.n_train_tasks / prm.meta_batch_size))
+            num_epochs = int(math.ceil(prm.n_meta_train_iterations / n_meta_batches))
+            n_meta_train_steps = num_epochs * int(math.ceil(prm.n_train_tasks * n_batches_per_task /
+                                                            prm.meta_batch_size))
+        else:
+            n_meta_train_steps = prm.n_meta_train_iterations
+        # meta-test: SGD steps from the learned initial point:
+        test_batch_size = min(prm.batch_size, n_test_task_samples)
+        test_step_flops = test_batch_size * sample_flops + 2 * n_params
+        n_meta_test_steps = prm.n_meta_test_grad_steps
+        test_params_bytes = 3 * BYTES_PER_ELEMENT * n_params  # the meta-model, and the task model with its gradients
+        test_activations_bytes = test_batch_size * sample_act_bytes
+    else:
+        raise ValueError('Invalid method')
+
+    n_test_tasks = prm.n_test_tasks if hasattr(prm, 'n_test_tasks') else 0
+    return {'method': method, 'model': model,
+            'meta_train': {'params_bytes': params_bytes, 'activations_bytes': activations_bytes,
+                           'peak_bytes': params_bytes + activations_bytes,
+                           'step_flops': step_flops, 'n_steps': n_meta_train_steps,
+                           'total_flops': step_flops * n_meta_train_steps},
+            'meta_test': {'params_bytes': test_params_bytes, 'activations_bytes': test_activations_bytes,
+                          'peak_bytes': test_params_bytes + test_activations_bytes,
+                          'step_flops': test_step_flops, 'n_steps': n_test_tasks * n_meta_test_steps,
+                          'total_flops': test_step_flops * n_test_tasks * n_meta_test_steps}}
+
+
+def predict_wall_time(costs, calibration):
+    ''' Predicted times [sec] of the run phases, from the measured time per step of a calibration run
+     (calibration: {'meta_train': {'step_time': ...}, 'meta_test': {'step_time': ...}}) '''
+    prediction = {}
+    for phase in ['meta_train', 'meta_test']:
+        step_time = calibration[phase]['step_time']
+        prediction[phase] = {'time_sec': step_time * costs[phase]['n_steps'],
+                             'achieved_gflops': 1e-9 * costs[phase]['step_flops'] / max(step_time, 1e-12)}
+    prediction['total_time_sec'] = sum(prediction[phase]['time_sec'] for phase in ['meta_train', 'meta_test'])
+    return prediction
+
+
+def costs_report(costs, prediction=None):
+    ''' Report lines of the estimated costs (and the predicted times, if given) '''
+    model = costs['model']
+    lines = ['Method: {}, model parameters: {:,} ({:,} weights), per sample: {:.2f} MFLOP forward, '
+             '{:.2f} MFLOP backward, {:.2f} MB kept activations'.format(
+                costs['method'], model['n_params'], model['n_weights'], 1e-6 * model['fwd_flops'],
+                1e-6 * model['bwd_flops'], 1e-6 * BYTES_PER_ELEMENT * model['act_elements'])]
+    lines.append('{:<12}{:>14}{:>16}{:>14}{:>16}{:>12}{:>16}'.format(
+        'Phase', 'Params[MB]', 'Activations[MB]', 'Peak[MB]', 'Step-GFLOP', 'Steps', 'Total-TFLOP'))
+    for phase in ['meta_train', 'meta_test']:
+        stats = costs[phase]
+        lines.append('{:<12}{:>14.1f}{:>16.1f}{:>14.1f}{:>16.3f}{:>12,}{:>16.3f}'.format(
+            phase, 1e-6 * stats['params_bytes'], 1e-6 * stats['activations_bytes'], 1e-6 * stats['peak_bytes'],
+            1e-9 * stats['step_flops'], stats['n_steps'], 1e-12 * stats['total_flops']))
+    if prediction is not None:
+        for phase in ['meta_train', 'meta_test']:
+            lines.append('Predicted {} time: {:.1f} [sec] ({:.2f} GFLOP/s achieved in the calibration)'.format(
+                phase, prediction[phase]['time_sec'], prediction[phase]['achieved_gflops']))
+        lines.append('Predicted total time: {:.1f} [hours]'.format(prediction['total_time_sec'] / 3600))
+    return lines
@@ -8,6 +8,7 @@ import os
 import numpy as np
 from Utils import omniglot
 from Utils import imagenet_data
+from Utils import synthetic_data
 import multiprocessing
 
 # -------------------------------------------------------------------------------------------
@@ -30,6 +31,10 @@ class Task_Generator(object):
         elif self.data_source == 'SmallImageNet':
             self.class_split = imagenet_data.split_classes(prm)
 
+        elif self.data_source == 'Synthetic':
+            # Tasks are generated in memory (no data set on disk)
+            self.synthetic_tasks = synthetic_data.SyntheticTasks(prm)
+
 
     def create_meta_batch(self, prm, n_tasks, meta_split='meta_train', limit_train_samples=None):
         ''' generate a meta-batch of tasks'''
@@ -102,6 +107,9 @@ class Task_Generator(object):
                 final_input_trans=final_input_trans, target_transform=target_trans)
 
 
+        elif self.data_source == 'Synthetic':
+            train_dataset, test_dataset = self.synthetic_tasks.get_task(meta_split, final_input_trans, target_trans)
+
         elif  self.data_source == 'binarized_MNIST':
             assert not target_trans # make sure no transformations
             target_trans = [create_label_binarize(prm, thresh=5)]
@@ -115,8 +123,13 @@ class Task_Generator(object):
         if limit_train_samples: # if not none/zero
             train_dataset = reduce_train_set(train_dataset, limit_train_samples)
 
+        # Keep the transformed samples in memory after their first access:
+        if hasattr(prm, 'cache_datasets') and prm.cache_datasets:
+            train_dataset, test_dataset = CachedDataset(train_dataset), CachedDataset(test_dataset)
+
         # Create data loaders:
-        kwargs = {'num_workers': 4, 'pin_memory': True}
+        num_workers = prm.num_workers if hasattr(prm, 'num_workers') else 4
+        kwargs = {'num_workers': num_workers, 'pin_memory': True}
 
         train_loader = data_utils.DataLoader(train_dataset, batch_size=prm.batch_size, shuffle=True, **kwargs)
         test_loader = data_utils.DataLoader(test_dataset, batch_size=prm.test_batch_size, shuffle=True, **kwargs)
@@ -130,6 +143,27 @@ class Task_Generator(object):
         return data_loader
 
 
+# -------------------------------------------------------------------------------------------
+#  Cached data set
+# -------------------------------------------------------------------------------------------
+class CachedDataset(data_utils.Dataset):
+    ''' Keeps the samples of a data set (after decoding and transformations) in memory after their first access.
+     Note: with num_workers > 0 each worker process has its own copy of the cache, which is discarded when the
+     epoch ends, so the cache is effective only with num_workers = 0 (see Benchmarks/data_pipeline.py)'''
+    def __init__(self, dataset):
+        super(CachedDataset, self).__init__()
+        self.dataset = dataset
+        self.cache = {}
+
+    def __getitem__(self, index):
+        if index not in self.cache:
+            self.cache[index] = self.dataset[index]
+        return self.cache[index]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
 # -------------------------------------------------------------------------------------------
 #  MNIST  Data set
 # -------------------------------------------------------------------------------------------
@@ -213,6 +247,11 @@ def get_info(prm):
     elif prm.data_source == 'binarized_MNIST':
         info = {'input_shape': (1, 28, 28),  'n_classes': 2, 'type': 'binary_class'}
         # note: since we have two classes, we can have one output
+
+    elif prm.data_source == 'Synthetic':
+        settings = synthetic_data.get_settings(prm)
+        info = {'input_shape': settings['synthetic_input_shape'], 'n_classes': settings['synthetic_n_classes'],
+                'type': 'multi_class'}
     else:
         raise ValueError('Invalid data_source')
 
@@ -242,11 +281,11 @@ def get_batch_vars(batch_data, prm):
 def get_next_batch_cyclic(data_iterator, data_generator):
     ''' get sample from iterator, if it finishes then restart  '''
     try:
-        batch_data = data_iterator.next()
+        batch_data = next(data_iterator)
     except StopIteration:
         # in case some task has less samples - just restart the iterator and re-use the samples
         data_iterator = iter(data_generator)
-        batch_data = data_iterator.next()
+        batch_data = next(data_iterator)
     return batch_data
 
 # -----------------------------------------------------------------------------------------------------------#
@@ -0,0 +1,117 @@
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+from collections import OrderedDict
+from Models.stochastic_layers import StochasticLayer
+
+# -------------------------------------------------------------------------------------------
+#  Evaluation cache
+# -------------------------------------------------------------------------------------------
+# The bound / loss analysis (e.g. NonVacuous/nonvacuous.py, learn_single_Bayes.save_result_for_figure and
+# eval_bound) evaluates the same posterior on the same loader many times (for each loss type, divergence type and
+# complexity type). With prm.eval_cache, run_eval_Bayes (see Bayes_utils.run_eval_Bayes_multi) looks up:
+#  * the results - keyed by a hash of the model parameters, the loader (its dataset and batch size), the evaluation
+#    settings (test types, n_MC_eval, n_votes, the noise / estimator / eps_std of the layers, mixed precision,
+#    weight sampling, loss type) and the random seed. A repeated evaluation returns immediately.
+#  * the per-batch outputs of the forward passes (and the targets) - the same key without the loss type, so an
+#    evaluation which differs only in the loss function recomputes the loss from the stored outputs, without
+#    running the model.
+# The entries are kept by least-recently-used order, at most prm.eval_cache_size entries of each kind (the stored
+# outputs are on the device, n_MC_eval x n_samples x n_classes per entry).
+# Notes:
+#   * The cached Monte-Carlo estimate is reused as is, i.e. a repeated evaluation does not draw new noise.
+#   * A model is identified by its parameters' values, so a model must not be changed in-place between an
+#     evaluation and its lookup without changing its parameters (e.g. set_eps_std is part of the key).
+#
+# Usage:
+#   init_eval_cache(prm) once at the start of the run (enabled only if prm.eval_cache is True)
+
+_eval_cache = None
+
+
+def init_eval_cache(prm):
+    global _eval_cache
+    if hasattr(prm, 'eval_cache') and prm.eval_cache:
+        _eval_cache = EvalCache(prm.eval_cache_size if hasattr(prm, 'eval_cache_size') else 32)
+    else:
+        _eval_cache = None
+    return _eval_cache
+
+
+def get_eval_cache():
+    return _eval_cache
+
+
+# -------------------------------------------------------------------------------------------
+
+def model_hash(model):
+    ''' A hash of the values of the model's parameters and buffers '''
+    hasher = hashlib.sha1(type(model).__name__.encode())
+    for name, tensor in model.state_dict().items():
+        hasher.update(name.encode())
+        hasher.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return hasher.hexdigest()
+
+
+def get_layers_settings(model):
+    ''' The settings of the stochastic layers which change the outputs (all the layers have the same settings) '''
+    for m in model.modules():
+        if isinstance(m, StochasticLayer):
+            return m.eps_std, m.noise_type, m.estimator
+    return None
+
+
+class EvalCache(object):
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.results = OrderedDict()
+        self.outputs = OrderedDict()
+        self.n_results_hits = 0
+        self.n_outputs_hits = 0
+        self.n_misses = 0
+
+    def get_keys(self, model, loader, prm, test_types, n_votes):
+        ''' Returns the key of the stored outputs and the key of the results '''
+        outputs_key = (model_hash(model), get_layers_settings(model),
+                       id(loader.dataset), len(loader.dataset), loader.batch_size,
+                       tuple(test_types), prm.n_MC_eval if 'Expected' in test_types else 0, n_votes,
+                       prm.mixed_precision if hasattr(prm, 'mixed_precision') else 'fp32',
+                       prm.eval_weight_sampling if hasattr(prm, 'eval_weight_sampling') else False, prm.seed)
+        results_key = outputs_key + (prm.loss_type,)
+        return outputs_key, results_key
+
+    def get_results(self, key):
+        if key in self.results:
+            self.n_results_hits += 1
+            self.results.move_to_end(key)
+            return self.results[key][0]
+        return None
+
+    def get_outputs(self, key):
+        if key in self.outputs:
+            self.n_outputs_hits += 1
+            self.outputs.move_to_end(key)
+            return self.outputs[key][0]
+        self.n_misses += 1
+        return None
+
+    def put_results(self, key, results, loader):
+        self._put(self.results, key, results, loader)
+
+    def put_outputs(self, key, batches_outputs, loader):
+        self._put(self.outputs, key, batches_outputs, loader)
+
+    def _put(self, entries, key, value, loader):
+        # the dataset is kept with the entry, so its id (in the key) is not reused while the entry exists
+        entries[key] = (value, loader.dataset)
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def clear(self):
+        self.results.clear()
+        self.outputs.clear()
+
+    def summary(self):
+        return {'results_hits': self.n_results_hits, 'outputs_hits': self.n_outputs_hits, 'misses': self.n_misses}
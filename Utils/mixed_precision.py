@@ -0,0 +1,75 @@
+from __future__ import absolute_import, division, print_function
+
+from contextlib import contextmanager
+import torch
+from Utils.compiled import is_compiled, get_compiled
+
+# -------------------------------------------------------------------------------------------
+#  Mixed precision (bfloat16)
+# -------------------------------------------------------------------------------------------
+# With prm.mixed_precision = 'bf16', the forward computations of the training steps (get_objective, meta_test_Bayes,
+# learn_single_Bayes, MAML) and of the evaluation (run_eval_Bayes) run under torch.autocast with bfloat16, so the
+# convolutions and matrix multiplications run in bf16 (on CPU and GPU), and the parameters, gradients and optimizer
+# state stay in fp32.
+# The numerically sensitive parts stay in fp32:
+#  * in the stochastic layers (see StochasticLayer.forward), the local re-parametrization's variance path
+#    (exp(log_var), the accumulation of x^2 * var, sqrt and the noise) is fp32. With Flipout, the weight perturbation
+#    is drawn in fp32 and only its operation runs in bf16 (like the mean path), the sum is fp32.
+#  * the divergences and complexity terms (computed from the fp32 parameters, see fp32_region).
+#  * the loss (autocast computes the cross-entropy in fp32).
+# Note: needs a version of PyTorch with torch.autocast (bf16 on CPU).
+
+PRECISIONS = ['fp32', 'bf16']
+
+
+def get_precision(prm):
+    precision = prm.mixed_precision if hasattr(prm, 'mixed_precision') else 'fp32'
+    if precision == 'bf16' and not hasattr(torch, 'autocast'):
+        raise ValueError('bf16 mixed precision needs a PyTorch version with torch.autocast')
+    return precision
+
+
+@contextmanager
+def fp32_region(device_type):
+    ''' Disables the autocast (if active) in the context, so the computations run in the inputs' dtype (fp32) '''
+    if hasattr(torch, 'is_autocast_enabled') and is_autocast_active(device_type):
+        with torch.autocast(device_type, enabled=False):
+            yield
+    else:
+        yield
+
+
+def is_autocast_active(device_type):
+    if device_type == 'cpu':
+        return torch.is_autocast_cpu_enabled() if hasattr(torch, 'is_autocast_cpu_enabled') else False
+    return torch.is_autocast_enabled()
+
+
+def forward_in_precision(model, inputs, precision, device_type, *args):
+    if precision == 'bf16':
+        with torch.autocast(device_type, dtype=torch.bfloat16):
+            outputs = model(inputs, *args)
+    elif precision == 'fp32':
+        outputs = model(inputs, *args)
+    else:
+        raise ValueError('Invalid mixed_precision')
+    return outputs.float()
+
+
+def forward_loss_in_precision(model, inputs, targets, loss_criterion, precision, device_type):
+    outputs = forward_in_precision(model, inputs, precision, device_type)
+    return outputs, loss_criterion(outputs, targets)
+
+
+def run_forward(model, inputs, prm, *args):
+    ''' The model's forward in the run's precision (compiled if prm.compile_forward, see Utils/compiled.py),
+     the outputs are returned in fp32 (for the loss) '''
+    forward = get_compiled(forward_in_precision, prm) if is_compiled(prm) else forward_in_precision
+    return forward(model, inputs, get_precision(prm), prm.device.type, *args)
+
+
+def run_forward_loss(model, inputs, targets, loss_criterion, prm):
+    ''' The model's forward and the (fp32) loss in the run's precision (compiled as one function if
+     prm.compile_forward), returns (outputs, loss) '''
+    forward_loss = get_compiled(forward_loss_in_precision, prm) if is_compiled(prm) else forward_loss_in_precision
+    return forward_loss(model, inputs, targets, loss_criterion, get_precision(prm), prm.device.type)
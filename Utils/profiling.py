@@ -0,0 +1,333 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+import timeit
+from contextlib import contextmanager
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.profiler import ProfilerActivity
+from Utils.common import write_to_log, list_mult
+
+# -------------------------------------------------------------------------------------------
+#  Phase-level profiling of the training loops
+# -------------------------------------------------------------------------------------------
+# Usage:
+#   init_profiler(prm) once at the start of the run (enabled only if prm.profile_phases is True),
+#   then, in the training code:
+#       profiler = get_profiler()
+#       with profiler.phase('forward'):
+#           ...
+#       profiler.step()  # at the end of each training step
+#   and at the end of the run - profiler.write_summary(prm)
+#   The summary can also be saved in run_data.pkl (profiler.summary())
+#
+# Optionally, a torch profiler trace (torch.profiler, of the CPU and CUDA activities) is captured for the steps in
+# prm.profile_trace_steps = [first, last] (0-based, the trace starts at the first phase of step first)
+# (saved in the results dir as 'profiler_trace.json', can be viewed in chrome://tracing)
+
+
+class PhaseProfiler(object):
+    ''' Records the wall time and CPU time of each phase of the training steps '''
+
+    def __init__(self, prm):
+        self.phases = {}  # phase name -> {'wall': list of times, 'cpu': list of times}
+        self.i_step = 0
+        # on GPU, the device is synchronized at the phase boundaries (otherwise the times are of kernel launches)
+        self.sync_cuda = prm.device.type == 'cuda'
+        self.trace_steps = prm.profile_trace_steps if hasattr(prm, 'profile_trace_steps') else None
+        self.trace_path = os.path.join(prm.result_dir, 'profiler_trace.json')
+        self.trace = None
+        self.trace_saved = False
+
+    @contextmanager
+    def phase(self, name):
+        self._update_trace()
+        self._sync()
+        wall_start, cpu_start = timeit.default_timer(), time.process_time()
+        try:
+            yield
+        finally:
+            self._sync()
+            times = self.phases.setdefault(name, {'wall': [], 'cpu': []})
+            times['wall'].append(timeit.default_timer() - wall_start)
+            times['cpu'].append(time.process_time() - cpu_start)
+
+    def step(self):
+        ''' Marks the end of a training step (used for the trace window) '''
+        self.i_step += 1
+        self._update_trace()
+
+    def _update_trace(self):
+        ''' Opens the trace before step trace_steps[0] (self.i_step is the index of the current / next step),
+         and closes it after step trace_steps[1] '''
+        if not self.trace_steps or self.trace_saved:
+            return
+        first, last = self.trace_steps
+        if self.trace is None and first <= self.i_step <= last:
+            activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if self.sync_cuda else [])
+            self.trace = torch.profiler.profile(activities=activities)
+            self.trace.__enter__()
+        elif self.i_step > last:
+            self._close_trace()
+
+    def _close_trace(self):
+        if self.trace is not None and not self.trace_saved:
+            self.trace.__exit__(None, None, None)
+            self.trace.export_chrome_trace(self.trace_path)
+            self.trace_saved = True
+            print('Profiler trace saved in ' + self.trace_path)
+
+    def _sync(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+
+    def summary(self):
+        ''' Returns a dict with the statistics and the wall-time histogram of each phase '''
+        summary = {}
+        for name, times in self.phases.items():
+            wall, cpu = np.array(times['wall']), np.array(times['cpu'])
+            hist_counts, hist_edges = np.histogram(wall, bins=10)
+            summary[name] = {'count': len(wall), 'wall_total': wall.sum(), 'wall_mean': wall.mean(),
+                             'wall_p50': np.percentile(wall, 50), 'wall_p90': np.percentile(wall, 90),
+                             'wall_max': wall.max(), 'cpu_total': cpu.sum(),
+                             'wall_hist': {'counts': hist_counts, 'edges': hist_edges}}
+        return summary
+
+    def summary_table(self):
+        summary = self.summary()
+        total_wall = sum(stats['wall_total'] for stats in summary.values())
+        lines = ['{:<22}{:>9}{:>12}{:>12}{:>12}{:>12}{:>12}{:>12}{:>8}'.format(
+            'Phase', 'Count', 'Total[s]', 'Mean[ms]', 'P50[ms]', 'P90[ms]', 'Max[ms]', 'CPU[s]', 'Share')]
+        for name, stats in sorted(summary.items(), key=lambda item: -item[1]['wall_total']):
+            lines.append('{:<22}{:>9}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}{:>7.1f}%'.format(
+                name, stats['count'], stats['wall_total'], 1e3 * stats['wall_mean'], 1e3 * stats['wall_p50'],
+                1e3 * stats['wall_p90'], 1e3 * stats['wall_max'], stats['cpu_total'],
+                100 * stats['wall_total'] / max(total_wall, 1e-12)))
+        return lines
+
+    def write_summary(self, prm):
+        self._close_trace()  # in case the run ended inside the trace window
+        write_to_log('---- Phase profiling summary ({} steps):'.format(self.i_step), prm)
+        write_to_log(self.summary_table(), prm)
+
+
+def sync_timer(prm):
+    ''' The wall time, after the device is synchronized (on GPU), e.g. for timing whole training steps '''
+    if prm.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return timeit.default_timer()
+
+
+class NullProfiler(object):
+    ''' Does nothing (used when profiling is disabled) '''
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def step(self):
+        pass
+
+    def summary(self):
+        return None
+
+    def write_summary(self, prm):
+        pass
+
+
+_profiler = NullProfiler()
+
+
+def init_profiler(prm):
+    ''' Creates the run's phase profiler (and the per-layer statistics, if prm.profile_layers is True) '''
+    global _profiler, _layer_stats
+    if hasattr(prm, 'profile_phases') and prm.profile_phases:
+        _profiler = PhaseProfiler(prm)
+    else:
+        _profiler = NullProfiler()
+    if hasattr(prm, 'profile_layers') and prm.profile_layers:
+        _layer_stats = LayerStats(prm)
+    else:
+        _layer_stats = None
+    return _profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+# -------------------------------------------------------------------------------------------
+#  Per-layer statistics (FLOPs, bytes moved and wall time)
+# -------------------------------------------------------------------------------------------
+# Enabled if prm.profile_layers is True (by init_profiler), the models register the hooks when they are created
+# by get_model (see general_model.register_layer_stats and base_model.register_layer_stats).
+# The statistics are aggregated by the layer name in the model (e.g. the 'conv1' of the prior and of all the
+# posteriors are summed together). Stochastic layers are split into the 'mean' and 'var' paths of the local
+# re-parametrization, the other layers have a single 'out' path.
+# Notes:
+#   * FLOPs count multiply and add separately; bytes are the sizes of the tensors read and written by each op
+#     (an estimate which ignores caching).
+#   * The backward FLOPs are of the weight-gradient and input-gradient products. The backward time is measured from
+#     the arrival of the gradient of the layer output to the arrival of the gradient of its input, so it is not
+#     available for the first layer (whose input does not require grad).
+#   * Layers which are applied by the functional form (e.g. MAML forward with fast weights) are not counted.
+
+
+class LayerStats(object):
+    ''' Aggregates the per-layer statistics over a run '''
+
+    def __init__(self, prm):
+        self.sync_cuda = prm.device.type == 'cuda'
+        self.paths = {}  # (layer name, path) -> forward / backward statistics
+        self.layers = {}  # layer name -> {'type', 'bwd_count', 'bwd_time'}
+
+    def __deepcopy__(self, memo):
+        # copies of a model (e.g. a frozen or quantized copy) keep recording to the run's statistics
+        return self
+
+    def timer(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return timeit.default_timer()
+
+    def add_forward(self, layer_name, path, start_time, flops, n_bytes, bwd_flops):
+        stats = self.paths.setdefault((layer_name, path), {'fwd_count': 0, 'fwd_time': 0.0, 'fwd_flops': 0,
+                                                          'fwd_bytes': 0, 'bwd_flops': 0})
+        stats['fwd_count'] += 1
+        stats['fwd_time'] += self.timer() - start_time
+        stats['fwd_flops'] += flops
+        stats['fwd_bytes'] += n_bytes
+        if torch.is_grad_enabled():
+            stats['bwd_flops'] += bwd_flops
+
+    def add_backward(self, layer_name, time):
+        layer = self.layers[layer_name]
+        layer['bwd_count'] += 1
+        layer['bwd_time'] += time
+
+    def register_layer(self, layer_name, module, split_paths=False):
+        ''' Registers forward hooks on a layer
+         (if split_paths - the layer records the statistics of its paths in its forward, e.g. stochastic layers) '''
+        self.layers.setdefault(layer_name, {'type': type(module).__name__, 'bwd_count': 0, 'bwd_time': 0.0})
+        handles = []
+        call = {}
+
+        def pre_hook(module, inputs):
+            call['start'] = self.timer()
+
+        def hook(module, inputs, output):
+            x = inputs[0]
+            if not split_paths:
+                flops, n_bytes = module_flops_and_bytes(module, x, output)
+                bwd_flops = backward_flops(module, x, output)
+                self.add_forward(layer_name, 'out', call['start'], flops, n_bytes, bwd_flops)
+            if torch.is_grad_enabled() and output.requires_grad and x.requires_grad:
+                backward_call = {}
+
+                def output_grad_hook(grad):
+                    backward_call['start'] = self.timer()
+
+                def input_grad_hook(grad):
+                    if 'start' in backward_call:
+                        self.add_backward(layer_name, self.timer() - backward_call.pop('start'))
+
+                output.register_hook(output_grad_hook)
+                x.register_hook(input_grad_hook)
+
+        if not split_paths:
+            handles.append(module.register_forward_pre_hook(pre_hook))
+        handles.append(module.register_forward_hook(hook))
+        return handles
+
+    def summary(self):
+        ''' Returns a dict: layer name -> {'type', 'bwd_count', 'bwd_time', 'paths': {path -> statistics}} '''
+        summary = {}
+        for layer_name, layer in self.layers.items():
+            summary[layer_name] = dict(layer, paths={path: dict(stats) for (name, path), stats in self.paths.items()
+                                                     if name == layer_name})
+        return summary
+
+    def report(self):
+        lines = ['{:<24}{:<18}{:<7}{:>8}{:>11}{:>11}{:>11}{:>11}{:>11}{:>11}'.format(
+            'Layer', 'Type', 'Path', 'Calls', 'Fwd[ms]', 'Fwd-GFLOP', 'Fwd-MB', 'Fwd-GFLOPS', 'Bwd[ms]', 'Bwd-GFLOP')]
+        row = '{:<24}{:<18}{:<7}{:>8}{:>11.2f}{:>11.3f}{:>11.1f}{:>11.2f}{:>11}{:>11.3f}'
+        for layer_name, layer in self.summary().items():
+            paths = layer['paths']
+            bwd_time = '{:.2f}'.format(1e3 * layer['bwd_time']) if layer['bwd_count'] else '-'
+            if len(paths) > 1:
+                # the backward time is not split to paths, it is shown in the layer's total
+                paths = dict(paths, total={key: sum(stats[key] for stats in paths.values())
+                                           for key in ['fwd_time', 'fwd_flops', 'fwd_bytes', 'bwd_flops']})
+                paths['total']['fwd_count'] = max(stats['fwd_count'] for stats in layer['paths'].values())
+            for path, stats in sorted(paths.items(), key=lambda item: item[0] == 'total'):
+                lines.append(row.format(layer_name, layer['type'], path, stats['fwd_count'], 1e3 * stats['fwd_time'],
+                                        1e-9 * stats['fwd_flops'], 1e-6 * stats['fwd_bytes'],
+                                        1e-9 * stats['fwd_flops'] / max(stats['fwd_time'], 1e-12),
+                                        bwd_time if path == 'total' or len(paths) == 1 else '',
+                                        1e-9 * stats['bwd_flops']))
+        return lines
+
+    def write_report(self, prm):
+        write_to_log('---- Per-layer statistics:', prm)
+        write_to_log(self.report(), prm)
+
+
+def matmul_flops(weight, output):
+    ''' FLOPs of a linear \\ conv2d product (each output element is a dot product with a weight row) '''
+    return 2 * output.numel() * list_mult(weight.shape[1:])
+
+
+def module_flops_and_bytes(module, x, output):
+    ''' FLOPs and bytes of a deterministic layer '''
+    el_size = output.element_size()
+    if isinstance(module, (nn.Linear, nn.Conv2d)):
+        flops = matmul_flops(module.weight, output)
+        n_elements = x.numel() + module.weight.numel() + output.numel()
+        if module.bias is not None:
+            flops += output.numel()
+            n_elements += module.bias.numel()
+    else:
+        # element-wise layer (e.g. batch-norm: scale and shift)
+        flops = 2 * output.numel()
+        n_elements = x.numel() + output.numel()
+    return flops, el_size * n_elements
+
+
+def backward_flops(module, x, output):
+    ''' FLOPs of the weight-gradient product (and of the input-gradient product, if needed) '''
+    if isinstance(module, (nn.Linear, nn.Conv2d)):
+        n_products = 2 if x.requires_grad else 1
+        return n_products * matmul_flops(module.weight, output)
+    return 2 * output.numel()
+
+
+def stochastic_path_flops_and_bytes(path, x, weight, output, bias=None):
+    ''' FLOPs and bytes of a path of a stochastic layer (see StochasticLayer.forward) '''
+    el_size = output.element_size()
+    bias_count = 0 if bias is None else bias.numel()
+    flops = matmul_flops(weight, output) + (0 if bias is None else output.numel())
+    if path == 'mean':
+        # out_mean = op(x, w_mu, b_mu)
+        n_elements = x.numel() + weight.numel() + output.numel() + bias_count
+    elif path == 'flipout':
+        # (weight = the log-variance) dW = exp(log_var / 2) * noise, x * signs, op(x * signs, dW, db), multiply by
+        # the output signs and add to out_mean
+        flops += x.numel() + 3 * weight.numel() + 3 * bias_count + 2 * output.numel()
+        n_elements = 3 * x.numel() + 5 * weight.numel() + 5 * bias_count + 6 * output.numel()
+    else:
+        # x^2, exp(log_var), out_var = op(x^2, w_var, b_var), noise, sqrt, multiply and add to out_mean
+        flops += x.numel() + weight.numel() + bias_count + 4 * output.numel()
+        n_elements = 3 * x.numel() + 3 * weight.numel() + 3 * bias_count + 10 * output.numel()
+    bwd_flops = (2 if x.requires_grad else 1) * matmul_flops(weight, output)
+    return flops, el_size * n_elements, bwd_flops
+
+
+
+_layer_stats = None
+
+
+def get_layer_stats():
+    ''' Returns the run's LayerStats (None if per-layer statistics are disabled) '''
+    return _layer_stats
@@ -0,0 +1,78 @@
+from __future__ import absolute_import, division, print_function
+
+import zlib
+import threading
+import torch
+
+# -------------------------------------------------------------------------------------------
+#  Counter-based random number streams
+# -------------------------------------------------------------------------------------------
+# With prm.rng_streams, the noise of the stochastic layers (the re-parametrization trick / Flipout) and of the
+# noised prior (complexity_terms.add_noise) is not drawn from the global torch RNG. Instead, each draw uses a
+# generator seeded by a hash of its key: (seed, model key, layer, train / eval, step, draw type, draw index), where
+# the model key is set by the training loops (e.g. the task id of a posterior, see general_model.set_rng_key), the
+# step is counted by the layer (see StochasticLayer.reset_noise) and the draw index is the MC index in the step.
+# So the noise is a function of the key only, and does not depend on the order in which the tasks / layers are
+# computed, on threads or on the number of data loader workers (which still use the global RNG for the data order).
+# Note: the streams of the CPU and of the GPU generators are different, so a run is reproduced bit-for-bit on the
+#  same device type.
+
+MASK_64 = (1 << 64) - 1
+
+_rng_streams = None
+
+
+def init_rng_streams(prm):
+    ''' Creates the run's RNG streams (if prm.rng_streams is True), otherwise the global RNG is used '''
+    global _rng_streams
+    if hasattr(prm, 'rng_streams') and prm.rng_streams:
+        _rng_streams = RNGStreams(prm.seed)
+    else:
+        _rng_streams = None
+    return _rng_streams
+
+
+def get_rng_streams():
+    ''' Returns the run's RNGStreams (None if the global RNG is used) '''
+    return _rng_streams
+
+
+def splitmix64(x):
+    x = (x + 0x9e3779b97f4a7c15) & MASK_64
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK_64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK_64
+    return x ^ (x >> 31)
+
+
+def stream_seed(*key):
+    ''' A 63-bit seed from a key of ints, strings, None and (nested) tuples (the same in every run and process,
+     unlike the built-in hash of strings) '''
+    h = 0
+    for field in key:
+        if isinstance(field, (tuple, list)):
+            value = stream_seed(*field)
+        elif isinstance(field, str):
+            value = zlib.crc32(field.encode('utf-8'))
+        elif field is None:
+            value = MASK_64
+        else:
+            value = int(field) & MASK_64
+        h = splitmix64(h ^ value)
+    return h >> 1
+
+
+class RNGStreams(object):
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.local = threading.local()  # a generator per thread and device
+
+    def generator(self, device, *key):
+        ''' Returns a generator on the device at the start of the stream of the key '''
+        generators = self.local.__dict__.setdefault('generators', {})
+        device = torch.device(device)
+        if device not in generators:
+            generators[device] = torch.Generator(device=device)
+        gen = generators[device]
+        gen.manual_seed(stream_seed(self.seed, *key))
+        return gen
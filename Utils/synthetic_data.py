@@ -0,0 +1,131 @@
+from __future__ import absolute_import, division, print_function
+
+import torch
+import torch.utils.data as data
+
+
+# -------------------------------------------------------------------------------------------
+#  Synthetic classification tasks (generated in memory, no download needed)
+# -------------------------------------------------------------------------------------------
+# Each class has a prototype input, which is shared by all the tasks of both meta-splits (so there is a common
+# structure for the meta-learner to transfer, as the images of MNIST with the 'Permute_Labels' transform), and each
+# task adds its own random shift to the prototypes. A sample is its class prototype plus Gaussian noise.
+#
+# All the data is drawn from generators seeded by (seed, meta-split, task index), so the same settings
+# always give the same tasks (independently of the global random state).
+#
+# The difficulty is set by the distance between the prototypes relative to the noise. With the default settings
+# (28x28 inputs, 10 classes, prototype STD 0.15, noise STD 1.0) the classes overlap, and a single task learned
+# from scratch with 600 samples ends at a non-trivial test error: about 5%-10% with FcNet3 and about 70% with
+# ConvNet3 (the prototypes have no spatial structure, so the pooling of the conv-nets loses much of the signal).
+# A larger prototype STD makes the tasks easier, e.g. ConvNet3 ends at about 25% with 0.3 and 2% with 0.5
+# (with prototype STD 1.0 all the models reach 0% error within the first epoch).
+#
+# Parameters (all optional):
+#   prm.synthetic_input_shape - input shape (channels, height, width) [default: (1, 28, 28)]
+#   prm.synthetic_n_classes - number of classes in each task [default: 10]
+#   prm.synthetic_n_train_samples, prm.synthetic_n_test_samples - number of samples in each task [default: 600, 100]
+#   prm.synthetic_n_tasks - number of distinct tasks in each meta-split, after which the tasks repeat
+#                           (None or 0 = a new task is generated each time) [default: None]
+#   prm.synthetic_prototype_std - STD of the entries of the class prototypes [default: 0.15]
+#   prm.synthetic_task_shift_std - STD of the task-specific shift of the prototypes, relative to
+#                                  synthetic_prototype_std [default: 0.5]
+#   prm.synthetic_noise_std - STD of the samples noise around the prototypes [default: 1.0]
+#   prm.synthetic_seed - [default: prm.seed]
+
+
+def get_settings(prm):
+    ''' Returns the synthetic data settings (with defaults for the ones not in prm) '''
+    defaults = {'synthetic_input_shape': (1, 28, 28), 'synthetic_n_classes': 10,
+                'synthetic_n_train_samples': 600, 'synthetic_n_test_samples': 100,
+                'synthetic_n_tasks': None, 'synthetic_prototype_std': 0.15, 'synthetic_task_shift_std': 0.5,
+                'synthetic_noise_std': 1.0,
+                'synthetic_seed': prm.seed if hasattr(prm, 'seed') else 1}
+    settings = {name: getattr(prm, name) if hasattr(prm, name) else default for name, default in defaults.items()}
+    settings['synthetic_input_shape'] = tuple(settings['synthetic_input_shape'])
+    return settings
+
+
+def get_generator(*seed_parts):
+    ''' A random generator seeded by a combination of integers '''
+    seed = 0
+    for part in seed_parts:
+        seed = (seed * 1000003 + part) % (2 ** 63)
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return generator
+
+
+# -------------------------------------------------------------------------------------------
+#  Task generator
+# -------------------------------------------------------------------------------------------
+class SyntheticTasks(object):
+
+    splits_ids = {'meta_train': 0, 'meta_test': 1}
+
+    def __init__(self, prm):
+        self.settings = get_settings(prm)
+        self.tasks_counters = {split_name: 0 for split_name in self.splits_ids}
+        # Class prototypes (of both meta-splits):
+        generator = get_generator(self.settings['synthetic_seed'])
+        shape = (self.settings['synthetic_n_classes'],) + self.settings['synthetic_input_shape']
+        self.prototypes = self.settings['synthetic_prototype_std'] * torch.randn(shape, generator=generator)
+
+    def get_task(self, meta_split, final_input_trans=None, target_transform=None):
+        ''' Returns the train and test datasets of the next task in the meta-split '''
+        i_task = self.tasks_counters[meta_split]
+        self.tasks_counters[meta_split] += 1
+        n_tasks = self.settings['synthetic_n_tasks']
+        if n_tasks:
+            i_task = i_task % n_tasks
+
+        generator = get_generator(self.settings['synthetic_seed'], self.splits_ids[meta_split], i_task + 1)
+        prototypes = self.prototypes
+        shift_std = self.settings['synthetic_prototype_std'] * self.settings['synthetic_task_shift_std']
+        task_prototypes = prototypes + shift_std * torch.randn(prototypes.shape, generator=generator)
+
+        train_dataset = self.draw_samples(task_prototypes, self.settings['synthetic_n_train_samples'], generator,
+                                          final_input_trans, target_transform)
+        test_dataset = self.draw_samples(task_prototypes, self.settings['synthetic_n_test_samples'], generator,
+                                         final_input_trans, target_transform)
+        return train_dataset, test_dataset
+
+    def draw_samples(self, task_prototypes, n_samples, generator, final_input_trans, target_transform):
+        n_classes = task_prototypes.shape[0]
+        # balanced labels, in random order:
+        labels = torch.arange(n_samples) % n_classes
+        labels = labels[torch.randperm(n_samples, generator=generator)]
+        inputs = task_prototypes[labels] + self.settings['synthetic_noise_std'] * \
+                 torch.randn((n_samples,) + tuple(task_prototypes.shape[1:]), generator=generator)
+        return synthetic_dataset(inputs, labels, final_input_trans, target_transform)
+
+
+# -------------------------------------------------------------------------------------------
+#  Class definition
+# -------------------------------------------------------------------------------------------
+class synthetic_dataset(data.Dataset):
+    # note: the data is kept in the fields train_data and train_labels (as in the torchvision datasets),
+    #  so the number of samples can be reduced by data_gen.reduce_train_set
+    def __init__(self, inputs, labels, final_input_trans=None, target_transform=None):
+        super(synthetic_dataset, self).__init__()
+        self.train_data = inputs
+        self.train_labels = labels
+        self.final_input_trans = final_input_trans
+        self.target_transform = target_transform
+
+    def __getitem__(self, index):
+        img = self.train_data[index]
+        target = int(self.train_labels[index])
+
+        if self.final_input_trans:
+            for trans in self.final_input_trans:
+                img = trans(img)
+
+        if self.target_transform:
+            for trans in self.target_transform:
+                target = trans(target)
+
+        return img, target
+
+    def __len__(self):
+        return len(self.train_labels)